@@ -0,0 +1,91 @@
+# Login Storm Benchmark
+# Fires a burst of concurrent logins at a running backend while probing an unrelated endpoint,
+# and reports login throughput and the probe's latency percentiles.
+#
+#   python benchmark_login.py --url http://localhost:8001 --username admin --password admin123 \
+#       --logins 200 --concurrency 50
+#
+# Compare runs with different PASSWORD_HASH_THREADS settings on the server; when password hashing
+# blocks the event loop the probe's p99 grows with the length of the login queue.
+
+import argparse
+import asyncio
+import time
+
+import httpx
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+async def run_storm(client: httpx.AsyncClient, username: str, password: str, logins: int, concurrency: int,
+                    probe_path: str = "/api/company-settings", probe_interval: float = 0.01) -> dict:
+    """Run the storm with an existing client (base_url set) and return the measurements"""
+    slots = asyncio.Semaphore(concurrency)
+    failures = 0
+
+    async def login():
+        nonlocal failures
+        async with slots:
+            response = await client.post("/api/auth/login", json={"username": username, "password": password})
+            if response.status_code != 200:
+                failures += 1
+
+    probe_latencies = []
+    storm_done = asyncio.Event()
+
+    async def probe():
+        # Latency is measured from when the request was due, so time spent waiting on a
+        # blocked event loop (the client may share it, e.g. with an in-process transport) counts
+        due = time.perf_counter()
+        while True:
+            await client.get(probe_path)
+            finished = time.perf_counter()
+            probe_latencies.append((finished - due) * 1000)
+            if storm_done.is_set():
+                break
+            due = finished + probe_interval
+            await asyncio.sleep(probe_interval)
+
+    prober = asyncio.create_task(probe())
+    started = time.perf_counter()
+    await asyncio.gather(*(login() for _ in range(logins)))
+    elapsed = time.perf_counter() - started
+    storm_done.set()
+    await prober
+
+    return {
+        "logins": logins,
+        "failed_logins": failures,
+        "seconds": round(elapsed, 3),
+        "logins_per_second": round(logins / elapsed, 1),
+        "probe_requests": len(probe_latencies),
+        "probe_p50_ms": round(percentile(probe_latencies, 0.50), 1),
+        "probe_p99_ms": round(percentile(probe_latencies, 0.99), 1),
+        "probe_max_ms": round(max(probe_latencies, default=0.0), 1)
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Login storm benchmark")
+    parser.add_argument("--url", default="http://localhost:8001")
+    parser.add_argument("--username", default="admin")
+    parser.add_argument("--password", default="admin123")
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--probe-path", default="/api/company-settings")
+    args = parser.parse_args()
+
+    limits = httpx.Limits(max_connections=args.concurrency + 1)
+    async with httpx.AsyncClient(base_url=args.url, timeout=120, limits=limits) as client:
+        result = await run_storm(client, args.username, args.password, args.logins, args.concurrency, args.probe_path)
+    for key, value in result.items():
+        print(f"{key:>20}: {value}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
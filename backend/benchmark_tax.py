@@ -0,0 +1,114 @@
+# GST Tax Engine Benchmark
+# Times the tax helpers against the float loop they replaced, on randomly generated invoices:
+#   old       - the two-pass loop calculate_document_totals used to run
+#   float     - document_totals, its one-pass replacement (quotations, orders, purchases)
+#   document  - compute_document_tax, one call per invoice (the create-invoice path, exact paise)
+#   batch     - compute_tax_batch over every invoice at once (batch invoices, ledgers, reports)
+#
+#   python benchmark_tax.py --documents 10000 --lines 5
+#
+# All four compute the same totals; document and batch are exact to the paisa.
+
+import argparse
+import random
+import time
+
+import numpy as np
+
+from tax import compute_document_tax, compute_tax_batch, document_totals
+
+
+def float_totals(lines: list, is_interstate: bool, overall_discount_type: str, overall_discount_value: float) -> dict:
+    """The float arithmetic calculate_document_totals used before the tax engine"""
+    subtotal = 0
+    total_discount = 0
+    for quantity, price, discount_percent, _ in lines:
+        item_total = quantity * price
+        subtotal += item_total
+        total_discount += item_total * (discount_percent / 100)
+    amount_after_item_discount = subtotal - total_discount
+    overall_discount_amount = 0.0
+    if overall_discount_value > 0:
+        if overall_discount_type == "percentage":
+            overall_discount_amount = amount_after_item_discount * (overall_discount_value / 100)
+        else:
+            overall_discount_amount = overall_discount_value
+    taxable_amount = amount_after_item_discount - overall_discount_amount
+    total_gst = 0
+    for quantity, price, discount_percent, gst_rate in lines:
+        item_total = quantity * price
+        item_taxable = item_total - item_total * (discount_percent / 100)
+        if amount_after_item_discount > 0:
+            item_taxable -= overall_discount_amount * (item_taxable / amount_after_item_discount)
+        total_gst += item_taxable * (gst_rate / 100)
+    igst = total_gst if is_interstate else 0.0
+    return {
+        "subtotal": subtotal, "total_discount": total_discount, "overall_discount_amount": overall_discount_amount,
+        "taxable_amount": taxable_amount, "cgst_amount": (total_gst - igst) / 2, "sgst_amount": (total_gst - igst) / 2,
+        "igst_amount": igst, "total_gst": total_gst, "grand_total": taxable_amount + total_gst
+    }
+
+
+def make_documents(count: int, lines_per_document: int, seed: int = 7) -> list:
+    """(lines, is_interstate, overall_discount_type, overall_discount_value) per document"""
+    rng = random.Random(seed)
+    return [(
+        [(rng.randint(1, 50), round(rng.uniform(5, 5000), 2), rng.choice((0, 0, 5, 10, 12.5)), rng.choice((0, 5, 12, 18, 28)))
+         for _ in range(lines_per_document)],
+        rng.random() < 0.3,
+        rng.choice(("percentage", "amount")),
+        rng.choice((0, 0, 2.5, 10))
+    ) for _ in range(count)]
+
+
+def run_old(documents: list) -> None:
+    for lines, is_interstate, discount_type, discount_value in documents:
+        float_totals(lines, is_interstate, discount_type, discount_value)
+
+
+def run_float(documents: list) -> None:
+    for lines, is_interstate, discount_type, discount_value in documents:
+        document_totals(lines, is_interstate, discount_type, discount_value)
+
+
+def run_document(documents: list) -> None:
+    for lines, is_interstate, discount_type, discount_value in documents:
+        compute_document_tax(lines, is_interstate, discount_type, discount_value)
+
+
+def run_batch(documents: list) -> None:
+    all_lines = [line for lines, _, _, _ in documents for line in lines]
+    quantities = [line[0] for line in all_lines]
+    prices = [line[1] for line in all_lines]
+    discounts = [line[2] for line in all_lines]
+    rates = [line[3] for line in all_lines]
+    positions = np.repeat(np.arange(len(documents)), [len(lines) for lines, _, _, _ in documents])
+    compute_tax_batch(quantities, prices, discounts, rates, positions, len(documents),
+                      [doc[2] for doc in documents], [doc[3] for doc in documents], [doc[1] for doc in documents])
+
+
+def best_of(function, documents: list, repeats: int) -> float:
+    """Fastest of several runs, in milliseconds"""
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        function(documents)
+        timings.append((time.perf_counter() - started) * 1000)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GST tax engine benchmark")
+    parser.add_argument("--documents", type=int, default=10000)
+    parser.add_argument("--lines", type=int, default=5)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    documents = make_documents(args.documents, args.lines)
+    for name, function in (("old", run_old), ("float", run_float), ("document", run_document), ("batch", run_batch)):
+        elapsed = best_of(function, documents, args.repeats)
+        print(f"{name:>10}: {elapsed:9.1f} ms  {elapsed * 1000 / args.documents:7.2f} us/document")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+# Multi-level BOM explosion
+# A BOM line with material_type "product" is a sub-assembly: a product that has its own BOM.
+# Works on an in-memory graph {product_id: [BOM lines]} - no database access.
+
+# BOM material_type -> stock item type
+BOM_ITEM_TYPES = {"raw": "raw_material", "packing": "packing_material", "product": "product"}
+
+
+def sub_assembly_ids(materials: list) -> list:
+    """Product ids referenced by a BOM's lines"""
+    return [m['material_id'] for m in materials if m.get('material_type') == "product"]
+
+
+def find_bom_cycle(product_id: str, boms: dict):
+    """Path of product ids that leads from product_id back to itself, or None.
+    The stored graph is kept acyclic, so any new cycle has to pass through the BOM being saved."""
+    path = [product_id]
+    visited = set()
+
+    def walk(current):
+        for child in sub_assembly_ids(boms.get(current, [])):
+            if child == product_id:
+                return path + [child]
+            if child in visited:
+                continue
+            visited.add(child)
+            path.append(child)
+            cycle = walk(child)
+            if cycle:
+                return cycle
+            path.pop()
+        return None
+
+    return walk(product_id)
+
+
+def flatten_bom(product_id: str, boms: dict, memo: dict) -> dict:
+    """Per-unit leaf requirements of a product: {(item_type, item_id): {"material_name", "unit", "quantity"}}.
+    Sub-assemblies with a BOM are expanded; sub-assemblies without one stay as product lines.
+    memo holds results already flattened, so shared sub-assemblies are expanded once."""
+    if product_id in memo:
+        return memo[product_id]
+
+    totals = {}
+    for material in boms[product_id]:
+        if material.get('material_type') == "product" and material['material_id'] in boms:
+            for key, line in flatten_bom(material['material_id'], boms, memo).items():
+                entry = totals.setdefault(key, {**line, "quantity": 0.0})
+                entry['quantity'] += material['quantity'] * line['quantity']
+        else:
+            item_type = BOM_ITEM_TYPES.get(material.get('material_type'), material.get('material_type'))
+            entry = totals.setdefault((item_type, material['material_id']), {
+                "material_name": material.get('material_name', ''),
+                "unit": material.get('unit', ''),
+                "quantity": 0.0
+            })
+            entry['quantity'] += material['quantity']
+
+    memo[product_id] = totals
+    return totals
@@ -0,0 +1,84 @@
+# Material Requirements Planning
+# Nets product demand against finished stock one BOM level at a time: a product's net requirement is
+# exploded into its sub-assemblies, whose stock is netted in turn before anything below them is
+# exploded. What the products to be made need of each material is then netted against stock and
+# open purchase orders.
+# Everything is held in NumPy arrays indexed by product / material position - no database access.
+
+import numpy as np
+
+
+class ArrayIndex:
+    """Maps keys (ids, or (type, id) tuples) to dense array positions, adding new keys on first sight"""
+
+    def __init__(self, keys=()):
+        self.positions = {}
+        self.keys = []
+        for key in keys:
+            self.add(key)
+
+    def add(self, key) -> int:
+        position = self.positions.get(key)
+        if position is None:
+            position = len(self.keys)
+            self.positions[key] = position
+            self.keys.append(key)
+        return position
+
+    def lookup(self, keys) -> np.ndarray:
+        """Positions for many keys at once, adding any that are new"""
+        return np.fromiter((self.add(key) for key in keys), dtype=np.int64, count=len(keys))
+
+    def __len__(self):
+        return len(self.keys)
+
+
+def sum_by_index(positions: np.ndarray, quantities, size: int) -> np.ndarray:
+    """Total quantity per position; repeated positions are added together"""
+    return np.bincount(positions, weights=np.asarray(quantities, dtype=np.float64), minlength=size)[:size]
+
+
+def low_level_codes(size: int, parents: np.ndarray, children: np.ndarray) -> np.ndarray:
+    """BOM level of each product: 0 for products no BOM uses, otherwise one below its deepest parent.
+    parents / children are product positions, one pair per sub-assembly line. The graph must be
+    acyclic, which saving a BOM enforces."""
+    levels = np.zeros(size, dtype=np.int64)
+    for _ in range(size):
+        deeper = levels[parents] + 1
+        if not np.any(deeper > levels[children]):
+            break
+        np.maximum.at(levels, children, deeper)
+    return levels
+
+
+def net_requirements(demand: np.ndarray, product_stock: np.ndarray,
+                     sub_parents: np.ndarray, sub_children: np.ndarray, sub_quantities: np.ndarray,
+                     bom_products: np.ndarray, bom_materials: np.ndarray, bom_quantities: np.ndarray,
+                     material_stock: np.ndarray, material_on_order: np.ndarray):
+    """MRP netting, level by level.
+    demand / product_stock are indexed by product; material_stock / material_on_order by material.
+    sub_parents, sub_children and sub_quantities are parallel arrays with one entry per BOM line that
+    uses a product (per-unit quantity of the sub-assembly in its parent); bom_products, bom_materials
+    and bom_quantities likewise for the lines that use a material.
+    Returns (requirement, to_produce, gross_requirement, shortage), where requirement is each
+    product's own demand plus what the products above it need of it."""
+    size = len(demand)
+    requirement = np.array(demand, dtype=np.float64)
+    to_produce = np.zeros(size)
+    stock = np.maximum(product_stock, 0)
+    levels = low_level_codes(size, sub_parents, sub_children)
+    parent_levels = levels[sub_parents]
+    for level in range(int(levels.max()) + 1 if size else 0):
+        at_level = levels == level
+        to_produce[at_level] = np.maximum(requirement[at_level] - stock[at_level], 0)
+        lines = parent_levels == level
+        requirement += np.bincount(
+            sub_children[lines], weights=sub_quantities[lines] * to_produce[sub_parents[lines]], minlength=size
+        )[:size]
+
+    gross_requirement = np.bincount(
+        bom_materials, weights=bom_quantities * to_produce[bom_products], minlength=len(material_stock)
+    )[:len(material_stock)]
+    available = np.maximum(material_stock, 0) + material_on_order
+    shortage = np.maximum(gross_requirement - available, 0)
+    return requirement, to_produce, gross_requirement, shortage
@@ -0,0 +1,68 @@
+# Password Hashing
+# bcrypt spends 100-300 ms of CPU on every hash and verify, so none of it runs on the event loop.
+# Logins and single password changes go to a bounded thread pool (bcrypt releases the GIL while
+# hashing); bulk hashing is spread over a process pool. The pool sizes are the concurrency caps.
+
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from passlib.context import CryptContext
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+# Hashes / verifications running at once for request handlers; further calls queue for a thread
+PASSWORD_HASH_THREADS = int(os.environ.get('PASSWORD_HASH_THREADS', str(min(4, os.cpu_count() or 1))))
+# Worker processes for bulk hashing
+PASSWORD_HASH_PROCESSES = int(os.environ.get('PASSWORD_HASH_PROCESSES', str(os.cpu_count() or 1)))
+# Below this many passwords a bulk call stays on the thread pool (process start-up costs more)
+BULK_HASH_MIN = 8
+
+_thread_pool = ThreadPoolExecutor(max_workers=PASSWORD_HASH_THREADS, thread_name_prefix="password-hash")
+_process_pool = None
+
+
+def verify_password(plain_password, hashed_password):
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+def get_password_hash(password):
+    return pwd_context.hash(password)
+
+
+async def verify_password_async(plain_password, hashed_password) -> bool:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_thread_pool, verify_password, plain_password, hashed_password)
+
+
+async def hash_password_async(password) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_thread_pool, get_password_hash, password)
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        # spawn, not fork: the server process holds threads and open sockets
+        _process_pool = ProcessPoolExecutor(max_workers=PASSWORD_HASH_PROCESSES,
+                                            mp_context=multiprocessing.get_context("spawn"))
+    return _process_pool
+
+
+async def hash_passwords_bulk(passwords: list) -> list:
+    """Hashes of many passwords, in order"""
+    if len(passwords) < BULK_HASH_MIN:
+        return list(await asyncio.gather(*(hash_password_async(password) for password in passwords)))
+    loop = asyncio.get_running_loop()
+    pool = _get_process_pool()
+    return list(await asyncio.gather(*(loop.run_in_executor(pool, get_password_hash, password)
+                                       for password in passwords)))
+
+
+def shutdown_password_pools():
+    global _process_pool
+    _thread_pool.shutdown(wait=False, cancel_futures=True)
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
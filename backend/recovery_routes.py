@@ -6,8 +6,9 @@ from pydantic import BaseModel, Field, ConfigDict
 from typing import List, Optional
 from datetime import datetime, timezone, timedelta
 from uuid import uuid4
-import httpx
-import os
+
+from whatsapp_client import whatsapp_request, WhatsAppUnavailable
+from whatsapp_queue import new_whatsapp_job, enqueue_whatsapp_jobs, job_finished_hooks
 
 # Create recovery router
 recovery_router = APIRouter(prefix="/api")
@@ -55,6 +56,41 @@ class FollowUpNote(BaseModel):
 
 # ========== RECOVERY ROUTES ==========
 
+def build_reminder_message(customer_name: str, invoices: list) -> str:
+    """WhatsApp payment reminder for one customer; invoices carry invoice_number, due_date,
+    days_overdue and outstanding"""
+    if len(invoices) == 1:
+        invoice = invoices[0]
+        details = f"""📄 Invoice: {invoice['invoice_number']}
+💰 Amount Due: ₹{invoice['outstanding']:,.2f}
+📅 Due Date: {invoice['due_date'][:10]}
+⚠️ Days Overdue: {invoice['days_overdue']} days"""
+    else:
+        lines = "\n".join(
+            f"📄 {invoice['invoice_number']} - ₹{invoice['outstanding']:,.2f} "
+            f"(due {invoice['due_date'][:10]}, {invoice['days_overdue']} days overdue)"
+            for invoice in invoices
+        )
+        total = sum(invoice['outstanding'] for invoice in invoices)
+        details = f"""{lines}
+
+💰 Total Amount Due: ₹{total:,.2f}"""
+
+    return f"""🔔 Payment Reminder - Nectar
+
+Dear {customer_name},
+
+This is a friendly reminder regarding:
+
+{details}
+
+Please process the payment at your earliest convenience.
+
+For any queries, contact us.
+
+Thank you!"""
+
+
 @recovery_router.get("/recovery/stats")
 async def get_recovery_stats():
     """Get recovery dashboard statistics"""
@@ -293,52 +329,43 @@ async def send_payment_reminder(invoice_id: str):
         
         outstanding = invoice['total_amount'] - invoice.get('paid_amount', 0)
         
-        # Create reminder message
-        message = f"""🔔 Payment Reminder - Nectar
-
-Dear {invoice['customer_name']},
-
-This is a friendly reminder regarding:
-
-📄 Invoice: {invoice['invoice_number']}
-💰 Amount Due: ₹{outstanding:,.2f}
-📅 Due Date: {invoice['due_date'][:10]}
-⚠️ Days Overdue: {days_overdue} days
-
-Please process the payment at your earliest convenience.
-
-For any queries, contact us.
-
-Thank you!"""
+        message = build_reminder_message(invoice['customer_name'], [{
+            "invoice_number": invoice['invoice_number'],
+            "due_date": invoice['due_date'],
+            "days_overdue": days_overdue,
+            "outstanding": outstanding
+        }])
 
         # Send via WhatsApp
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "http://localhost:3001/send-message",
-                json={
-                    "phone_number": invoice['customer_phone'],
-                    "message": message
-                },
-                timeout=30.0
+        result = await whatsapp_request(
+            "POST",
+            "/send-message",
+            json={
+                "phone_number": invoice['customer_phone'],
+                "message": message
+            },
+            timeout=30.0
+        )
+        
+        if result.get('success'):
+            # Record follow-up
+            follow_up = FollowUpNote(
+                invoice_id=invoice_id,
+                invoice_number=invoice['invoice_number'],
+                follow_up_date=datetime.now(timezone.utc).isoformat(),
+                contact_method="whatsapp",
+                notes=f"Payment reminder sent via WhatsApp. Days overdue: {days_overdue}",
+                status="contacted",
+                recorded_by="System"
             )
+            await get_db().follow_ups.insert_one(follow_up.model_dump())
             
-            if response.json().get('success'):
-                # Record follow-up
-                follow_up = FollowUpNote(
-                    invoice_id=invoice_id,
-                    invoice_number=invoice['invoice_number'],
-                    follow_up_date=datetime.now(timezone.utc).isoformat(),
-                    contact_method="whatsapp",
-                    notes=f"Payment reminder sent via WhatsApp. Days overdue: {days_overdue}",
-                    status="contacted",
-                    recorded_by="System"
-                )
-                await get_db().follow_ups.insert_one(follow_up.model_dump())
-                
-                return {"success": True, "message": "Payment reminder sent via WhatsApp"}
-            else:
-                return {"success": False, "message": "Failed to send WhatsApp reminder"}
-                
+            return {"success": True, "message": "Payment reminder sent via WhatsApp"}
+        else:
+            return {"success": False, "message": "Failed to send WhatsApp reminder"}
+            
+    except WhatsAppUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -399,3 +426,202 @@ async def get_customer_summary():
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+async def find_reminder_targets(min_days_overdue: int, min_amount: float, customer_id: Optional[str],
+                                customer_name: Optional[str]) -> list:
+    """Overdue invoices matching the filters, grouped into one entry per customer (largest outstanding first)"""
+    today = datetime.now(timezone.utc)
+    match = {
+        "status": {"$ne": "cancelled"},
+        "payment_status": {"$in": ["unpaid", "partially_paid"]},
+        "due_date": {"$lte": (today - timedelta(days=max(min_days_overdue, 1))).isoformat()}
+    }
+    if customer_id:
+        match["customer_id"] = customer_id
+    if customer_name:
+        match["customer_name"] = {"$regex": customer_name, "$options": "i"}
+
+    customers = await get_db().invoices.aggregate([
+        {"$match": match},
+        {"$addFields": {"outstanding": {"$subtract": ["$total_amount", {"$ifNull": ["$paid_amount", 0]}]}}},
+        {"$match": {"outstanding": {"$gt": 0, "$gte": min_amount or 0}}},
+        {"$sort": {"due_date": 1}},
+        {"$group": {
+            "_id": {"$ifNull": ["$customer_id", "$customer_name"]},
+            "customer_name": {"$last": "$customer_name"},
+            "customer_phone": {"$last": "$customer_phone"},
+            "total_outstanding": {"$sum": "$outstanding"},
+            "invoices": {"$push": {
+                "id": "$id",
+                "invoice_number": "$invoice_number",
+                "due_date": "$due_date",
+                "outstanding": "$outstanding"
+            }}
+        }},
+        {"$sort": {"total_outstanding": -1}}
+    ]).to_list(None)
+
+    for customer in customers:
+        customer['customer_id'] = customer.pop('_id')
+        for invoice in customer['invoices']:
+            due_date = datetime.fromisoformat(invoice['due_date'].replace('Z', '+00:00'))
+            invoice['days_overdue'] = (today - due_date).days
+    return customers
+
+
+def campaign_row(customer: dict) -> dict:
+    """A campaign's result row for one customer; the invoices are kept to write follow-ups once the reminder is sent"""
+    return {
+        "customer_id": customer['customer_id'],
+        "customer_name": customer['customer_name'],
+        "customer_phone": customer.get('customer_phone') or "",
+        "invoice_count": len(customer['invoices']),
+        "total_outstanding": round(customer['total_outstanding'], 2),
+        "invoices": [
+            {"id": invoice['id'], "invoice_number": invoice['invoice_number'], "days_overdue": invoice['days_overdue']}
+            for invoice in customer['invoices']
+        ],
+        "job_id": None,
+        "status": "queued",
+        "error": None
+    }
+
+
+async def record_campaign_job(job: dict, status: str, error: Optional[str] = None):
+    """WhatsApp queue hook: mark the customer's campaign row sent or failed, write its follow-ups when sent,
+    and complete the campaign once every customer is done. Rows only move out of queued once."""
+    if not job.get('campaign_id'):
+        return
+    db = get_db()
+    result = await db.reminder_campaigns.update_one(
+        {"id": job['campaign_id'], "results": {"$elemMatch": {"job_id": job['id'], "status": "queued"}}},
+        {
+            "$set": {"results.$.status": status, "results.$.error": error,
+                     "updated_at": datetime.now(timezone.utc).isoformat()},
+            "$inc": {"processed_customers": 1, status: 1}
+        }
+    )
+    if not result.modified_count:
+        return
+    campaign = await db.reminder_campaigns.find_one({"id": job['campaign_id']}, {"_id": 0})
+
+    row = next(row for row in campaign['results'] if row['job_id'] == job['id'])
+    if status == "sent":
+        now = datetime.now(timezone.utc).isoformat()
+        follow_ups = [
+            FollowUpNote(
+                invoice_id=invoice['id'],
+                invoice_number=invoice['invoice_number'],
+                follow_up_date=now,
+                contact_method="whatsapp",
+                notes=f"Payment reminder sent via WhatsApp (campaign {campaign['id']}). Days overdue: {invoice['days_overdue']}",
+                status="contacted",
+                recorded_by="System"
+            ).model_dump()
+            for invoice in row['invoices']
+        ]
+        if follow_ups:
+            await db.follow_ups.insert_many(follow_ups)
+            await db.reminder_campaigns.update_one({"id": campaign['id']},
+                                                   {"$inc": {"follow_ups_recorded": len(follow_ups)}})
+
+    if campaign['processed_customers'] >= campaign['total_customers']:
+        await db.reminder_campaigns.update_one({"id": campaign['id'], "status": "running"}, {"$set": {
+            "status": "completed", "finished_at": datetime.now(timezone.utc).isoformat()
+        }})
+
+
+job_finished_hooks.append(record_campaign_job)
+
+
+async def ensure_reminder_campaigns():
+    """Index campaigns and close the ones an older in-process runner left running (they have no queued jobs)"""
+    db = get_db()
+    await db.reminder_campaigns.create_index("id", unique=True)
+    await db.reminder_campaigns.create_index("results.job_id")
+    await db.reminder_campaigns.update_many(
+        {"status": "running", "queued_jobs": {"$exists": False}},
+        {"$set": {"status": "interrupted", "finished_at": datetime.now(timezone.utc).isoformat()}}
+    )
+
+
+@recovery_router.post("/recovery/reminder-campaign")
+async def start_reminder_campaign(request: dict):
+    """Send one WhatsApp reminder per customer covering all their overdue invoices that match the filters.
+    Each reminder is a job on the WhatsApp queue, so its rate limits, retries and circuit breaker apply.
+    Body: min_days_overdue (default 1), min_amount (per invoice outstanding), customer_id, customer_name,
+    dry_run (only list the targets). Returns at once; follow progress at /recovery/reminder-campaign/{id}."""
+    try:
+        min_days_overdue = int(request.get('min_days_overdue') or 1)
+        min_amount = float(request.get('min_amount') or 0)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="min_days_overdue and min_amount must be numbers")
+
+    customers = await find_reminder_targets(min_days_overdue, min_amount,
+                                            request.get('customer_id'), request.get('customer_name'))
+    summary = {
+        "total_customers": len(customers),
+        "total_invoices": sum(len(customer['invoices']) for customer in customers),
+        "total_outstanding": round(sum(customer['total_outstanding'] for customer in customers), 2)
+    }
+    if request.get('dry_run'):
+        return {"dry_run": True, **summary, "customers": customers}
+    if not customers:
+        return {"campaign_id": None, "status": "completed", **summary, "message": "No overdue invoices match the filters"}
+
+    campaign_id = str(uuid4())
+    rows, jobs = [], []
+    for customer in customers:
+        row = campaign_row(customer)
+        if row['customer_phone']:
+            job = new_whatsapp_job("message", {
+                "phone_number": row['customer_phone'],
+                "message": build_reminder_message(customer['customer_name'], customer['invoices'])
+            }, campaign_id=campaign_id)
+            row['job_id'] = job['id']
+            jobs.append(job)
+        else:
+            row.update(status="skipped", error="No phone number")
+        rows.append(row)
+
+    now = datetime.now(timezone.utc).isoformat()
+    skipped = len(rows) - len(jobs)
+    campaign = {
+        "id": campaign_id,
+        "filters": {
+            "min_days_overdue": min_days_overdue,
+            "min_amount": min_amount,
+            "customer_id": request.get('customer_id'),
+            "customer_name": request.get('customer_name')
+        },
+        "status": "running" if jobs else "completed",
+        **summary,
+        "queued_jobs": len(jobs),
+        "processed_customers": skipped,
+        "sent": 0,
+        "failed": 0,
+        "skipped": skipped,
+        "follow_ups_recorded": 0,
+        "results": rows,
+        "started_at": now,
+        "updated_at": now,
+        "finished_at": None if jobs else now
+    }
+    # The campaign is saved before its jobs so no job can finish before its row exists
+    await get_db().reminder_campaigns.insert_one(dict(campaign))
+    await enqueue_whatsapp_jobs(jobs)
+
+    return {"campaign_id": campaign_id, "status": campaign['status'], **summary,
+            "queued_jobs": len(jobs), "skipped": skipped}
+
+
+@recovery_router.get("/recovery/reminder-campaign/{campaign_id}")
+async def get_reminder_campaign(campaign_id: str):
+    """Progress of a reminder campaign: processed/sent/failed/skipped counts and per-customer results"""
+    campaign = await get_db().reminder_campaigns.find_one({"id": campaign_id}, {"_id": 0})
+    if not campaign:
+        raise HTTPException(status_code=404, detail="Campaign not found")
+    total = campaign['total_customers']
+    campaign['progress_percent'] = round(campaign['processed_customers'] * 100 / total, 1) if total else 100.0
+    return campaign
@@ -1,24 +1,34 @@
-from fastapi import FastAPI, APIRouter, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Depends, Request, Response
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import StreamingResponse, JSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import InsertOne, UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import os
+import asyncio
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict
+from pydantic import BaseModel, Field, ConfigDict, ValidationError
 from typing import List, Optional
 from uuid import uuid4
 from datetime import datetime, timezone
 import io
-from openpyxl import Workbook
+import csv
+import tempfile
+from itertools import islice
+from contextlib import asynccontextmanager
+import numpy as np
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import letter, A4
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch
-from passlib.context import CryptContext
+from reportlab.pdfgen import canvas as pdf_canvas
 from jose import JWTError, jwt
 from datetime import timedelta
 
@@ -28,7 +38,29 @@ from reportlab.lib.enums import TA_CENTER, TA_RIGHT
 from whatsapp_routes import whatsapp_router
 
 # Import Recovery routes
-from recovery_routes import recovery_router
+from recovery_routes import recovery_router, ensure_reminder_campaigns
+
+# Import pooled WhatsApp service client and outbound queue
+from whatsapp_client import start_whatsapp_client, close_whatsapp_client, probe_whatsapp_service
+from whatsapp_queue import ensure_whatsapp_jobs, start_whatsapp_workers
+
+# Import inventory valuation engine
+from valuation import new_item_state, value_movements, VALUATION_METHODS, WEIGHTED_AVERAGE
+
+# Import MRP netting
+from mrp import ArrayIndex, sum_by_index, net_requirements
+
+# Import multi-level BOM explosion
+from bom import BOM_ITEM_TYPES, sub_assembly_ids, find_bom_cycle, flatten_bom
+
+# Import password hashing (runs off the event loop)
+from passwords import verify_password_async, hash_password_async, hash_passwords_bulk, shutdown_password_pools
+
+# Import in-process TTL cache
+from ttl_cache import TTLCache
+
+# Import GST tax engine
+from tax import compute_tax_batch, compute_document_tax, document_totals, to_rupee_lists, group_line_tax
 
 
 ROOT_DIR = Path(__file__).parent
@@ -39,6 +71,12 @@ mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
+# Inventory valuation: weighted_average or fifo
+INVENTORY_VALUATION_METHOD = os.environ.get('INVENTORY_VALUATION_METHOD', WEIGHTED_AVERAGE)
+if INVENTORY_VALUATION_METHOD not in VALUATION_METHODS:
+    raise ValueError(f"INVENTORY_VALUATION_METHOD must be one of {VALUATION_METHODS}")
+VALUATION_RETRIES = 5
+
 # Create the main app without a prefix
 app = FastAPI()
 
@@ -256,6 +294,19 @@ class InvoiceItem(BaseModel):
     discount_percent: float = 0.0
     gst_rate: float = 0.0
 
+class HsnTaxLine(BaseModel):
+    """An invoice's tax grouped by HSN code, GST rate and unit, kept for GST returns"""
+    hsn_code: str = ""
+    gst_rate: float = 0.0
+    unit: str = ""
+    quantity: float = 0.0
+    taxable_amount: float = 0.0
+    cgst_amount: float = 0.0
+    sgst_amount: float = 0.0
+    igst_amount: float = 0.0
+    total_gst: float = 0.0
+    total_value: float = 0.0
+
 class Invoice(BaseModel):
     model_config = ConfigDict(extra="ignore")
     
@@ -286,6 +337,8 @@ class Invoice(BaseModel):
     grand_total: float
     payment_status: str = "unpaid"  # unpaid, partial, paid
     stock_updated: bool = False
+    cost_of_goods_sold: float = 0.0  # From the inventory valuation engine at the time of sale
+    hsn_summary: List[HsnTaxLine] = []
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class InvoiceCreate(BaseModel):
@@ -626,7 +679,7 @@ class PurchaseInvoiceCreate(BaseModel):
 
 # BOM (Bill of Materials) Models
 class BOMMaterial(BaseModel):
-    material_type: str  # 'raw' or 'packing'
+    material_type: str  # 'raw', 'packing' or 'product' (sub-assembly with its own BOM)
     material_id: str
     material_name: str
     quantity: float
@@ -656,7 +709,7 @@ class BOMUpdate(BaseModel):
 
 # Production Order Models
 class ProductionOrderMaterial(BaseModel):
-    material_type: str  # 'raw' or 'packing'
+    material_type: str  # 'raw', 'packing' or 'product'
     material_id: str
     material_name: str
     required_quantity: float
@@ -902,9 +955,6 @@ class Token(BaseModel):
     token_type: str
     user: dict
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 
 # ========== USER & ROLE MANAGEMENT MODELS ==========
 
@@ -1320,12 +1370,6 @@ SECRET_KEY = "your-secret-key-change-this-in-production-2024"  # Change this in
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 1440  # 24 hours
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
-
-def get_password_hash(password):
-    return pwd_context.hash(password)
-
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -1337,27 +1381,222 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
+# Users (and their roles) resolved from tokens are cached briefly, so authenticated routes don't
+# query per request. Every user or role write through this process drops the affected entries;
+# other workers pick changes up within the TTL. get_current_auth is the dependency for routes that
+# require a login (require_permission builds on it); /auth/me shares the cache.
+AUTH_CACHE_TTL_SECONDS = float(os.environ.get('AUTH_CACHE_TTL_SECONDS', '30'))
+AUTH_CACHE_SIZE = int(os.environ.get('AUTH_CACHE_SIZE', '1024'))
+auth_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL_SECONDS)
+# Bumped by every invalidation, so a lookup that raced a write doesn't cache what it read before it
+auth_cache_generation = 0
+bearer_scheme = HTTPBearer(auto_error=False)
+
+
+def decode_access_token(token: str) -> str:
+    """Username (sub) of a valid, unexpired token; 401 otherwise"""
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    username = payload.get("sub")
+    if username is None:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return username
+
+
+async def load_auth_context(username: str) -> Optional[dict]:
+    """{"user", "role"} for a username - from the cache, or users/roles on a miss; None if there is no such user.
+    role is the user's Role document (None without a role_id). Shared with the cache: read only."""
+    context = auth_cache.get(username)
+    if context is None:
+        generation = auth_cache_generation
+        user = await db.users.find_one({"username": username}, {"_id": 0, "hashed_password": 0})
+        if user is None:
+            return None
+        role = None
+        if user.get('role_id'):
+            role = await db.roles.find_one({"id": user['role_id']}, {"_id": 0})
+        context = {"user": user, "role": role}
+        if generation == auth_cache_generation:
+            auth_cache.set(username, context)
+    return context
+
+
+def request_token(credentials: Optional[HTTPAuthorizationCredentials], token: Optional[str]) -> str:
+    """The bearer token, or the token query parameter; 401 without either"""
+    raw_token = credentials.credentials if credentials else token
+    if not raw_token:
+        raise HTTPException(status_code=401, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+    return raw_token
+
+
+async def get_current_auth(credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer_scheme),
+                           token: Optional[str] = None) -> dict:
+    """Dependency for authenticated routes: the bearer token (or a token query parameter) resolved to
+    {"user", "role"}. Use as auth: dict = Depends(get_current_auth)."""
+    context = await load_auth_context(decode_access_token(request_token(credentials, token)))
+    if context is None:
+        raise HTTPException(status_code=401, detail="User not found")
+    if not context['user'].get('is_active', True):
+        raise HTTPException(status_code=401, detail="User account is disabled")
+    return context
+
+
+def invalidate_auth_cache(predicate):
+    global auth_cache_generation
+    auth_cache_generation += 1
+    auth_cache.pop_where(predicate)
+
+
+def invalidate_auth_user(user_id: str = None, username: str = None):
+    """Drop the cached context of a user, by id or username, after any write to it"""
+    invalidate_auth_cache(lambda context: context['user'].get('id') == user_id
+                          or context['user'].get('username') == username)
+
+
+def invalidate_auth_role(role_id: str):
+    invalidate_auth_cache(lambda context: context['user'].get('role_id') == role_id)
+
+
+# Role permissions compiled for constant-time checks: role_id -> {"modules": frozenset of modules,
+# "pages": frozenset of (module, page)}. Replaced whole on every change, never mutated.
+role_permissions = {}
+
+
+def compile_role_permissions(role: dict) -> dict:
+    permissions = role.get('permissions') or []
+    return {
+        "modules": frozenset(permission['module'] for permission in permissions),
+        "pages": frozenset((permission['module'], page) for permission in permissions
+                           for page in permission.get('pages', []))
+    }
+
+
+async def load_role_permissions():
+    global role_permissions
+    role_permissions = {
+        role['id']: compile_role_permissions(role)
+        async for role in db.roles.find({}, {"_id": 0, "id": 1, "permissions": 1})
+    }
+
+
+async def refresh_role_permissions(role_id: str):
+    """Recompile one role after it was saved or deleted"""
+    global role_permissions
+    role = await db.roles.find_one({"id": role_id}, {"_id": 0, "id": 1, "permissions": 1})
+    compiled = dict(role_permissions)
+    if role:
+        compiled[role_id] = compile_role_permissions(role)
+    else:
+        compiled.pop(role_id, None)
+    role_permissions = compiled
+
+
+async def watch_role_permissions():
+    """Pick up role changes saved by other workers: change stream on replica sets, otherwise a
+    full reload every AUTH_CACHE_TTL_SECONDS (roles are few)"""
+    while True:
+        try:
+            if await supports_transactions():
+                async with db.roles.watch() as stream:
+                    await load_role_permissions()
+                    async for _ in stream:
+                        await load_role_permissions()
+            else:
+                await asyncio.sleep(AUTH_CACHE_TTL_SECONDS)
+                await load_role_permissions()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Role permissions watch failed, retrying: {e}")
+            await asyncio.sleep(AUTH_CACHE_TTL_SECONDS)
+
+
+def has_permission(user: dict, module: str, page: Optional[str] = None) -> bool:
+    """Whether the user's role grants the module (any page) or the given page of it. Admins have everything."""
+    if user.get('role') == "admin":
+        return True
+    compiled = role_permissions.get(user.get('role_id'))
+    if compiled is None:
+        return False
+    if page is None:
+        return module in compiled['modules']
+    return (module, page) in compiled['pages']
+
+
+def require_permission(module: str, page: Optional[str] = None):
+    """Dependency for routes restricted to a module or page, e.g.
+    dependencies=[Depends(require_permission("sales", "/invoices"))]. Returns the auth context."""
+    async def check_permission(auth: dict = Depends(get_current_auth)) -> dict:
+        if not has_permission(auth['user'], module, page):
+            raise HTTPException(status_code=403, detail="You do not have permission to access this resource")
+        return auth
+    return check_permission
+
+
 
 # ========== HELPER FUNCTIONS ==========
 
 async def generate_invoice_number():
     """Generate invoice number in format INV-YYYYMMDD-XXXX"""
-    today = datetime.now(timezone.utc)
-    date_str = today.strftime("%Y%m%d")
-    
-    # Find the last invoice for today
+    return (await generate_invoice_numbers(1))[0]
+
+
+async def generate_invoice_numbers(count: int) -> list:
+    """Allocate a block of consecutive invoice numbers in format INV-YYYYMMDD-XXXX.
+    The block is reserved by one $inc on the day's counter, so concurrent callers never share a number
+    (a number whose invoice then fails to save is skipped, not reused)."""
+    date_str = datetime.now(timezone.utc).strftime("%Y%m%d")
+    counter = await db.counters.find_one_and_update(
+        {"_id": f"invoice:{date_str}"},
+        {"$inc": {"seq": count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    last_num = counter['seq']
+    return [f"INV-{date_str}-{num:04d}" for num in range(last_num - count + 1, last_num + 1)]
+
+
+async def ensure_invoice_numbering():
+    """Make invoice numbers unique and start today's counter after invoices numbered before it existed"""
+    date_str = datetime.now(timezone.utc).strftime("%Y%m%d")
     last_invoice = await db.invoices.find_one(
-        {"invoice_number": {"$regex": f"^INV-{date_str}"}},
+        {"invoice_number": {"$regex": f"^INV-{date_str}-"}},
         sort=[("invoice_number", -1)]
     )
-    
     if last_invoice:
-        last_num = int(last_invoice["invoice_number"].split("-")[-1])
-        new_num = last_num + 1
-    else:
-        new_num = 1
+        await db.counters.update_one(
+            {"_id": f"invoice:{date_str}"},
+            {"$max": {"seq": int(last_invoice["invoice_number"].split("-")[-1])}},
+            upsert=True
+        )
+    await ensure_unique_index("invoices", "invoice_number")
+
+
+async def ensure_unique_index(collection_name: str, field: str) -> bool:
+    """Create a unique index on field unless existing documents already repeat a value; then log the
+    repeated values and keep a plain index until they are cleaned up. Returns whether it is unique."""
+    collection = db[collection_name]
+    duplicates = await collection.aggregate([
+        {"$group": {"_id": f"${field}", "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+        {"$limit": 10}
+    ]).to_list(10)
+    if duplicates:
+        logger.error(
+            f"{collection_name}.{field} has repeated values, fix them so it can be indexed unique: "
+            + ", ".join(str(d['_id']) for d in duplicates)
+        )
+        await collection.create_index(field)
+        return False
     
-    return f"INV-{date_str}-{new_num:04d}"
+    # An index on the field from before it was unique has the same name; replace it
+    existing = (await collection.index_information()).get(f"{field}_1")
+    if existing and not existing.get('unique'):
+        await collection.drop_index(f"{field}_1")
+    await collection.create_index(field, unique=True)
+    return True
 
 
 async def generate_po_number():
@@ -1398,40 +1637,557 @@ async def generate_purchase_invoice_number():
     return f"PINV-{date_str}-{new_num:04d}"
 
 
-async def update_stock_on_purchase(items):
+# ========== STOCK MOVEMENT JOURNAL ==========
+
+# item_type -> collection holding its stock_quantity
+STOCK_COLLECTIONS = {
+    "product": "products",
+    "raw_material": "raw_materials",
+    "packing_material": "packing_materials"
+}
+
+# BOM / production orders use the short material names
+MATERIAL_ITEM_TYPES = {"raw": "raw_material", "packing": "packing_material"}
+
+
+def stock_movement(item_type: str, item_id: str, quantity: float, source_type: str,
+                   source_id: str = "", source_number: str = "", item_name: str = "",
+                   unit_cost: Optional[float] = None, occurred_at=None) -> dict:
+    """Build one append-only stock_movements row. quantity is signed: + in, - out.
+    unit_cost is only given for receipts with a known cost; valuation fills in the rest.
+    occurred_at is the source document's date (datetime or ISO string); month and created_at
+    follow it so backdated documents land in their own month. posted_at is when it was journaled."""
+    now = datetime.now(timezone.utc)
+    if occurred_at is None:
+        occurred_at = now
+    elif isinstance(occurred_at, str):
+        occurred_at = datetime.fromisoformat(occurred_at)
+    if occurred_at.tzinfo is None:
+        occurred_at = occurred_at.replace(tzinfo=timezone.utc)
+    # Stored in UTC so created_at compares as a string against the as-of cutoff
+    occurred_at = occurred_at.astimezone(timezone.utc)
+    return {
+        "id": str(uuid4()),
+        "item_type": item_type,
+        "item_id": item_id,
+        "item_name": item_name,
+        "quantity": quantity,
+        "source_type": source_type,  # sales_invoice, invoice_cancel, purchase_invoice, credit_note, ...
+        "source_id": source_id,
+        "source_number": source_number,
+        "unit_cost": unit_cost,
+        "value": 0.0,
+        "month": occurred_at.strftime("%Y-%m"),
+        "created_at": occurred_at.isoformat(),
+        "posted_at": now.isoformat()
+    }
+
+
+async def journal_stock_movements(movements: list, session=None):
+    """Append movements and fold them into the per-item monthly snapshots.
+    Callers that already changed stock_quantity themselves (conditional updates) use this directly."""
+    movements = [m for m in movements if m['quantity']]
+    if not movements:
+        return
+    await value_stock_movements(movements, session=session)
+    await db.stock_movements.insert_many([dict(m) for m in movements], ordered=True, session=session)
+    
+    snapshot_totals = {}
+    for movement in movements:
+        key = (movement['item_type'], movement['item_id'], movement['month'])
+        net, count, _ = snapshot_totals.get(key, (0, 0, ""))
+        snapshot_totals[key] = (net + movement['quantity'], count + 1, movement['item_name'])
+    await db.stock_snapshots.bulk_write([
+        UpdateOne(
+            {"item_type": item_type, "item_id": item_id, "month": month},
+            {"$inc": {"net_quantity": net, "movement_count": count}, "$set": {"item_name": name}},
+            upsert=True
+        )
+        for (item_type, item_id, month), (net, count, name) in snapshot_totals.items()
+    ], ordered=False, session=session)
+    await refresh_reorder_items({(m['item_type'], m['item_id']) for m in movements}, session=session)
+
+
+async def apply_stock_movements(movements: list, session=None):
+    """Apply signed stock changes with one bulk_write per collection and journal them.
+    Pass the caller's transaction session so the stock change and its journal rows commit together."""
+    per_collection = {}
+    for movement in movements:
+        items = per_collection.setdefault(STOCK_COLLECTIONS[movement['item_type']], {})
+        items[movement['item_id']] = items.get(movement['item_id'], 0) + movement['quantity']
+    
+    for collection_name, items in per_collection.items():
+        operations = [
+            UpdateOne({"id": item_id}, {"$inc": {"stock_quantity": quantity}})
+            for item_id, quantity in items.items() if quantity
+        ]
+        if operations:
+            await db[collection_name].bulk_write(operations, ordered=False, session=session)
+    
+    await journal_stock_movements(movements, session=session)
+
+
+async def journal_stock_adjustment(item_type: str, before: dict, new_quantity: Optional[float]):
+    """Journal a manual stock_quantity edit made through the master data routes"""
+    if before is None or new_quantity is None:
+        return
+    delta = new_quantity - before.get('stock_quantity', 0)
+    await journal_stock_movements([
+        stock_movement(item_type, before['id'], delta, "adjustment", item_name=before.get('name', ''))
+    ])
+
+
+async def ensure_stock_journal():
+    """Create journal indexes and give every item that predates the journal an opening balance row"""
+    await db.stock_movements.create_index([("item_type", 1), ("item_id", 1), ("created_at", 1)])
+    await db.stock_movements.create_index([("source_type", 1), ("source_id", 1)])
+    await db.stock_movements.create_index("created_at")
+    await db.stock_snapshots.create_index([("item_type", 1), ("item_id", 1), ("month", 1)], unique=True)
+    await db.stock_snapshots.create_index([("item_type", 1), ("month", 1)])
+    
+    # Backfilled openings describe stock as it stood when the journal began, not at deploy time
+    earliest = await db.stock_movements.find_one({}, {"_id": 0, "created_at": 1}, sort=[("created_at", 1)])
+    opened_at = earliest['created_at'] if earliest else None
+    standard_costs = await load_standard_costs()
+    for item_type, collection_name in STOCK_COLLECTIONS.items():
+        journaled = set(await db.stock_snapshots.distinct("item_id", {"item_type": item_type}))
+        openings = []
+        async for item in db[collection_name].find({}, {"_id": 0}):
+            if item['id'] not in journaled and item.get('stock_quantity'):
+                openings.append(stock_movement(
+                    item_type, item['id'], item['stock_quantity'], "opening_balance",
+                    item_name=item.get('name', ''), unit_cost=opening_unit_cost(item, standard_costs),
+                    occurred_at=opened_at
+                ))
+        await journal_stock_movements(openings)
+
+
+async def load_valuation_states(keys, session=None) -> dict:
+    states = {}
+    async for state in db.inventory_valuation.find({"key": {"$in": list(keys)}}, {"_id": 0}, session=session):
+        states[state['key']] = state
+    return states
+
+
+def valuation_update(state: dict, version: int) -> UpdateOne:
+    """Conditional write of a valuation state; version 0 means the item has no state yet"""
+    fields = {k: v for k, v in state.items() if k != 'version'}
+    return UpdateOne(
+        {"key": state['key'], "version": version},
+        {"$set": {**fields, "version": version + 1}},
+        upsert=version == 0
+    )
+
+
+async def value_stock_movements(movements: list, session=None):
+    """Run movements through the valuation engine, setting unit_cost/value on each one.
+    Item states are written with a version precondition; the per-type totals move by $inc,
+    so reading the inventory value never needs a scan."""
+    by_item = {}
+    for movement in movements:
+        by_item.setdefault(f"{movement['item_type']}:{movement['item_id']}", []).append(movement)
+    # Production output is costed from what the same order consumed, so value it last
+    is_output = lambda key: any(m['source_type'] == "production_output" for m in by_item[key])
+    phases = [[key for key in by_item if not is_output(key)], [key for key in by_item if is_output(key)]]
+    consumed_cost = {}
+    type_deltas = {}
+    
+    def post(key, state):
+        """Value one item's movements on copies; nothing is kept until its write succeeds"""
+        moves = [dict(m) for m in by_item[key]]
+        if state is None:
+            state = new_item_state(moves[0]['item_type'], moves[0]['item_id'], moves[0]['item_name'])
+        version = state.get('version', 0)
+        consumed = dict(consumed_cost)
+        delta = value_movements(state, moves, INVENTORY_VALUATION_METHOD, consumed)
+        return state, version, delta, moves, consumed
+    
+    def keep(key, state, delta, moves, consumed):
+        for movement, valued in zip(by_item[key], moves):
+            movement.update(valued)
+        consumed_cost.update(consumed)
+        type_deltas[state['item_type']] = type_deltas.get(state['item_type'], 0.0) + delta
+    
+    for keys in phases:
+        if not keys:
+            continue
+        if session is not None:
+            # Inside a transaction a concurrent writer surfaces as a retried write conflict
+            states = await load_valuation_states(keys, session=session)
+            operations = []
+            for key in keys:
+                state, version, delta, moves, consumed = post(key, states.get(key))
+                operations.append(valuation_update(state, version))
+                keep(key, state, delta, moves, consumed)
+            result = await db.inventory_valuation.bulk_write(operations, ordered=False, session=session)
+            if result.matched_count + result.upserted_count != len(operations):
+                raise HTTPException(status_code=409, detail="Inventory valuation changed concurrently, please retry")
+        else:
+            # No transaction: optimistic per-item retry on version conflicts
+            for key in keys:
+                for _ in range(VALUATION_RETRIES):
+                    state = (await load_valuation_states([key])).get(key)
+                    state, version, delta, moves, consumed = post(key, state)
+                    try:
+                        result = await db.inventory_valuation.bulk_write([valuation_update(state, version)])
+                    except BulkWriteError:
+                        continue  # lost an upsert race on the unique key
+                    if result.matched_count + result.upserted_count == 1:
+                        keep(key, state, delta, moves, consumed)
+                        break
+                else:
+                    raise HTTPException(status_code=409, detail="Inventory valuation changed concurrently, please retry")
+    
+    total_updates = [
+        UpdateOne({"item_type": item_type}, {"$inc": {"value": delta}}, upsert=True)
+        for item_type, delta in type_deltas.items() if delta
+    ]
+    if total_updates:
+        await db.inventory_valuation_totals.bulk_write(total_updates, ordered=False, session=session)
+
+
+async def get_inventory_value() -> dict:
+    """Current inventory value per item type, read from the running totals"""
+    totals = {item_type: 0.0 for item_type in STOCK_COLLECTIONS}
+    async for total in db.inventory_valuation_totals.find({}, {"_id": 0}):
+        totals[total['item_type']] = total.get('value', 0.0)
+    return totals
+
+
+def opening_unit_cost(item: dict, standard_costs: dict = None) -> float:
+    """Best known cost for stock that predates valuation: materials carry purchase_price; products
+    use their BOM standard cost (average supplier quotes), never the selling price, and come in at
+    zero without a BOM until production output values them"""
+    if 'purchase_price' in item:
+        return item['purchase_price'] or 0.0
+    return (standard_costs or {}).get(item.get('id'), 0.0)
+
+
+async def load_standard_costs() -> dict:
+    """product_id -> average-quote BOM cost from the product cost rollup"""
+    return {
+        cost['product_id']: cost.get('average_cost', 0.0)
+        async for cost in db.product_costs.find({}, {"_id": 0, "product_id": 1, "average_cost": 1})
+    }
+
+
+async def ensure_inventory_valuation():
+    """Index the valuation collections, seed items that have never been valued
+    and rebuild the running totals from the item states"""
+    await db.inventory_valuation.create_index("key", unique=True)
+    await db.inventory_valuation.create_index([("item_type", 1), ("value", -1)])
+    await db.inventory_valuation_totals.create_index("item_type", unique=True)
+    
+    standard_costs = await load_standard_costs()
+    for item_type, collection_name in STOCK_COLLECTIONS.items():
+        valued = set(await db.inventory_valuation.distinct("item_id", {"item_type": item_type}))
+        seeds = []
+        async for item in db[collection_name].find({}, {"_id": 0}):
+            if item['id'] in valued or not item.get('stock_quantity'):
+                continue
+            state = new_item_state(item_type, item['id'], item.get('name', ''))
+            value_movements(state, [{
+                "quantity": item['stock_quantity'], "unit_cost": opening_unit_cost(item, standard_costs),
+                "source_type": "opening_balance"
+            }], INVENTORY_VALUATION_METHOD)
+            seeds.append(valuation_update(state, 0))
+        if seeds:
+            await db.inventory_valuation.bulk_write(seeds, ordered=False)
+    
+    pipeline = [{"$group": {"_id": "$item_type", "value": {"$sum": "$value"}}}]
+    totals = await db.inventory_valuation.aggregate(pipeline).to_list(length=None)
+    await db.inventory_valuation_totals.delete_many({})
+    if totals:
+        await db.inventory_valuation_totals.insert_many([
+            {"item_type": total['_id'], "value": total['value']} for total in totals
+        ])
+
+
+async def get_cheapest_supplier_prices(material_ids: list, session=None) -> dict:
+    """Lowest supplier price per material_id, with that supplier's lead time and MOQ"""
+    pipeline = [
+        {"$match": {"material_id": {"$in": material_ids}}},
+        {"$sort": {"material_id": 1, "price": 1}},
+        {"$group": {
+            "_id": "$material_id",
+            "supplier_id": {"$first": "$supplier_id"},
+            "supplier_name": {"$first": "$supplier_name"},
+            "price": {"$first": "$price"},
+            "lead_time_days": {"$first": "$lead_time_days"},
+            "minimum_order_qty": {"$first": "$minimum_order_qty"}
+        }}
+    ]
+    cheapest = {}
+    async for row in db.supplier_prices.aggregate(pipeline, session=session):
+        cheapest[row['_id']] = row
+    return cheapest
+
+
+async def record_supplier_price(supplier_price: dict, price: float, recorded_at: str):
+    """Append a price point to the supplier-material bucket for its month,
+    keeping the bucket's count/sum/min/max current so stats never read the points"""
+    await db.supplier_price_history.update_one(
+        {
+            "supplier_id": supplier_price['supplier_id'],
+            "material_id": supplier_price['material_id'],
+            "month": recorded_at[:7]
+        },
+        {
+            "$push": {"points": {"price": price, "recorded_at": recorded_at}},
+            "$inc": {"count": 1, "sum": price},
+            "$min": {"min": price},
+            "$max": {"max": price},
+            "$set": {
+                "supplier_name": supplier_price.get('supplier_name', ''),
+                "material_name": supplier_price.get('material_name', ''),
+                "material_type": supplier_price.get('material_type', ''),
+                "last": price
+            },
+            "$setOnInsert": {"first": price}
+        },
+        upsert=True
+    )
+
+
+async def ensure_supplier_price_history():
+    """Index the price history buckets and seed one point for prices recorded before history was kept"""
+    await db.supplier_price_history.create_index([("material_id", 1), ("month", 1)])
+    await db.supplier_price_history.create_index([("supplier_id", 1), ("material_id", 1), ("month", 1)], unique=True)
+    
+    tracked = {
+        (row['_id']['supplier_id'], row['_id']['material_id'])
+        async for row in db.supplier_price_history.aggregate([
+            {"$group": {"_id": {"supplier_id": "$supplier_id", "material_id": "$material_id"}}}
+        ])
+    }
+    async for supplier_price in db.supplier_prices.find({}, {"_id": 0}):
+        if (supplier_price['supplier_id'], supplier_price['material_id']) not in tracked:
+            recorded_at = supplier_price.get('updated_at') or datetime.now(timezone.utc).isoformat()
+            await record_supplier_price(supplier_price, supplier_price['price'], recorded_at)
+
+
+async def refresh_reorder_items(keys, session=None):
+    """Bring the reorder list in line with the current stock of the given (item_type, item_id) pairs.
+    Items below min_stock_level are upserted with their shortfall and cheapest supplier; the rest are removed."""
+    per_type = {}
+    for item_type, item_id in keys:
+        per_type.setdefault(item_type, set()).add(item_id)
+    
+    now = datetime.now(timezone.utc).isoformat()
+    upserts = []
+    cleared = []
+    for item_type, item_ids in per_type.items():
+        items = await db[STOCK_COLLECTIONS[item_type]].find(
+            {"id": {"$in": list(item_ids)}},
+            {"_id": 0, "id": 1, "name": 1, "unit": 1, "stock_quantity": 1, "min_stock_level": 1},
+            session=session
+        ).to_list(length=None)
+        below = {
+            item['id']: item for item in items
+            if item.get('stock_quantity', 0) < (item.get('min_stock_level') or 0)
+        }
+        cleared.extend(f"{item_type}:{item_id}" for item_id in item_ids if item_id not in below)
+        if not below:
+            continue
+        
+        cheapest = {}
+        if item_type != "product":
+            cheapest = await get_cheapest_supplier_prices(list(below), session=session)
+        
+        for item_id, item in below.items():
+            shortfall = item['min_stock_level'] - item.get('stock_quantity', 0)
+            supplier = cheapest.get(item_id, {})
+            upserts.append(UpdateOne({"key": f"{item_type}:{item_id}"}, {"$set": {
+                "item_type": item_type,
+                "item_id": item_id,
+                "item_name": item.get('name', ''),
+                "unit": item.get('unit', ''),
+                "stock_quantity": item.get('stock_quantity', 0),
+                "min_stock_level": item['min_stock_level'],
+                "shortfall": shortfall,
+                "suggested_order_qty": max(shortfall, supplier.get('minimum_order_qty') or 0),
+                "cheapest_supplier_id": supplier.get('supplier_id'),
+                "cheapest_supplier_name": supplier.get('supplier_name'),
+                "cheapest_price": supplier.get('price'),
+                "lead_time_days": supplier.get('lead_time_days'),
+                "updated_at": now
+            }}, upsert=True))
+    
+    if upserts:
+        await db.reorder_list.bulk_write(upserts, ordered=False, session=session)
+    if cleared:
+        await db.reorder_list.delete_many({"key": {"$in": cleared}}, session=session)
+
+
+async def ensure_reorder_list():
+    """Index the reorder list and rebuild it once from every stocked item"""
+    await db.reorder_list.create_index("key", unique=True)
+    await db.reorder_list.create_index([("shortfall", -1)])
+    await db.reorder_list.create_index([("item_type", 1), ("shortfall", -1)])
+    await db.supplier_prices.create_index([("material_id", 1), ("price", 1)])
+    
+    await db.reorder_list.delete_many({})
+    for item_type, collection_name in STOCK_COLLECTIONS.items():
+        item_ids = await db[collection_name].distinct("id", {"min_stock_level": {"$gt": 0}})
+        for start in range(0, len(item_ids), DAYBOOK_BATCH_SIZE):
+            await refresh_reorder_items([(item_type, item_id) for item_id in item_ids[start:start + DAYBOOK_BATCH_SIZE]])
+
+
+async def update_stock_on_purchase(items, source_id: str = "", source_number: str = "", session=None,
+                                   occurred_at=None):
     """Update stock when purchase invoice is created"""
-    for item in items:
-        if item.item_type == "raw_material":
-            await db.raw_materials.update_one(
-                {"id": item.item_id},
-                {"$inc": {"stock_quantity": item.quantity}}
-            )
-        elif item.item_type == "packing_material":
-            await db.packing_materials.update_one(
-                {"id": item.item_id},
-                {"$inc": {"stock_quantity": item.quantity}}
-            )
+    await apply_stock_movements([
+        stock_movement(item.item_type, item.item_id, item.quantity, "purchase_invoice",
+                       source_id, source_number, item.item_name,
+                       unit_cost=item.price * (1 - item.discount_percent / 100), occurred_at=occurred_at)
+        for item in items if item.item_type in ("raw_material", "packing_material")
+    ], session=session)
+
+
+# Cached result of the replica-set check; standalone servers can't run transactions
+transactions_supported = None
+
+
+async def supports_transactions() -> bool:
+    """Multi-document transactions need a replica set or mongos"""
+    global transactions_supported
+    if transactions_supported is None:
+        try:
+            hello = await client.admin.command("hello")
+            transactions_supported = bool(hello.get("setName")) or hello.get("msg") == "isdbgrid"
+        except Exception:
+            transactions_supported = False
+    return transactions_supported
+
 
+async def run_transaction(callback):
+    """Run callback(session) inside a transaction, retrying transient errors.
+    On a standalone server the callback gets session=None and must compensate itself."""
+    if not await supports_transactions():
+        return await callback(None)
+    async with await client.start_session() as session:
+        return await session.with_transaction(callback)
 
-async def update_stock_on_sale(items):
-    """Deduct stock when sales invoice is created"""
+
+def sum_quantities_by_product(items) -> dict:
+    """Total quantity per product_id, so repeated lines become one stock update"""
+    totals = {}
     for item in items:
-        # Check if enough stock available
-        product = await db.products.find_one({"id": item.product_id})
-        if not product:
-            raise HTTPException(status_code=404, detail=f"Product {item.product_name} not found")
-        
-        if product.get('stock_quantity', 0) < item.quantity:
-            raise HTTPException(
-                status_code=400, 
-                detail=f"Insufficient stock for {item.product_name}. Available: {product.get('stock_quantity', 0)}, Required: {item.quantity}"
+        totals[item.product_id] = totals.get(item.product_id, 0) + item.quantity
+    return totals
+
+
+async def get_stock_shortages(items, session=None) -> list:
+    """Report every line whose product is missing or short, with one $in lookup"""
+    totals = sum_quantities_by_product(items)
+    products = await db.products.find(
+        {"id": {"$in": list(totals.keys())}},
+        {"_id": 0, "id": 1, "stock_quantity": 1},
+        session=session
+    ).to_list(length=None)
+    available = {product['id']: product.get('stock_quantity', 0) for product in products}
+    return find_stock_shortages(items, available)
+
+
+def find_stock_shortages(items, available: dict) -> list:
+    """Lines whose product is missing from available (product_id -> stock) or short of the total asked for"""
+    totals = sum_quantities_by_product(items)
+    shortages = []
+    for line_no, item in enumerate(items, start=1):
+        if item.product_id not in available:
+            shortages.append({
+                "line": line_no,
+                "product_id": item.product_id,
+                "product_name": item.product_name,
+                "required": item.quantity,
+                "available": 0,
+                "error": f"Product {item.product_name} not found"
+            })
+        elif available[item.product_id] < totals[item.product_id]:
+            shortages.append({
+                "line": line_no,
+                "product_id": item.product_id,
+                "product_name": item.product_name,
+                "required": item.quantity,
+                "available": available[item.product_id],
+                "error": f"Insufficient stock for {item.product_name}. Available: {available[item.product_id]}, Required: {totals[item.product_id]}"
+            })
+    return shortages
+
+
+async def deduct_product_stock(totals: dict, session=None) -> bool:
+    """Take product_id -> quantity out of stock only where enough is left; False if any product fell short.
+    Inside a transaction this is one bulk_write, and the caller raises to abort the updates that matched.
+    Without one, products are deducted one at a time and put back on failure."""
+    if session is not None:
+        result = await db.products.bulk_write([
+            UpdateOne(
+                {"id": product_id, "stock_quantity": {"$gte": quantity}},
+                {"$inc": {"stock_quantity": -quantity}}
             )
-        
-        # Deduct stock
-        await db.products.update_one(
-            {"id": item.product_id},
-            {"$inc": {"stock_quantity": -item.quantity}}
+            for product_id, quantity in totals.items()
+        ], ordered=False, session=session)
+        return result.matched_count == len(totals)
+    
+    deducted = {}
+    for product_id, quantity in totals.items():
+        result = await db.products.update_one(
+            {"id": product_id, "stock_quantity": {"$gte": quantity}},
+            {"$inc": {"stock_quantity": -quantity}}
         )
+        if result.matched_count == 0:
+            break
+        deducted[product_id] = quantity
+    else:
+        return True
+    await restore_product_stock(deducted)
+    return False
+
+
+async def restore_product_stock(totals: dict):
+    """Put back product_id -> quantity taken by deduct_product_stock outside a transaction"""
+    if totals:
+        await db.products.bulk_write([
+            UpdateOne({"id": product_id}, {"$inc": {"stock_quantity": quantity}})
+            for product_id, quantity in totals.items()
+        ], ordered=False)
+
+
+async def update_stock_on_sale(items, session=None, source_id: str = "", source_number: str = "",
+                              occurred_at=None):
+    """Deduct stock when sales invoice is created.
+    Each product gets one conditional $inc that only matches while enough stock is left,
+    so concurrent invoices can't drive stock negative. Raises 400 with per-line shortages.
+    Returns the cost of goods sold from the valuation engine."""
+    totals = sum_quantities_by_product(items)
+    if not totals:
+        return 0.0
+    movements = [
+        stock_movement("product", item.product_id, -item.quantity, "sales_invoice",
+                       source_id, source_number, item.product_name, occurred_at=occurred_at)
+        for item in items
+    ]
+    
+    # Shortages come from a read taken before anything is deducted: once a transactional
+    # bulk_write has partly matched, reads in the same session see the lines it already took
+    shortages = await get_stock_shortages(items, session=session)
+    if not shortages and await deduct_product_stock(totals, session=session):
+        try:
+            await journal_stock_movements(movements, session=session)
+        except Exception:
+            # Inside a transaction the abort undoes the deduction; without one, put the stock back
+            if session is None:
+                await restore_product_stock(totals)
+            raise
+        return -sum(m['value'] for m in movements)
+    
+    raise HTTPException(
+        status_code=400,
+        detail={
+            "message": shortages[0]['error'] if shortages else "Stock changed while the invoice was being saved, please retry",
+            "items": shortages
+        }
+    )
 
 
 def detect_interstate(customer_gst: str, company_gst: str = None) -> bool:
@@ -1455,7 +2211,7 @@ def detect_interstate(customer_gst: str, company_gst: str = None) -> bool:
 
 async def get_company_gst():
     """Get company GST number from settings"""
-    settings = await db.company_settings.find_one({}, {"_id": 0})
+    settings = await get_cached_company_settings()
     if settings and settings.get('gst_number'):
         return settings['gst_number']
     return "29AAAAA1234A1Z5"  # Default
@@ -1645,90 +2401,105 @@ async def update_invoice_payment_status_from_payment(invoice_id: str, invoice_ty
     )
 
 
-async def restore_stock_on_return(items):
+async def restore_stock_on_return(items, session=None, source_type: str = "credit_note",
+                                  source_id: str = "", source_number: str = "", occurred_at=None):
     """Restore stock when credit note is created (product return)"""
-    for item in items:
-        await db.products.update_one(
-            {"id": item.product_id},
-            {"$inc": {"stock_quantity": item.quantity}}
-        )
+    await apply_stock_movements([
+        stock_movement("product", item.product_id, item.quantity, source_type,
+                       source_id, source_number, item.product_name, occurred_at=occurred_at)
+        for item in items
+    ], session=session)
+
+
+def tax_columns(items) -> tuple:
+    """Quantities, prices, discount percents and GST rates of the items as parallel lists, for the tax engine.
+    Items are models or stored item dicts; items without discount_percent have none."""
+    if items and isinstance(items[0], dict):
+        return ([item.get('quantity', 0) for item in items], [item.get('price', 0) for item in items],
+                [item.get('discount_percent', 0) or 0 for item in items], [item.get('gst_rate', 0) or 0 for item in items])
+    return ([item.quantity for item in items], [item.price for item in items],
+            [getattr(item, 'discount_percent', 0.0) for item in items], [item.gst_rate for item in items])
+
+
+def tax_lines(items) -> list:
+    """(quantity, price, discount_percent, gst_rate) of each item"""
+    return list(zip(*tax_columns(items)))
+
+
+def calculate_totals_batch(documents: list, include_lines: bool = False) -> list:
+    """Totals of many sales documents in one tax engine pass.
+    documents are (items, is_interstate, overall_discount_type, overall_discount_value) tuples;
+    returns the totals of each, in order, with the per-line amounts under "lines" if include_lines."""
+    all_items = [item for doc in documents for item in doc[0]]
+    positions = np.repeat(np.arange(len(documents)), [len(doc[0]) for doc in documents])
+    quantities, prices, discounts, rates = tax_columns(all_items)
+
+    result = compute_tax_batch(
+        quantities, prices, discounts, rates, positions, len(documents),
+        [doc[2] or "percentage" for doc in documents], [doc[3] or 0.0 for doc in documents],
+        [doc[1] for doc in documents]
+    )
+    document_totals = to_rupee_lists(result['documents'])
+    keys = list(document_totals)
+    all_totals = [
+        {**dict(zip(keys, values)), "is_interstate": doc[1]}
+        for values, doc in zip(zip(*document_totals.values()), documents)
+    ]
+    if include_lines:
+        line_amounts = to_rupee_lists(result['lines'])
+        line_keys = list(line_amounts)
+        for totals in all_totals:
+            totals['lines'] = []
+        for values, position in zip(zip(*line_amounts.values()), positions.tolist()):
+            all_totals[position]['lines'].append(dict(zip(line_keys, values)))
+    return all_totals
+
+
+def ledger_line_taxes(ledger: dict) -> dict:
+    """Per-line tax of every invoice and credit note in a customer ledger, by document id, in one engine pass.
+    Ledger rows show each line on its own, so no document discount is applied."""
+    documents = ledger['invoices'] + ledger['credit_notes']
+    all_totals = calculate_totals_batch([(doc.get('items') or [], False, "percentage", 0.0) for doc in documents],
+                                        include_lines=True)
+    return {doc.get('id'): totals['lines'] for doc, totals in zip(documents, all_totals)}
+
+
+def hsn_tax_summary(items, line_taxes: list) -> list:
+    """Tax of a document's lines grouped by HSN code, GST rate and unit (see HsnTaxLine).
+    line_taxes are the tax engine's per-line amounts for the same items, in order."""
+    if items and isinstance(items[0], dict):
+        keys = [(item.get('hsn_code') or "", item.get('gst_rate', 0) or 0, item.get('unit') or "") for item in items]
+        quantities = [item.get('quantity', 0) for item in items]
+    else:
+        keys = [(item.hsn_code or "", item.gst_rate, item.unit or "") for item in items]
+        quantities = [item.quantity for item in items]
+    return [
+        {"hsn_code": hsn_code, "gst_rate": gst_rate, "unit": unit, "quantity": quantity, **amounts,
+         "total_value": round(amounts['taxable_amount'] + amounts['total_gst'], 2)}
+        for (hsn_code, gst_rate, unit), quantity, amounts in group_line_tax(keys, quantities, line_taxes)
+    ]
 
 
-async def calculate_document_totals(items, customer_gst, overall_discount_type="percentage", overall_discount_value=0.0):
-    """Calculate totals for sales documents (Quotation, Sales Order, Invoice)"""
-    # Calculate item-level totals
-    subtotal = 0
-    total_discount = 0
-    
-    for item in items:
-        item_total = item.quantity * item.price
-        discount_amount = item_total * (item.discount_percent / 100)
-        
-        subtotal += item_total
-        total_discount += discount_amount
-    
-    # Calculate after item discounts
-    amount_after_item_discount = subtotal - total_discount
-    
-    # Calculate overall discount
-    overall_discount_amount = 0.0
-    if overall_discount_value > 0:
-        if overall_discount_type == "percentage":
-            overall_discount_amount = amount_after_item_discount * (overall_discount_value / 100)
-        else:  # amount
-            overall_discount_amount = overall_discount_value
-    
-    # Calculate taxable amount
-    taxable_amount = amount_after_item_discount - overall_discount_amount
-    
+async def calculate_document_totals(items, customer_gst, overall_discount_type="percentage", overall_discount_value=0.0,
+                                    company_gst: str = None, with_hsn_summary: bool = False):
+    """Calculate totals for sales documents (Quotation, Sales Order, Invoice).
+    Pass company_gst when totalling many documents so settings are read once.
+    with_hsn_summary adds the per-HSN breakdown stored on invoices."""
     # Get company GST for interstate detection
-    company_gst = await get_company_gst()
-    
-    # Detect if interstate
+    if company_gst is None:
+        company_gst = await get_company_gst()
     is_interstate = detect_interstate(customer_gst, company_gst)
-    
-    # Calculate GST
-    total_gst = 0
-    for item in items:
-        item_total = item.quantity * item.price
-        item_discount = item_total * (item.discount_percent / 100)
-        item_taxable = item_total - item_discount
-        
-        # Apply overall discount proportionally
-        if amount_after_item_discount > 0:
-            item_share = item_taxable / amount_after_item_discount
-            item_overall_discount = overall_discount_amount * item_share
-            item_final_taxable = item_taxable - item_overall_discount
-        else:
-            item_final_taxable = item_taxable
-        
-        item_gst = item_final_taxable * (item.gst_rate / 100)
-        total_gst += item_gst
-    
-    # Split GST based on interstate or intrastate
-    if is_interstate:
-        igst_amount = total_gst
-        cgst_amount = 0.0
-        sgst_amount = 0.0
-    else:
-        igst_amount = 0.0
-        cgst_amount = total_gst / 2
-        sgst_amount = total_gst / 2
-    
-    grand_total = taxable_amount + total_gst
-    
-    return {
-        "subtotal": subtotal,
-        "total_discount": total_discount,
-        "overall_discount_amount": overall_discount_amount,
-        "taxable_amount": taxable_amount,
-        "is_interstate": is_interstate,
-        "cgst_amount": cgst_amount,
-        "sgst_amount": sgst_amount,
-        "igst_amount": igst_amount,
-        "total_gst": total_gst,
-        "grand_total": grand_total
-    }
+
+    if not with_hsn_summary:
+        totals = document_totals(tax_lines(items), is_interstate, overall_discount_type, overall_discount_value)
+        totals['is_interstate'] = is_interstate
+        return totals
+    # Invoices store their per-line tax by HSN, so they take the exact paise path the HSN rows add up to
+    totals = compute_document_tax(tax_lines(items), is_interstate, overall_discount_type, overall_discount_value,
+                                  include_lines=True)
+    totals['is_interstate'] = is_interstate
+    totals['hsn_summary'] = hsn_tax_summary(items, totals.pop('lines'))
+    return totals
 
 
 
@@ -1756,6 +2527,52 @@ async def generate_production_order_number():
 
 # ========== COMPANY SETTINGS ROUTES ==========
 
+# How often a worker checks whether another worker changed the settings (standalone servers only)
+COMPANY_SETTINGS_POLL_SECONDS = float(os.environ.get('COMPANY_SETTINGS_POLL_SECONDS', '5'))
+
+# In-process copy of the settings singleton; version is bumped on every save
+company_settings_cache = {"settings": None, "version": 0, "loaded": False}
+
+
+async def load_company_settings():
+    """(Re)load the settings singleton into this worker's cache"""
+    settings = await db.company_settings.find_one({}, {"_id": 0})
+    company_settings_cache['settings'] = settings
+    company_settings_cache['version'] = (settings or {}).get('version', 0)
+    company_settings_cache['loaded'] = True
+
+
+async def get_cached_company_settings() -> Optional[dict]:
+    """Company settings from the in-process cache (a copy, safe to modify); None if never saved"""
+    if not company_settings_cache['loaded']:
+        await load_company_settings()
+    settings = company_settings_cache['settings']
+    return dict(settings) if settings else None
+
+
+async def watch_company_settings():
+    """Keep the cache current when another worker saves the settings.
+    Replica sets push changes through a change stream; standalone servers are polled for the version."""
+    while True:
+        try:
+            if await supports_transactions():
+                async with db.company_settings.watch() as stream:
+                    # Anything saved before the stream opened
+                    await load_company_settings()
+                    async for _ in stream:
+                        await load_company_settings()
+            else:
+                await asyncio.sleep(COMPANY_SETTINGS_POLL_SECONDS)
+                current = await db.company_settings.find_one({}, {"_id": 0, "version": 1})
+                if (current or {}).get('version', 0) != company_settings_cache['version']:
+                    await load_company_settings()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Company settings watch failed, retrying: {e}")
+            await asyncio.sleep(COMPANY_SETTINGS_POLL_SECONDS)
+
+
 @api_router.post("/company-settings", response_model=CompanySettings)
 async def create_or_update_company_settings(settings: CompanySettingsCreate):
     """Create or update company settings (singleton)"""
@@ -1769,10 +2586,11 @@ async def create_or_update_company_settings(settings: CompanySettingsCreate):
         
         await db.company_settings.update_one(
             {"id": existing['id']},
-            {"$set": update_data}
+            {"$set": update_data, "$inc": {"version": 1}}
         )
+        await load_company_settings()
         
-        updated_settings = await db.company_settings.find_one({"id": existing['id']}, {"_id": 0})
+        updated_settings = await get_cached_company_settings()
         if isinstance(updated_settings.get('created_at'), str):
             updated_settings['created_at'] = datetime.fromisoformat(updated_settings['created_at'])
         if isinstance(updated_settings.get('updated_at'), str):
@@ -1784,14 +2602,16 @@ async def create_or_update_company_settings(settings: CompanySettingsCreate):
         doc = settings_obj.model_dump()
         doc['created_at'] = doc['created_at'].isoformat()
         doc['updated_at'] = doc['updated_at'].isoformat()
+        doc['version'] = 1
         
         await db.company_settings.insert_one(doc)
+        await load_company_settings()
         return settings_obj
 
 @api_router.get("/company-settings", response_model=CompanySettings)
 async def get_company_settings():
     """Get company settings"""
-    settings = await db.company_settings.find_one({}, {"_id": 0})
+    settings = await get_cached_company_settings()
     
     if not settings:
         # Return default settings if none exist
@@ -1814,6 +2634,10 @@ async def create_product(product: ProductCreate):
     doc['created_at'] = doc['created_at'].isoformat()
     
     await db.products.insert_one(doc)
+    await journal_stock_movements([
+        stock_movement("product", product_obj.id, product_obj.stock_quantity, "opening_balance",
+                       item_name=product_obj.name, unit_cost=opening_unit_cost(doc))
+    ])
     return product_obj
 
 @api_router.get("/products", response_model=List[Product])
@@ -1840,13 +2664,17 @@ async def update_product(product_id: str, product_update: ProductUpdate):
     if not update_data:
         raise HTTPException(status_code=400, detail="No fields to update")
     
-    result = await db.products.update_one(
+    before = await db.products.find_one_and_update(
         {"id": product_id},
-        {"$set": update_data}
+        {"$set": update_data},
+        projection={"_id": 0, "id": 1, "name": 1, "stock_quantity": 1}
     )
     
-    if result.matched_count == 0:
+    if before is None:
         raise HTTPException(status_code=404, detail="Product not found")
+    await journal_stock_adjustment("product", before, update_data.get('stock_quantity'))
+    if 'min_stock_level' in update_data:
+        await refresh_reorder_items([("product", product_id)])
     
     updated_product = await db.products.find_one({"id": product_id}, {"_id": 0})
     if isinstance(updated_product.get('created_at'), str):
@@ -1858,6 +2686,7 @@ async def delete_product(product_id: str):
     result = await db.products.delete_one({"id": product_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
+    await db.reorder_list.delete_one({"key": f"product:{product_id}"})
     return {"message": "Product deleted successfully"}
 
 
@@ -1982,6 +2811,10 @@ async def create_raw_material(raw_material: RawMaterialCreate):
     doc['created_at'] = doc['created_at'].isoformat()
     
     await db.raw_materials.insert_one(doc)
+    await journal_stock_movements([
+        stock_movement("raw_material", raw_material_obj.id, raw_material_obj.stock_quantity, "opening_balance",
+                       item_name=raw_material_obj.name, unit_cost=opening_unit_cost(doc))
+    ])
     return raw_material_obj
 
 @api_router.get("/raw-materials", response_model=List[RawMaterial])
@@ -2008,13 +2841,17 @@ async def update_raw_material(raw_material_id: str, raw_material_update: RawMate
     if not update_data:
         raise HTTPException(status_code=400, detail="No fields to update")
     
-    result = await db.raw_materials.update_one(
+    before = await db.raw_materials.find_one_and_update(
         {"id": raw_material_id},
-        {"$set": update_data}
+        {"$set": update_data},
+        projection={"_id": 0, "id": 1, "name": 1, "stock_quantity": 1}
     )
     
-    if result.matched_count == 0:
+    if before is None:
         raise HTTPException(status_code=404, detail="Raw material not found")
+    await journal_stock_adjustment("raw_material", before, update_data.get('stock_quantity'))
+    if 'min_stock_level' in update_data:
+        await refresh_reorder_items([("raw_material", raw_material_id)])
     
     updated_raw_material = await db.raw_materials.find_one({"id": raw_material_id}, {"_id": 0})
     if isinstance(updated_raw_material.get('created_at'), str):
@@ -2026,6 +2863,7 @@ async def delete_raw_material(raw_material_id: str):
     result = await db.raw_materials.delete_one({"id": raw_material_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Raw material not found")
+    await db.reorder_list.delete_one({"key": f"raw_material:{raw_material_id}"})
     return {"message": "Raw material deleted successfully"}
 
 
@@ -2038,6 +2876,10 @@ async def create_packing_material(packing_material: PackingMaterialCreate):
     doc['created_at'] = doc['created_at'].isoformat()
     
     await db.packing_materials.insert_one(doc)
+    await journal_stock_movements([
+        stock_movement("packing_material", packing_material_obj.id, packing_material_obj.stock_quantity, "opening_balance",
+                       item_name=packing_material_obj.name, unit_cost=opening_unit_cost(doc))
+    ])
     return packing_material_obj
 
 @api_router.get("/packing-materials", response_model=List[PackingMaterial])
@@ -2064,13 +2906,17 @@ async def update_packing_material(packing_material_id: str, packing_material_upd
     if not update_data:
         raise HTTPException(status_code=400, detail="No fields to update")
     
-    result = await db.packing_materials.update_one(
+    before = await db.packing_materials.find_one_and_update(
         {"id": packing_material_id},
-        {"$set": update_data}
+        {"$set": update_data},
+        projection={"_id": 0, "id": 1, "name": 1, "stock_quantity": 1}
     )
     
-    if result.matched_count == 0:
+    if before is None:
         raise HTTPException(status_code=404, detail="Packing material not found")
+    await journal_stock_adjustment("packing_material", before, update_data.get('stock_quantity'))
+    if 'min_stock_level' in update_data:
+        await refresh_reorder_items([("packing_material", packing_material_id)])
     
     updated_packing_material = await db.packing_materials.find_one({"id": packing_material_id}, {"_id": 0})
     if isinstance(updated_packing_material.get('created_at'), str):
@@ -2082,11 +2928,213 @@ async def delete_packing_material(packing_material_id: str):
     result = await db.packing_materials.delete_one({"id": packing_material_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Packing material not found")
+    await db.reorder_list.delete_one({"key": f"packing_material:{packing_material_id}"})
     return {"message": "Packing material deleted successfully"}
 
 
 
 
+# ========== BULK IMPORT ROUTES ==========
+
+# Rows are validated, upserted and journaled this many at a time
+IMPORT_CHUNK_SIZE = 500
+
+# entity in the URL -> (collection, create model, full model, stock item type)
+IMPORT_ENTITIES = {
+    "products": ("products", ProductCreate, Product, "product"),
+    "customers": ("customers", CustomerCreate, Customer, None),
+    "suppliers": ("suppliers", SupplierCreate, Supplier, None),
+    "raw-materials": ("raw_materials", RawMaterialCreate, RawMaterial, "raw_material"),
+    "packing-materials": ("packing_materials", PackingMaterialCreate, PackingMaterial, "packing_material"),
+}
+
+
+def import_cell_value(value):
+    """Spreadsheet cells as text, so the Create models parse them the same way as CSV fields"""
+    if value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, datetime):
+        return value.isoformat()
+    value = str(value).strip()
+    return value or None
+
+
+def iter_import_rows(upload: UploadFile):
+    """Yield (row_number, {column: value}) from a CSV or XLSX upload without loading the whole sheet.
+    Column headers are matched case-insensitively, spaces read as underscores; empty cells are left out."""
+    filename = (upload.filename or "").lower()
+    if filename.endswith(".xlsx"):
+        workbook = load_workbook(upload.file, read_only=True, data_only=True)
+        rows = workbook.active.iter_rows(values_only=True)
+    elif filename.endswith(".csv"):
+        rows = csv.reader(io.TextIOWrapper(upload.file, encoding="utf-8-sig", newline=""))
+    else:
+        raise HTTPException(status_code=400, detail="Upload a .csv or .xlsx file")
+    return iter_header_rows(rows)
+
+
+def iter_header_rows(rows):
+    """Yield (row_number, {column: value}) from rows whose first row is the header"""
+    header = next(rows, None) or []
+    columns = [str(name or "").strip().lower().replace(" ", "_") for name in header]
+    for row_number, row in enumerate(rows, start=2):
+        values = {
+            column: import_cell_value(value)
+            for column, value in zip(columns, row) if column
+        }
+        values = {column: value for column, value in values.items() if value is not None}
+        if values:
+            yield row_number, values
+
+
+def read_import_chunk(rows) -> list:
+    return list(islice(rows, IMPORT_CHUNK_SIZE))
+
+
+async def ensure_import_indexes():
+    """Imports look records up by name (or id); names are indexed but not unique, since two customers
+    or suppliers may share one. Replaces the unique name index earlier versions created."""
+    for collection_name, _, _, _ in IMPORT_ENTITIES.values():
+        collection = db[collection_name]
+        existing = (await collection.index_information()).get("name_1")
+        if existing and existing.get('unique'):
+            await collection.drop_index("name_1")
+        await collection.create_index("name")
+        await collection.create_index("id")
+
+
+@api_router.post("/import/{entity}")
+async def import_entities(entity: str, file: UploadFile = File(...), dry_run: bool = False):
+    """Bulk create or update master data from a CSV/XLSX file.
+    A row with an id column updates that record; otherwise it is matched on name, and a name that more
+    than one record shares is reported as an error (add the id to pick one). Unmatched rows are created.
+    Only the columns present in the file are written to existing records; stock quantity changes
+    are journaled like manual edits. With dry_run nothing is written and the report shows what would happen."""
+    if entity not in IMPORT_ENTITIES:
+        raise HTTPException(status_code=404, detail=f"Cannot import {entity}. Supported: {', '.join(IMPORT_ENTITIES)}")
+    collection_name, create_model, model, item_type = IMPORT_ENTITIES[entity]
+    collection = db[collection_name]
+    
+    report = {"entity": entity, "dry_run": dry_run, "total_rows": 0, "valid_rows": 0,
+              "inserted": 0, "updated": 0, "errors": []}
+    seen_keys = {}
+    rows = iter_import_rows(file)
+    
+    def row_error(row_number, name, message):
+        report['errors'].append({"row": row_number, "name": name, "errors": [message]})
+    
+    while True:
+        # Parsing is CPU-bound, so keep it off the event loop
+        chunk = await asyncio.to_thread(read_import_chunk, rows)
+        if not chunk:
+            break
+        report['total_rows'] += len(chunk)
+        
+        parsed = []
+        for row_number, values in chunk:
+            try:
+                record = create_model(**values)
+            except ValidationError as e:
+                report['errors'].append({
+                    "row": row_number,
+                    "name": values.get('name', ''),
+                    "errors": [f"{'.'.join(str(part) for part in err['loc'])}: {err['msg']}" for err in e.errors()]
+                })
+                continue
+            key = ("id", values['id']) if values.get('id') else ("name", record.name)
+            if key in seen_keys:
+                row_error(row_number, record.name, f"Duplicate {key[0]}, already imported from row {seen_keys[key]}")
+                continue
+            seen_keys[key] = row_number
+            fields = {k: v for k, v in record.model_dump().items() if k in values}
+            parsed.append((row_number, key, record, fields))
+        if not parsed:
+            continue
+        
+        by_id = {}
+        by_name = {}
+        async for doc in collection.find(
+            {"$or": [
+                {"id": {"$in": [key[1] for _, key, _, _ in parsed if key[0] == "id"]}},
+                {"name": {"$in": [key[1] for _, key, _, _ in parsed if key[0] == "name"]}}
+            ]},
+            {"_id": 0, "id": 1, "name": 1, "stock_quantity": 1}
+        ):
+            by_id[doc['id']] = doc
+            by_name.setdefault(doc['name'], []).append(doc)
+        
+        # (row_number, record, fields, existing record or None)
+        valid = []
+        for row_number, (match, value), record, fields in parsed:
+            if match == "id":
+                if value not in by_id:
+                    row_error(row_number, record.name, f"No record with id {value}")
+                    continue
+                valid.append((row_number, record, fields, by_id[value]))
+            elif len(by_name.get(value, [])) > 1:
+                row_error(row_number, record.name,
+                          f"{len(by_name[value])} records share this name, add an id column to choose one")
+            else:
+                valid.append((row_number, record, fields, by_name.get(value, [None])[0]))
+        report['valid_rows'] += len(valid)
+        if dry_run:
+            updates = sum(1 for *_, before in valid if before is not None)
+            report['updated'] += updates
+            report['inserted'] += len(valid) - updates
+            continue
+        if not valid:
+            continue
+        
+        operations = []
+        new_ids = {}
+        for index, (_, record, fields, before) in enumerate(valid):
+            if before is not None:
+                operations.append(UpdateOne({"id": before['id']}, {"$set": fields}))
+                continue
+            doc = model(**record.model_dump()).model_dump()
+            doc['created_at'] = doc['created_at'].isoformat()
+            new_ids[index] = doc['id']
+            operations.append(InsertOne(doc))
+        
+        failed = set()
+        try:
+            await collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                row_number, record, _, _ = valid[error['index']]
+                failed.add(error['index'])
+                row_error(row_number, record.name, error.get('errmsg', 'Write failed'))
+        
+        written = [(index, record, fields, before)
+                   for index, (_, record, fields, before) in enumerate(valid) if index not in failed]
+        report['inserted'] += sum(1 for *_, before in written if before is None)
+        report['updated'] += sum(1 for *_, before in written if before is not None)
+        
+        if item_type:
+            movements = []
+            for index, record, fields, before in written:
+                if before is None:
+                    movements.append(stock_movement(
+                        item_type, new_ids[index], record.stock_quantity, "opening_balance",
+                        item_name=record.name, unit_cost=opening_unit_cost(record.model_dump())
+                    ))
+                elif 'stock_quantity' in fields:
+                    movements.append(stock_movement(
+                        item_type, before['id'], record.stock_quantity - before.get('stock_quantity', 0),
+                        "adjustment", item_name=record.name
+                    ))
+            await journal_stock_movements(movements)
+            # min_stock_level may have changed without any stock movement
+            await refresh_reorder_items([
+                (item_type, before['id'] if before is not None else new_ids[index])
+                for index, _, _, before in written
+            ])
+    
+    return report
+
+
 # ========== PURCHASE REQUEST ROUTES ==========
 
 @api_router.post("/purchase-requests", response_model=PurchaseRequest)
@@ -2328,13 +3376,6 @@ async def create_stock_inward(stock_data: StockInwardCreate):
     if not material:
         raise HTTPException(status_code=404, detail="Material not found")
     
-    # Update stock quantity
-    new_quantity = material.get("stock_quantity", 0) + stock_data.quantity_added
-    await collection.update_one(
-        {"id": stock_data.material_id},
-        {"$set": {"stock_quantity": new_quantity}}
-    )
-    
     # Save stock inward record
     stock_inward = StockInward(
         material_type=stock_data.material_type,
@@ -2348,7 +3389,19 @@ async def create_stock_inward(stock_data: StockInwardCreate):
     doc['added_date'] = doc['added_date'].isoformat()
     doc['created_at'] = doc['created_at'].isoformat()
     
-    await db.stock_inward.insert_one(doc)
+    # $inc rather than read-modify-write so concurrent inwards don't overwrite each other
+    async def post_stock_inward(session):
+        await apply_stock_movements([
+            stock_movement("raw_material" if collection_name == "raw_materials" else "packing_material",
+                           stock_data.material_id, stock_data.quantity_added, "stock_inward",
+                           stock_inward.id, "", material.get("name", ""),
+                           unit_cost=material.get("purchase_price"), occurred_at=stock_inward.added_date)
+        ], session=session)
+        await db.stock_inward.insert_one(dict(doc), session=session)
+    
+    await run_transaction(post_stock_inward)
+    updated = await collection.find_one({"id": stock_data.material_id}, {"_id": 0, "stock_quantity": 1})
+    new_quantity = updated.get("stock_quantity", 0) if updated else stock_data.quantity_added
     
     return {
         "message": "Stock added successfully",
@@ -2367,6 +3420,130 @@ async def get_stock_inward():
 
 
 
+# ========== STOCK MOVEMENT ROUTES ==========
+
+@api_router.get("/stock-movements")
+async def get_stock_movements(
+    item_type: Optional[str] = None,
+    item_id: Optional[str] = None,
+    source_type: Optional[str] = None,
+    source_id: Optional[str] = None,
+    skip: int = 0,
+    limit: int = 100
+):
+    """Get stock movements, newest first"""
+    query = {}
+    if item_type:
+        query['item_type'] = item_type
+    if item_id:
+        query['item_id'] = item_id
+    if source_type:
+        query['source_type'] = source_type
+    if source_id:
+        query['source_id'] = source_id
+    
+    movements = await db.stock_movements.find(query, {"_id": 0}) \
+        .sort("created_at", -1).skip(max(skip, 0)).limit(min(max(limit, 1), 1000)).to_list(length=None)
+    return movements
+
+
+@api_router.get("/stock/as-of")
+async def get_stock_as_of(date: str, item_type: Optional[str] = None, item_id: Optional[str] = None):
+    """Stock per item at a point in time.
+    Whole months come from the monthly snapshots; only the as-of month's movements are read.
+    A date-only value (YYYY-MM-DD) means the end of that day."""
+    as_of = parse_entry_date(date)
+    if len(date) == 10:
+        as_of = as_of + timedelta(days=1)
+    if as_of.tzinfo is None:
+        as_of = as_of.replace(tzinfo=timezone.utc)
+    cutoff = as_of.astimezone(timezone.utc).isoformat()
+    month = cutoff[:7]
+    
+    match = {}
+    if item_type:
+        match['item_type'] = item_type
+    if item_id:
+        match['item_id'] = item_id
+    
+    snapshot_pipeline = [
+        {"$match": {**match, "month": {"$lt": month}}},
+        {"$group": {
+            "_id": {"item_type": "$item_type", "item_id": "$item_id"},
+            "quantity": {"$sum": "$net_quantity"},
+            "item_name": {"$last": "$item_name"}
+        }}
+    ]
+    movement_pipeline = [
+        {"$match": {**match, "month": month, "created_at": {"$lt": cutoff}}},
+        {"$group": {
+            "_id": {"item_type": "$item_type", "item_id": "$item_id"},
+            "quantity": {"$sum": "$quantity"},
+            "item_name": {"$last": "$item_name"}
+        }}
+    ]
+    
+    stock = {}
+    for pipeline, collection in ((snapshot_pipeline, db.stock_snapshots), (movement_pipeline, db.stock_movements)):
+        async for row in collection.aggregate(pipeline):
+            key = (row['_id']['item_type'], row['_id']['item_id'])
+            entry = stock.setdefault(key, {
+                "item_type": key[0], "item_id": key[1], "item_name": row.get('item_name', ''), "quantity": 0
+            })
+            entry['quantity'] += row['quantity']
+    
+    return {
+        "as_of": cutoff,
+        "items": sorted(stock.values(), key=lambda x: (x['item_type'], x['item_name'] or ''))
+    }
+
+
+
+# ========== INVENTORY VALUATION ROUTES ==========
+
+@api_router.get("/inventory/valuation")
+async def get_inventory_valuation():
+    """Current inventory value per item type from the running totals"""
+    totals = await get_inventory_value()
+    return {
+        "method": INVENTORY_VALUATION_METHOD,
+        "raw_materials": round(totals['raw_material'], 2),
+        "packing_materials": round(totals['packing_material'], 2),
+        "finished_goods": round(totals['product'], 2),
+        "total": round(sum(totals.values()), 2)
+    }
+
+
+@api_router.get("/inventory/valuation/items")
+async def get_inventory_valuation_items(item_type: Optional[str] = None, skip: int = 0, limit: int = 100):
+    """Per-item quantity, value and average cost, highest value first"""
+    query = {}
+    if item_type:
+        query['item_type'] = item_type
+    
+    items = await db.inventory_valuation.find(query, {"_id": 0, "key": 0, "version": 0}) \
+        .sort("value", -1).skip(max(skip, 0)).limit(min(max(limit, 1), 1000)).to_list(length=None)
+    for item in items:
+        item['value'] = round(item['value'], 2)
+        item['average_cost'] = round(item['average_cost'], 4)
+    return items
+
+
+@api_router.get("/inventory/reorder-list")
+async def get_reorder_list(item_type: Optional[str] = None, skip: int = 0, limit: int = 100):
+    """Items below their min_stock_level, largest shortfall first.
+    Maintained on every stock change, so this is a read of the materialized list."""
+    query = {}
+    if item_type:
+        query['item_type'] = item_type
+    
+    total = await db.reorder_list.count_documents(query)
+    items = await db.reorder_list.find(query, {"_id": 0, "key": 0}) \
+        .sort("shortfall", -1).skip(max(skip, 0)).limit(min(max(limit, 1), 1000)).to_list(length=None)
+    return {"total": total, "skip": max(skip, 0), "items": items}
+
+
+
 # ========== SUPPLIER PRICE ROUTES ==========
 
 @api_router.post("/supplier-prices")
@@ -2404,6 +3581,10 @@ async def create_supplier_price(price_data: SupplierPriceCreate):
             {"id": existing['id']},
             {"$set": update_data}
         )
+        if price_data.price != existing['price']:
+            await record_supplier_price(existing, price_data.price, update_data['updated_at'])
+        await refresh_reorder_items([(existing['material_type'], existing['material_id'])])
+        await refresh_costs_for_material(existing['material_id'])
         
         return {"message": "Supplier price updated successfully", "id": existing['id']}
     else:
@@ -2426,6 +3607,9 @@ async def create_supplier_price(price_data: SupplierPriceCreate):
         doc['updated_at'] = doc['updated_at'].isoformat()
         
         await db.supplier_prices.insert_one(doc)
+        await record_supplier_price(doc, doc['price'], doc['updated_at'])
+        await refresh_reorder_items([(price_data.material_type, price_data.material_id)])
+        await refresh_costs_for_material(price_data.material_id)
         
         return {"message": "Supplier price added successfully", "id": supplier_price.id}
 
@@ -2453,57 +3637,129 @@ async def get_supplier_prices(
 
 
 @api_router.get("/supplier-prices/comparison")
-async def get_price_comparison(material_type: Optional[str] = None):
-    """Get price comparison across all suppliers and materials"""
+async def get_price_comparison(
+    material_type: Optional[str] = None,
+    top_k: Optional[int] = None,
+    max_lead_time_days: Optional[int] = None,
+    max_minimum_order_qty: Optional[float] = None,
+    skip: int = 0,
+    limit: int = 1000
+):
+    """Get price comparison across all suppliers and materials.
+    Grouped in the database on the (material_id, price) index; top_k keeps the cheapest k suppliers
+    per material and skip/limit page through materials. Suppliers with no lead time are excluded
+    when max_lead_time_days is given; suppliers with no MOQ always pass max_minimum_order_qty."""
     query = {}
     if material_type:
         query["material_type"] = material_type
+    if max_lead_time_days is not None:
+        query["lead_time_days"] = {"$lte": max_lead_time_days}
+    if max_minimum_order_qty is not None:
+        query["$or"] = [
+            {"minimum_order_qty": None},
+            {"minimum_order_qty": {"$lte": max_minimum_order_qty}}
+        ]
     
-    # Get all supplier prices
-    all_prices = await db.supplier_prices.find(query, {"_id": 0}).to_list(10000)
-    
-    # Group by material
-    materials_map = {}
+    suppliers = "$suppliers"
+    if top_k:
+        suppliers = {"$slice": ["$suppliers", max(top_k, 1)]}
+    
+    pipeline = [
+        {"$match": query},
+        {"$sort": {"material_id": 1, "price": 1}},
+        {"$group": {
+            "_id": "$material_id",
+            "material_name": {"$first": "$material_name"},
+            "material_type": {"$first": "$material_type"},
+            "unit": {"$first": "$unit"},
+            "supplier_count": {"$sum": 1},
+            "suppliers": {"$push": {
+                "supplier_id": "$supplier_id",
+                "supplier_name": "$supplier_name",
+                "price": "$price",
+                "lead_time_days": "$lead_time_days",
+                "minimum_order_qty": "$minimum_order_qty",
+                "notes": {"$ifNull": ["$notes", ""]},
+                "updated_at": "$updated_at"
+            }}
+        }},
+        {"$sort": {"material_name": 1, "_id": 1}},
+        {"$skip": max(skip, 0)},
+        {"$limit": min(max(limit, 1), 1000)},
+        {"$project": {
+            "_id": 0,
+            "material_id": "$_id",
+            "material_name": 1,
+            "material_type": 1,
+            "unit": 1,
+            "supplier_count": 1,
+            "suppliers": suppliers,
+            "cheapest_supplier": {"$arrayElemAt": ["$suppliers.supplier_name", 0]},
+            "cheapest_price": {"$arrayElemAt": ["$suppliers.price", 0]}
+        }}
+    ]
     
-    for price in all_prices:
-        material_id = price['material_id']
-        
-        if material_id not in materials_map:
-            materials_map[material_id] = {
-                "material_id": material_id,
-                "material_name": price['material_name'],
-                "material_type": price['material_type'],
-                "unit": price['unit'],
-                "suppliers": []
-            }
-        
-        materials_map[material_id]['suppliers'].append({
-            "supplier_id": price['supplier_id'],
-            "supplier_name": price['supplier_name'],
-            "price": price['price'],
-            "lead_time_days": price.get('lead_time_days'),
-            "minimum_order_qty": price.get('minimum_order_qty'),
-            "notes": price.get('notes', ''),
-            "updated_at": price['updated_at']
+    comparison = await db.supplier_prices.aggregate(pipeline).to_list(length=None)
+    return comparison
+
+
+@api_router.get("/supplier-prices/history")
+async def get_supplier_price_history(
+    material_id: str,
+    supplier_id: Optional[str] = None,
+    from_month: Optional[str] = None,
+    to_month: Optional[str] = None
+):
+    """Price trend of a material per supplier, with min/avg/max overall and per month.
+    Months are YYYY-MM; the stats come from the monthly buckets' running totals."""
+    query = {"material_id": material_id}
+    if supplier_id:
+        query["supplier_id"] = supplier_id
+    if from_month or to_month:
+        query["month"] = {}
+        if from_month:
+            query["month"]["$gte"] = from_month
+        if to_month:
+            query["month"]["$lte"] = to_month
+    
+    buckets = await db.supplier_price_history.find(query, {"_id": 0}).sort("month", 1).to_list(length=None)
+    
+    series = {}
+    monthly = []
+    for bucket in buckets:
+        supplier = series.setdefault(bucket['supplier_id'], {
+            "supplier_id": bucket['supplier_id'],
+            "supplier_name": bucket.get('supplier_name', ''),
+            "points": []
+        })
+        supplier['points'].extend(bucket['points'])
+        monthly.append({
+            "month": bucket['month'],
+            "supplier_id": bucket['supplier_id'],
+            "supplier_name": bucket.get('supplier_name', ''),
+            "min": bucket['min'],
+            "max": bucket['max'],
+            "avg": round(bucket['sum'] / bucket['count'], 2),
+            "first": bucket.get('first'),
+            "last": bucket.get('last'),
+            "count": bucket['count']
         })
     
-    # Convert to list and find cheapest for each material
-    comparison = []
-    for material_id, data in materials_map.items():
-        # Sort suppliers by price
-        data['suppliers'].sort(key=lambda x: x['price'])
-        
-        # Mark the cheapest
-        if data['suppliers']:
-            data['cheapest_supplier'] = data['suppliers'][0]['supplier_name']
-            data['cheapest_price'] = data['suppliers'][0]['price']
-        
-        comparison.append(data)
-    
-    # Sort by material name
-    comparison.sort(key=lambda x: x['material_name'])
+    count = sum(bucket['count'] for bucket in buckets)
+    stats = {
+        "min": min((bucket['min'] for bucket in buckets), default=None),
+        "max": max((bucket['max'] for bucket in buckets), default=None),
+        "avg": round(sum(bucket['sum'] for bucket in buckets) / count, 2) if count else None,
+        "count": count
+    }
     
-    return comparison
+    return {
+        "material_id": material_id,
+        "material_name": buckets[0].get('material_name', '') if buckets else "",
+        "stats": stats,
+        "monthly": monthly,
+        "series": list(series.values())
+    }
 
 
 @api_router.get("/supplier-prices/{price_id}")
@@ -2533,6 +3789,11 @@ async def update_supplier_price(price_id: str, update_data: SupplierPriceUpdate)
         {"id": price_id},
         {"$set": update_dict}
     )
+    await refresh_reorder_items([(existing['material_type'], existing['material_id'])])
+    if 'price' in update_dict:
+        if update_dict['price'] != existing['price']:
+            await record_supplier_price(existing, update_dict['price'], update_dict['updated_at'])
+        await refresh_costs_for_material(existing['material_id'])
     
     updated_price = await db.supplier_prices.find_one({"id": price_id}, {"_id": 0})
     return {"message": "Supplier price updated successfully", "price": updated_price}
@@ -2541,10 +3802,14 @@ async def update_supplier_price(price_id: str, update_data: SupplierPriceUpdate)
 @api_router.delete("/supplier-prices/{price_id}")
 async def delete_supplier_price(price_id: str):
     """Delete supplier price"""
-    result = await db.supplier_prices.delete_one({"id": price_id})
+    deleted = await db.supplier_prices.find_one_and_delete(
+        {"id": price_id}, projection={"_id": 0, "material_type": 1, "material_id": 1}
+    )
     
-    if result.deleted_count == 0:
+    if deleted is None:
         raise HTTPException(status_code=404, detail="Supplier price not found")
+    await refresh_reorder_items([(deleted['material_type'], deleted['material_id'])])
+    await refresh_costs_for_material(deleted['material_id'])
     
     return {"message": "Supplier price deleted successfully"}
 
@@ -2557,24 +3822,14 @@ async def create_purchase_order(po_data: PurchaseOrderCreate):
     po_number = await generate_po_number()
     
     # Calculate totals
-    subtotal = 0
-    total_gst = 0
-    
-    for item in po_data.items:
-        item_total = item.quantity * item.price
-        item_gst = item_total * (item.gst_rate / 100)
-        
-        subtotal += item_total
-        total_gst += item_gst
-    
-    grand_total = subtotal + total_gst
+    totals = document_totals(tax_lines(po_data.items))
     
     po_obj = PurchaseOrder(
         po_number=po_number,
         **po_data.model_dump(),
-        subtotal=subtotal,
-        total_gst=total_gst,
-        grand_total=grand_total
+        subtotal=totals['subtotal'],
+        total_gst=totals['total_gst'],
+        grand_total=totals['grand_total']
     )
     
     doc = po_obj.model_dump()
@@ -2637,48 +3892,36 @@ async def create_purchase_invoice(invoice_data: PurchaseInvoiceCreate):
     # Generate invoice number
     invoice_number = await generate_purchase_invoice_number()
     
-    # Calculate totals
-    subtotal = 0
-    total_discount = 0
-    taxable_amount = 0
-    total_gst = 0
-    
-    for item in invoice_data.items:
-        item_total = item.quantity * item.price
-        discount_amount = item_total * (item.discount_percent / 100)
-        item_taxable = item_total - discount_amount
-        item_gst = item_taxable * (item.gst_rate / 100)
-        
-        subtotal += item_total
-        total_discount += discount_amount
-        taxable_amount += item_taxable
-        total_gst += item_gst
-    
-    cgst_amount = total_gst / 2
-    sgst_amount = total_gst / 2
-    grand_total = taxable_amount + total_gst
+    # Calculate totals (purchases are booked intrastate: CGST + SGST)
+    totals = document_totals(tax_lines(invoice_data.items))
     
     invoice_obj = PurchaseInvoice(
         invoice_number=invoice_number,
         **invoice_data.model_dump(),
-        subtotal=subtotal,
-        total_discount=total_discount,
-        taxable_amount=taxable_amount,
-        cgst_amount=cgst_amount,
-        sgst_amount=sgst_amount,
-        total_gst=total_gst,
-        grand_total=grand_total,
+        subtotal=totals['subtotal'],
+        total_discount=totals['total_discount'],
+        taxable_amount=totals['taxable_amount'],
+        cgst_amount=totals['cgst_amount'],
+        sgst_amount=totals['sgst_amount'],
+        total_gst=totals['total_gst'],
+        grand_total=totals['grand_total'],
         stock_updated=True
     )
     
-    # Update stock for each item
-    await update_stock_on_purchase(invoice_data.items)
-    
     doc = invoice_obj.model_dump()
     doc['invoice_date'] = doc['invoice_date'].isoformat()
     doc['created_at'] = doc['created_at'].isoformat()
     
-    await db.purchase_invoices.insert_one(doc)
+    # Update stock for each item together with the invoice insert
+    async def post_purchase_invoice(session):
+        await update_stock_on_purchase(invoice_data.items, invoice_obj.id, invoice_number, session=session,
+                                       occurred_at=invoice_obj.invoice_date)
+        await db.purchase_invoices.insert_one(dict(doc), session=session)
+    
+    await run_transaction(post_purchase_invoice)
+    # The purchase is now the last purchased cost of its materials
+    for material_id in {item.item_id for item in invoice_data.items}:
+        await refresh_costs_for_material(material_id)
     return invoice_obj
 
 @api_router.get("/purchase-invoices", response_model=List[PurchaseInvoice])
@@ -2794,24 +4037,12 @@ async def get_balance_sheet():
     paid_sales = sum(inv.get('paid_amount', 0) for inv in sales_invoices)
     outstanding_receivables = total_sales - paid_sales
     
-    # Calculate inventory value
-    raw_materials = await db.raw_materials.find({}, {"_id": 0}).to_list(1000)
-    raw_materials_value = sum(
-        (rm.get('stock_quantity', 0) * rm.get('purchase_price', 0)) 
-        for rm in raw_materials
-    )
-    
-    packing_materials = await db.packing_materials.find({}, {"_id": 0}).to_list(1000)
-    packing_materials_value = sum(
-        (pm.get('stock_quantity', 0) * pm.get('purchase_price', 0)) 
-        for pm in packing_materials
-    )
-    
-    products = await db.products.find({}, {"_id": 0}).to_list(1000)
-    finished_goods_value = sum(
-        (p.get('stock_quantity', 0) * p.get('selling_price', 0)) 
-        for p in products
-    )
+    # Inventory value from the valuation engine's running totals
+    inventory_value = await get_inventory_value()
+    raw_materials_value = inventory_value['raw_material']
+    packing_materials_value = inventory_value['packing_material']
+    finished_goods_value = inventory_value['product']
+    cost_of_goods_sold = sum(inv.get('cost_of_goods_sold', 0) for inv in sales_invoices)
     
     total_inventory_value = raw_materials_value + packing_materials_value + finished_goods_value
     
@@ -2824,6 +4055,49 @@ async def get_balance_sheet():
     # Calculate net worth
     total_assets = cash_balance + total_inventory_value + outstanding_receivables
     total_liabilities = outstanding_payables
+    net_worth = total_assets - total_liabilities
+    net_profit = total_sales - total_purchases - expenses
+    
+    return {
+        "assets": {
+            "cash": round(cash_balance, 2),
+            "accounts_receivable": round(outstanding_receivables, 2),
+            "inventory": {
+                "raw_materials": round(raw_materials_value, 2),
+                "packing_materials": round(packing_materials_value, 2),
+                "finished_goods": round(finished_goods_value, 2),
+                "total": round(total_inventory_value, 2),
+                "valuation_method": INVENTORY_VALUATION_METHOD
+            },
+            "total_assets": round(total_assets, 2)
+        },
+        "liabilities": {
+            "accounts_payable": round(outstanding_payables, 2),
+            "total_liabilities": round(total_liabilities, 2)
+        },
+        "income_statement": {
+            "revenue": {
+                "sales": round(total_sales, 2),
+                "payments_received": round(payments_received, 2)
+            },
+            "expenses": {
+                "purchases": round(total_purchases, 2),
+                "payments_made": round(payments_made, 2),
+                "other_expenses": round(expenses, 2),
+                "total_expenses": round(total_purchases + expenses, 2)
+            },
+            "cost_of_goods_sold": round(cost_of_goods_sold, 2),
+            "gross_profit": round(total_sales - cost_of_goods_sold, 2),
+            "net_profit": round(net_profit, 2)
+        },
+        "summary": {
+            "cash_balance": round(cash_balance, 2),
+            "total_assets": round(total_assets, 2),
+            "total_liabilities": round(total_liabilities, 2),
+            "net_worth": round(net_worth, 2),
+            "net_profit": round(net_profit, 2)
+        }
+    }
 
 
 # ========== AUTHENTICATION ROUTES ==========
@@ -2837,7 +4111,7 @@ async def register_user(user_data: UserCreate):
         raise HTTPException(status_code=400, detail="Username already exists")
     
     # Create user
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await hash_password_async(user_data.password)
     user = User(
         username=user_data.username,
         email=user_data.email,
@@ -2849,7 +4123,11 @@ async def register_user(user_data: UserCreate):
     doc = user.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
     
-    await db.users.insert_one(doc)
+    try:
+        await db.users.insert_one(doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Username already exists")
+    invalidate_auth_user(user.id, user.username)
     
     return {"message": "User created successfully", "username": user.username, "role": user.role}
 
@@ -2864,7 +4142,7 @@ async def login(user_credentials: UserLogin):
         raise HTTPException(status_code=401, detail="Invalid username or password")
     
     # Verify password
-    if not verify_password(user_credentials.password, user["hashed_password"]):
+    if not await verify_password_async(user_credentials.password, user["hashed_password"]):
         raise HTTPException(status_code=401, detail="Invalid username or password")
     
     if not user.get("is_active", True):
@@ -2892,21 +4170,13 @@ async def login(user_credentials: UserLogin):
 
 
 @api_router.get("/auth/me")
-async def get_current_user(token: str):
-    """Get current user from token"""
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
-    
-    user = await db.users.find_one({"username": username}, {"_id": 0, "hashed_password": 0})
-    if user is None:
+async def get_current_user(credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer_scheme),
+                           token: Optional[str] = None):
+    """Get current user from token (Authorization: Bearer header, or the token query parameter)"""
+    context = await load_auth_context(decode_access_token(request_token(credentials, token)))
+    if context is None:
         raise HTTPException(status_code=404, detail="User not found")
-    
-    return user
+    return context['user']
 
 
 @api_router.get("/users")
@@ -2926,7 +4196,7 @@ async def initialize_admin():
     
     # Create default admin
     admin_password = "admin123"  # Change this immediately after first login!
-    hashed_password = get_password_hash(admin_password)
+    hashed_password = await hash_password_async(admin_password)
     
     admin = User(
         username="admin",
@@ -2940,6 +4210,7 @@ async def initialize_admin():
     doc['created_at'] = doc['created_at'].isoformat()
     
     await db.users.insert_one(doc)
+    invalidate_auth_user(admin.id, admin.username)
     
     return {
         "message": "Admin user created successfully",
@@ -2948,56 +4219,6 @@ async def initialize_admin():
         "warning": "⚠️ CHANGE THIS PASSWORD IMMEDIATELY!"
     }
 
-    net_worth = total_assets - total_liabilities
-    
-    # Calculate profit/loss
-    gross_revenue = total_sales
-    total_expenses = total_purchases + expenses
-    net_profit = gross_revenue - total_expenses
-    
-    return {
-        "summary": {
-            "cash_balance": round(cash_balance, 2),
-            "total_assets": round(total_assets, 2),
-            "total_liabilities": round(total_liabilities, 2),
-            "net_worth": round(net_worth, 2),
-            "net_profit": round(net_profit, 2)
-        },
-        "assets": {
-            "cash": round(cash_balance, 2),
-            "inventory": {
-                "raw_materials": round(raw_materials_value, 2),
-                "packing_materials": round(packing_materials_value, 2),
-                "finished_goods": round(finished_goods_value, 2),
-                "total": round(total_inventory_value, 2)
-            },
-            "accounts_receivable": round(outstanding_receivables, 2),
-            "total_assets": round(total_assets, 2)
-        },
-        "liabilities": {
-            "accounts_payable": round(outstanding_payables, 2),
-            "total_liabilities": round(total_liabilities, 2)
-        },
-        "income_statement": {
-            "revenue": {
-                "sales": round(total_sales, 2),
-                "payments_received": round(payments_received, 2)
-            },
-            "expenses": {
-                "purchases": round(total_purchases, 2),
-                "payments_made": round(payments_made, 2),
-                "other_expenses": round(expenses, 2),
-                "total_expenses": round(total_expenses, 2)
-            },
-            "net_profit": round(net_profit, 2)
-        },
-        "transactions_summary": {
-            "total_transactions": len(all_transactions),
-            "payments_received_count": sum(1 for t in all_transactions if t.get('transaction_type') == 'payment_received'),
-            "payments_made_count": sum(1 for t in all_transactions if t.get('transaction_type') == 'payment_made')
-        }
-    }
-
 
 @api_router.delete("/financial-transactions/{transaction_id}")
 async def delete_financial_transaction(transaction_id: str):
@@ -3022,7 +4243,8 @@ async def create_invoice(invoice_data: InvoiceCreate):
         invoice_data.items,
         invoice_data.customer_gst,
         invoice_data.overall_discount_type,
-        invoice_data.overall_discount_value
+        invoice_data.overall_discount_value,
+        with_hsn_summary=True
     )
     
     invoice_obj = Invoice(
@@ -3032,16 +4254,137 @@ async def create_invoice(invoice_data: InvoiceCreate):
         stock_updated=True
     )
     
-    # Deduct stock for each item
-    await update_stock_on_sale(invoice_data.items)
-    
     doc = invoice_obj.model_dump()
     doc['invoice_date'] = doc['invoice_date'].isoformat()
     doc['created_at'] = doc['created_at'].isoformat()
     
-    await db.invoices.insert_one(doc)
+    # Stock deduction and the invoice insert commit or roll back together
+    async def post_invoice(session):
+        cost_of_goods_sold = await update_stock_on_sale(invoice_data.items, session=session,
+                                                        source_id=invoice_obj.id, source_number=invoice_number,
+                                                        occurred_at=invoice_obj.invoice_date)
+        invoice_obj.cost_of_goods_sold = cost_of_goods_sold
+        doc['cost_of_goods_sold'] = cost_of_goods_sold
+        try:
+            await db.invoices.insert_one(dict(doc), session=session)
+        except Exception:
+            if session is None:
+                await restore_stock_on_return(invoice_data.items, source_type="invoice_rollback",
+                                              source_id=invoice_obj.id, source_number=invoice_number,
+                                              occurred_at=invoice_obj.invoice_date)
+            raise
+    
+    await run_transaction(post_invoice)
     return invoice_obj
 
+@api_router.post("/invoices/batch")
+async def create_invoices_batch(batch_data: dict):
+    """Create many invoices at once: {"invoices": [<invoice>, ...]}.
+    Settings and stock are read once, invoice numbers are allocated as a block, and stock,
+    journal and invoices are written together. Invoices that fail validation or would overdraw
+    stock (taking earlier invoices in the batch into account) are reported and skipped."""
+    raw_invoices = batch_data.get("invoices") or []
+    if not raw_invoices:
+        raise HTTPException(status_code=400, detail="No invoices provided")
+    
+    results = [None] * len(raw_invoices)
+    parsed = []
+    for index, raw in enumerate(raw_invoices):
+        try:
+            parsed.append((index, InvoiceCreate(**raw)))
+        except (ValidationError, TypeError) as e:
+            errors = e.errors() if isinstance(e, ValidationError) else [{"loc": (), "msg": str(e)}]
+            results[index] = {"index": index, "success": False, "error": "; ".join(
+                f"{'.'.join(str(part) for part in err['loc'])}: {err['msg']}" for err in errors
+            )}
+    
+    # Allocate stock in batch order against one read of every product involved
+    product_ids = {item.product_id for _, invoice_data in parsed for item in invoice_data.items}
+    available = {
+        product['id']: product.get('stock_quantity', 0)
+        async for product in db.products.find({"id": {"$in": list(product_ids)}}, {"_id": 0, "id": 1, "stock_quantity": 1})
+    }
+    accepted = []
+    for index, invoice_data in parsed:
+        shortages = find_stock_shortages(invoice_data.items, available)
+        if shortages:
+            results[index] = {"index": index, "success": False, "error": shortages[0]['error'], "items": shortages}
+            continue
+        for product_id, quantity in sum_quantities_by_product(invoice_data.items).items():
+            available[product_id] -= quantity
+        accepted.append((index, invoice_data))
+    
+    if accepted:
+        company_gst = await get_company_gst()
+        invoice_numbers = await generate_invoice_numbers(len(accepted))
+        # Totals of the whole batch in one tax engine pass
+        all_totals = calculate_totals_batch([
+            (invoice_data.items, detect_interstate(invoice_data.customer_gst, company_gst),
+             invoice_data.overall_discount_type, invoice_data.overall_discount_value)
+            for _, invoice_data in accepted
+        ], include_lines=True)
+        invoices = []
+        for (index, invoice_data), invoice_number, totals in zip(accepted, invoice_numbers, all_totals):
+            totals['hsn_summary'] = hsn_tax_summary(invoice_data.items, totals.pop('lines'))
+            invoices.append((index, invoice_data, Invoice(
+                invoice_number=invoice_number,
+                **invoice_data.model_dump(),
+                **totals,
+                stock_updated=True
+            )))
+        
+        all_items = [item for _, invoice_data, _ in invoices for item in invoice_data.items]
+        movements = [
+            stock_movement("product", item.product_id, -item.quantity, "sales_invoice",
+                           invoice_obj.id, invoice_obj.invoice_number, item.product_name,
+                           occurred_at=invoice_obj.invoice_date)
+            for _, invoice_data, invoice_obj in invoices for item in invoice_data.items
+        ]
+        
+        async def post_batch(session):
+            if not await deduct_product_stock(sum_quantities_by_product(all_items), session=session):
+                raise HTTPException(status_code=409, detail="Stock changed while the batch was being saved, please retry")
+            await journal_stock_movements(movements, session=session)
+            
+            cost_of_goods_sold = {}
+            for movement in movements:
+                cost_of_goods_sold[movement['source_id']] = cost_of_goods_sold.get(movement['source_id'], 0.0) - movement['value']
+            docs = []
+            for _, _, invoice_obj in invoices:
+                invoice_obj.cost_of_goods_sold = cost_of_goods_sold.get(invoice_obj.id, 0.0)
+                doc = invoice_obj.model_dump()
+                doc['invoice_date'] = doc['invoice_date'].isoformat()
+                doc['created_at'] = doc['created_at'].isoformat()
+                docs.append(doc)
+            try:
+                await db.invoices.insert_many(docs, session=session)
+            except Exception:
+                if session is None:
+                    await apply_stock_movements([
+                        stock_movement(m['item_type'], m['item_id'], -m['quantity'], "invoice_rollback",
+                                       m['source_id'], m['source_number'], m['item_name'],
+                                       occurred_at=m['created_at'])
+                        for m in movements
+                    ])
+                raise
+        
+        await run_transaction(post_batch)
+        
+        for index, _, invoice_obj in invoices:
+            results[index] = {
+                "index": index,
+                "success": True,
+                "invoice_id": invoice_obj.id,
+                "invoice_number": invoice_obj.invoice_number,
+                "grand_total": invoice_obj.grand_total
+            }
+    
+    return {
+        "created": len(accepted),
+        "failed": len(raw_invoices) - len(accepted),
+        "results": results
+    }
+
 @api_router.get("/invoices", response_model=List[Invoice])
 async def get_invoices():
     invoices = await db.invoices.find({}, {"_id": 0}).sort("invoice_date", -1).to_list(1000)
@@ -3105,19 +4448,21 @@ async def cancel_invoice(invoice_id: str):
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
     
-    # Restore stock for each item (only if stock was updated)
-    if invoice.get('stock_updated', True):  # Default to True for old invoices
-        for item in invoice['items']:
-            await db.products.update_one(
-                {"id": item['product_id']},
-                {"$inc": {"stock_quantity": item['quantity']}}
-            )
-    
-    # Delete the invoice completely
-    result = await db.invoices.delete_one({"id": invoice_id})
+    # Restore stock (only if stock was updated) and delete the invoice in one transaction
+    async def cancel(session):
+        result = await db.invoices.delete_one({"id": invoice_id}, session=session)
+        if result.deleted_count == 0:
+            raise HTTPException(status_code=404, detail="Invoice not found")
+        
+        if invoice.get('stock_updated', True):  # Default to True for old invoices
+            await apply_stock_movements([
+                stock_movement("product", item['product_id'], item['quantity'], "invoice_cancel",
+                               invoice_id, invoice.get('invoice_number', ''), item.get('product_name', ''),
+                               occurred_at=invoice.get('invoice_date'))
+                for item in invoice['items']
+            ], session=session)
     
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Invoice not found")
+    await run_transaction(cancel)
     
     return {"message": "Invoice deleted and stock restored successfully"}
 
@@ -3451,207 +4796,619 @@ async def create_expense(expense_data: ExpenseCreate):
     return expense_obj
 
 
+# ========== DAY BOOK HELPERS ==========
+
+# Day book writes are serialised across workers by a lease on one daybook_locks document, so two
+# entries can't read the same opening balance. The local lock queues this worker's writers first,
+# so only one of them at a time polls Mongo for the lease.
+daybook_lock = asyncio.Lock()
+DAYBOOK_LOCK_ID = "daybook"
+# A writer that dies holding the lease blocks the others for at most this long
+DAYBOOK_LOCK_LEASE_SECONDS = 30
+DAYBOOK_LOCK_POLL_SECONDS = 0.05
+
+DAYBOOK_BATCH_SIZE = 500
+DAYBOOK_PDF_ROWS_PER_TABLE = 200
+# Exports stay in memory up to this size and spill to a temp file beyond it
+EXPORT_SPOOL_SIZE = 8 * 1024 * 1024
+
+
+async def claim_daybook_lease(token: str) -> bool:
+    """Take (or extend) the day book lease for token; False while another writer holds it"""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.daybook_locks.find_one_and_update(
+            {"_id": DAYBOOK_LOCK_ID, "$or": [{"holder": token}, {"lease_until": {"$lt": now.isoformat()}}]},
+            {"$set": {
+                "holder": token,
+                "lease_until": (now + timedelta(seconds=DAYBOOK_LOCK_LEASE_SECONDS)).isoformat()
+            }},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # The lock document exists and its lease is live, so the upsert tried to insert a second one
+        return False
+    return True
+
+
+async def release_daybook_lease(token: str):
+    await db.daybook_locks.update_one(
+        {"_id": DAYBOOK_LOCK_ID, "holder": token},
+        {"$set": {"holder": None, "lease_until": datetime.now(timezone.utc).isoformat()}}
+    )
+
+
+@asynccontextmanager
+async def daybook_write_lock():
+    """Hold the day book lease for the duration of a write. Yields the lease token, which long
+    writers (a full rebuild) pass to claim_daybook_lease between batches to extend the lease."""
+    async with daybook_lock:
+        token = str(uuid4())
+        while not await claim_daybook_lease(token):
+            await asyncio.sleep(DAYBOOK_LOCK_POLL_SECONDS)
+        try:
+            yield token
+        finally:
+            await release_daybook_lease(token)
+
+
+def parse_entry_date(date_str: str) -> datetime:
+    """Parse an ISO date/datetime string coming from the UI"""
+    return datetime.fromisoformat(date_str.replace('Z', '+00:00'))
+
+
+def daybook_date_key(entry_date) -> str:
+    """UTC timestamp prefix of a day book sort key; string order matches time order"""
+    if isinstance(entry_date, str):
+        entry_date = parse_entry_date(entry_date)
+    if entry_date.tzinfo is None:
+        entry_date = entry_date.replace(tzinfo=timezone.utc)
+    return entry_date.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')
+
+
+def daybook_sort_key(entry_date, created_at, entry_id: str) -> str:
+    """Build the indexed key that orders day book rows chronologically.
+    created_at and id break ties between entries on the same date."""
+    if isinstance(created_at, datetime):
+        created_at = created_at.isoformat()
+    return f"{daybook_date_key(entry_date)}|{created_at or ''}|{entry_id}"
+
+
+def daybook_range_query(start_date: str = None, end_date: str = None, purpose: str = None) -> dict:
+    """Build a sort_key range filter for the day book.
+    A date-only end_date (YYYY-MM-DD) includes that whole day."""
+    query = {}
+    key_range = {}
+    if start_date:
+        key_range["$gte"] = daybook_date_key(start_date)
+    if end_date:
+        end = parse_entry_date(end_date)
+        if len(end_date) == 10:
+            key_range["$lt"] = daybook_date_key(end + timedelta(days=1))
+        else:
+            key_range["$lte"] = daybook_date_key(end) + "|~"
+    if key_range:
+        query["sort_key"] = key_range
+    if purpose:
+        query["purpose"] = purpose
+    return query
+
+
+async def get_month_balance_before(sort_key: str, exclude_id: str = None) -> float:
+    """Month balance of the row immediately before sort_key in its month (single indexed lookup)"""
+    query = {"sort_key": {"$gte": sort_key[:7], "$lt": sort_key}}
+    if exclude_id:
+        query["id"] = {"$ne": exclude_id}
+    previous = await db.daybook.find_one(query, {"_id": 0, "month_balance": 1}, sort=[("sort_key", -1)])
+    return previous['month_balance'] if previous else 0.0
+
+
+async def shift_daybook_after(sort_key: str, amount: float, exclude_id: str = None):
+    """Shift the month balance of the rows after sort_key in its month.
+    Later months pick the change up through their checkpoints, so their rows are never touched."""
+    if not amount:
+        return
+    query = {"sort_key": {"$gt": sort_key, "$lt": sort_key[:7] + "~"}}
+    if exclude_id:
+        query["id"] = {"$ne": exclude_id}
+    await db.daybook.update_many(query, {"$inc": {"month_balance": amount}})
+
+
+def checkpoint_opening(checkpoint: dict) -> float:
+    """Balance brought into a checkpoint's month"""
+    return checkpoint['closing_balance'] - checkpoint['total_credit'] + checkpoint['total_debit']
+
+
+async def get_month_openings(months) -> dict:
+    """Opening balance of each month (YYYY-MM) from its checkpoint"""
+    checkpoints = await db.daybook_checkpoints.find(
+        {"month": {"$in": list(months)}}, {"_id": 0}
+    ).to_list(length=None)
+    return {checkpoint['month']: checkpoint_opening(checkpoint) for checkpoint in checkpoints}
+
+
+async def add_daybook_balances(entries: list) -> list:
+    """Turn each row's month balance into its running balance (rows need their sort_key, which is dropped)"""
+    openings = await get_month_openings({entry['sort_key'][:7] for entry in entries})
+    for entry in entries:
+        entry['balance'] = openings.get(entry.pop('sort_key')[:7], 0.0) + entry.pop('month_balance', 0.0)
+    return entries
+
+
+async def apply_daybook_checkpoint(month: str, credit: float, debit: float, count: int):
+    """Fold an entry's amounts into its monthly checkpoint and carry the net into later months"""
+    existing = await db.daybook_checkpoints.find_one({"month": month}, {"_id": 0, "month": 1})
+    if not existing:
+        prior = await db.daybook_checkpoints.find_one(
+            {"month": {"$lt": month}},
+            {"_id": 0, "closing_balance": 1},
+            sort=[("month", -1)]
+        )
+        await db.daybook_checkpoints.update_one(
+            {"month": month},
+            {"$setOnInsert": {
+                "closing_balance": prior['closing_balance'] if prior else 0.0,
+                "total_credit": 0.0,
+                "total_debit": 0.0,
+                "entry_count": 0
+            }},
+            upsert=True
+        )
+    
+    net = credit - debit
+    await db.daybook_checkpoints.update_one(
+        {"month": month},
+        {"$inc": {
+            "total_credit": credit,
+            "total_debit": debit,
+            "entry_count": count,
+            "closing_balance": net
+        }}
+    )
+    if net:
+        await db.daybook_checkpoints.update_many(
+            {"month": {"$gt": month}},
+            {"$inc": {"closing_balance": net}}
+        )
+
+
+async def get_daybook_opening_balance(sort_key: str) -> float:
+    """Balance brought forward at sort_key: its month's opening plus the month balance of the row before it"""
+    month = sort_key[:7]
+    checkpoint = await db.daybook_checkpoints.find_one({"month": month}, {"_id": 0})
+    if not checkpoint:
+        # Nothing in this month yet: everything before it closed in the nearest earlier month
+        checkpoint = await db.daybook_checkpoints.find_one(
+            {"month": {"$lt": month}},
+            {"_id": 0, "closing_balance": 1},
+            sort=[("month", -1)]
+        )
+        return checkpoint['closing_balance'] if checkpoint else 0.0
+    return checkpoint_opening(checkpoint) + await get_month_balance_before(sort_key)
+
+
+async def recalculate_daybook_from(month: str = None, lease_token: str = None):
+    """Rebuild month balances and checkpoints from the start of month onwards.
+    Starts from the nearest earlier checkpoint so older history is never re-read."""
+    if month:
+        checkpoint = await db.daybook_checkpoints.find_one(
+            {"month": {"$lt": month}},
+            {"_id": 0, "closing_balance": 1},
+            sort=[("month", -1)]
+        )
+        running_balance = checkpoint['closing_balance'] if checkpoint else 0.0
+        row_query = {"sort_key": {"$gte": month}}
+        await db.daybook_checkpoints.delete_many({"month": {"$gte": month}})
+    else:
+        running_balance = 0.0
+        row_query = {}
+        await db.daybook_checkpoints.delete_many({})
+    
+    checkpoints = {}
+    updates = []
+    rows_updated = 0
+    cursor = db.daybook.find(
+        row_query,
+        {"_id": 0, "id": 1, "sort_key": 1, "credit": 1, "debit": 1, "month_balance": 1, "balance": 1}
+    ).sort("sort_key", 1)
+    async for entry in cursor:
+        credit = entry.get('credit', 0)
+        debit = entry.get('debit', 0)
+        running_balance += credit - debit
+        
+        entry_month = entry['sort_key'][:7]
+        checkpoint = checkpoints.setdefault(entry_month, {
+            "month": entry_month, "total_credit": 0.0, "total_debit": 0.0, "entry_count": 0
+        })
+        checkpoint['total_credit'] += credit
+        checkpoint['total_debit'] += debit
+        checkpoint['entry_count'] += 1
+        checkpoint['closing_balance'] = running_balance
+        
+        month_balance = checkpoint['total_credit'] - checkpoint['total_debit']
+        # Rows from before month balances also carry a stored running balance, which is dropped
+        if entry.get('month_balance') != month_balance or 'balance' in entry:
+            updates.append(UpdateOne(
+                {"id": entry['id']},
+                {"$set": {"month_balance": month_balance}, "$unset": {"balance": ""}}
+            ))
+        
+        if len(updates) >= DAYBOOK_BATCH_SIZE:
+            await db.daybook.bulk_write(updates, ordered=False)
+            rows_updated += len(updates)
+            updates = []
+            if lease_token:
+                await claim_daybook_lease(lease_token)
+    
+    if updates:
+        await db.daybook.bulk_write(updates, ordered=False)
+        rows_updated += len(updates)
+    if checkpoints:
+        await db.daybook_checkpoints.insert_many(list(checkpoints.values()))
+    
+    return {"rows_updated": rows_updated, "months": len(checkpoints), "closing_balance": running_balance}
+
+
+async def ensure_daybook_indexes():
+    """Create day book indexes and backfill sort keys and month balances for rows written before them"""
+    await db.daybook.create_index("sort_key")
+    await db.daybook.create_index("id")
+    await db.daybook.create_index([("purpose", 1), ("sort_key", 1)])
+    await db.daybook_checkpoints.create_index("month", unique=True)
+    
+    # Every worker runs this at startup; the lease keeps them from rebuilding at the same time
+    async with daybook_write_lock() as lease_token:
+        legacy = await db.daybook.find(
+            {"sort_key": {"$exists": False}},
+            {"_id": 0, "id": 1, "date": 1, "created_at": 1}
+        ).to_list(length=None)
+        if legacy:
+            updates = [
+                UpdateOne(
+                    {"id": entry['id']},
+                    {"$set": {"sort_key": daybook_sort_key(entry['date'], entry.get('created_at', ''), entry['id'])}}
+                )
+                for entry in legacy
+            ]
+            for i in range(0, len(updates), DAYBOOK_BATCH_SIZE):
+                await db.daybook.bulk_write(updates[i:i + DAYBOOK_BATCH_SIZE], ordered=False)
+        
+        if legacy or await db.daybook.count_documents({"month_balance": {"$exists": False}}, limit=1) > 0 or (
+            await db.daybook_checkpoints.count_documents({}) == 0
+            and await db.daybook.count_documents({}, limit=1) > 0
+        ):
+            await recalculate_daybook_from(lease_token=lease_token)
+
+
+def parse_daybook_entry(entry: dict) -> dict:
+    if isinstance(entry.get('date'), str):
+        entry['date'] = datetime.fromisoformat(entry['date'])
+    if isinstance(entry.get('created_at'), str):
+        entry['created_at'] = datetime.fromisoformat(entry['created_at'])
+    return entry
+
+
 # ========== DAY BOOK ROUTES (Manual Entry) ==========
 
 @api_router.post("/daybook", response_model=DayBookEntry)
 async def create_daybook_entry(entry_data: DayBookEntryCreate):
     """Add a manual day book entry"""
-    # Parse date
-    entry_date = datetime.fromisoformat(entry_data.date.replace('Z', '+00:00'))
-    
-    # Get previous balance
-    previous_entries = await db.daybook.find({}, {"_id": 0}).sort("date", -1).to_list(length=1)
-    previous_balance = previous_entries[0]['balance'] if previous_entries else 0.0
-    
-    # Calculate new balance: previous + credit - debit (bank statement format)
-    new_balance = previous_balance + entry_data.credit - entry_data.debit
-    
-    # Create entry
-    entry_obj = DayBookEntry(
-        date=entry_date,
-        description=entry_data.description,
-        purpose=entry_data.purpose,
-        debit=entry_data.debit,
-        credit=entry_data.credit,
-        balance=new_balance
-    )
-    
-    doc = entry_obj.model_dump()
-    doc['date'] = doc['date'].isoformat()
-    doc['created_at'] = doc['created_at'].isoformat()
+    entry_date = parse_entry_date(entry_data.date)
+    
+    async with daybook_write_lock():
+        entry_obj = DayBookEntry(
+            date=entry_date,
+            description=entry_data.description,
+            purpose=entry_data.purpose,
+            debit=entry_data.debit,
+            credit=entry_data.credit
+        )
+        
+        doc = entry_obj.model_dump(exclude={'balance'})
+        doc['date'] = doc['date'].isoformat()
+        doc['created_at'] = doc['created_at'].isoformat()
+        doc['sort_key'] = daybook_sort_key(entry_date, doc['created_at'], entry_obj.id)
+        month = doc['sort_key'][:7]
+        
+        # Rows keep their balance within the month; the month's checkpoint carries the balance
+        # brought forward, so a back-dated entry only shifts the rows after it in its own month
+        net = entry_data.credit - entry_data.debit
+        doc['month_balance'] = await get_month_balance_before(doc['sort_key']) + net
+        
+        await db.daybook.insert_one(doc)
+        await shift_daybook_after(doc['sort_key'], net, exclude_id=entry_obj.id)
+        await apply_daybook_checkpoint(month, entry_data.credit, entry_data.debit, 1)
+        
+        # Balance = balance of the preceding row + credit - debit (bank statement format)
+        entry_obj.balance = (await get_month_openings([month])).get(month, 0.0) + doc['month_balance']
     
-    await db.daybook.insert_one(doc)
     return entry_obj
 
 @api_router.get("/daybook", response_model=List[DayBookEntry])
-async def get_daybook_entries():
-    """Get all day book entries"""
-    entries = await db.daybook.find({}, {"_id": 0}).to_list(length=None)
-    entries.sort(key=lambda x: x['date'])
-    return entries
+async def get_daybook_entries(
+    response: Response,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    purpose: Optional[str] = None,
+    skip: int = 0,
+    limit: Optional[int] = None
+):
+    """Get day book entries in date order: the whole range, or one page of it when limit is given.
+    Pages run backwards from the most recent entry in the range (skip=0 is the latest page), and
+    X-Total-Count carries the number of entries in the range."""
+    query = daybook_range_query(start_date, end_date, purpose)
+    if limit is None:
+        entries = await db.daybook.find(query, {"_id": 0}).sort("sort_key", 1).to_list(length=None)
+        return [parse_daybook_entry(entry) for entry in await add_daybook_balances(entries)]
+    
+    entries = await db.daybook.find(query, {"_id": 0}) \
+        .sort("sort_key", -1).skip(max(skip, 0)).limit(min(max(limit, 1), 5000)).to_list(length=None)
+    entries.reverse()
+    response.headers["X-Total-Count"] = str(await db.daybook.count_documents(query))
+    return [parse_daybook_entry(entry) for entry in await add_daybook_balances(entries)]
+
+@api_router.post("/daybook/recalculate")
+async def recalculate_daybook(from_date: Optional[str] = None):
+    """Rebuild running balances from the checkpoint before from_date (or from the beginning)"""
+    month = daybook_date_key(from_date)[:7] if from_date else None
+    async with daybook_write_lock() as lease_token:
+        return await recalculate_daybook_from(month, lease_token=lease_token)
+
+async def iter_daybook_rows(query: dict):
+    """Yield day book rows with their running balance for an export, in date order,
+    without materialising the range"""
+    cursor = db.daybook.find(query, {"_id": 0}).sort("sort_key", 1).batch_size(DAYBOOK_BATCH_SIZE)
+    month, opening = None, 0.0
+    async for entry in cursor:
+        if entry['sort_key'][:7] != month:
+            month = entry['sort_key'][:7]
+            opening = (await get_month_openings([month])).get(month, 0.0)
+        entry['balance'] = opening + entry.pop('month_balance', 0.0)
+        yield entry
+
+
+def iter_file_chunks(file_obj, chunk_size: int = 64 * 1024):
+    """Stream a spooled export file back to the client in chunks"""
+    file_obj.seek(0)
+    try:
+        while True:
+            chunk = file_obj.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        file_obj.close()
+
+
+class PdfPageWriter:
+    """Draws flowables straight onto the pages of a canvas, splitting tables across pages the way
+    SimpleDocTemplate would. Callers add one chunk at a time, so a long export never holds more
+    than the current chunk's table in memory. Blocking: call it through asyncio.to_thread."""
+    
+    def __init__(self, file_obj, pagesize=A4, margin_x=20, margin_y=30):
+        self.canvas = pdf_canvas.Canvas(file_obj, pagesize=pagesize)
+        self.page_width, self.page_height = pagesize
+        self.margin_x = margin_x
+        self.margin_y = margin_y
+        self.frame_width = self.page_width - 2 * margin_x
+        self.y = self.page_height - margin_y
+    
+    def new_page(self):
+        self.canvas.showPage()
+        self.y = self.page_height - self.margin_y
+    
+    def add(self, flowable, space_after: float = 0):
+        while flowable is not None:
+            available = self.y - self.margin_y
+            width, height = flowable.wrap(self.frame_width, available)
+            if height <= available:
+                flowable.drawOn(self.canvas, self.margin_x + (self.frame_width - width) / 2, self.y - height)
+                self.y -= height + space_after
+                return
+            parts = flowable.split(self.frame_width, available)
+            if len(parts) < 2:
+                if self.y < self.page_height - self.margin_y:
+                    self.new_page()
+                    continue
+                parts = [flowable, None]  # taller than a whole page: draw it clipped rather than loop
+            first, flowable = parts[0], parts[1]
+            width, height = first.wrap(self.frame_width, available)
+            first.drawOn(self.canvas, self.margin_x + (self.frame_width - width) / 2, self.y - height)
+            self.new_page()
+    
+    def close(self):
+        self.canvas.save()
+
+
+def daybook_export_title(start_date: str = None, end_date: str = None, purpose: str = None) -> str:
+    if start_date or end_date:
+        title = f"Day Book - {(start_date or 'Beginning')[:10]} to {(end_date or 'Today')[:10]}"
+    else:
+        title = "Day Book - All Transactions"
+    if purpose:
+        title += f" ({purpose})"
+    return title
+
 
 @api_router.get("/daybook/export-excel")
-async def export_daybook_excel():
-    """Export Day Book to Excel"""
-    entries = await db.daybook.find({}, {"_id": 0}).to_list(length=None)
-    entries.sort(key=lambda x: x['date'])
+async def export_daybook_excel(start_date: Optional[str] = None, end_date: Optional[str] = None, purpose: Optional[str] = None):
+    """Export Day Book to Excel, optionally limited to a date range and purpose"""
+    query = daybook_range_query(start_date, end_date, purpose)
+    # A purpose-filtered export totals that purpose's movements only, so it has no opening balance
+    with_opening = bool(start_date) and not purpose
+    opening_balance = await get_daybook_opening_balance(query["sort_key"]["$gte"]) if with_opening else 0.0
     
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Day Book"
+    # Write-only workbook: rows are flushed as they are appended instead of kept as cell objects
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Day Book")
     
     # Styling
     title_font = Font(bold=True, size=16, color="FFFFFF")
     title_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
     header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
     header_font = Font(bold=True, color="FFFFFF", size=11)
-    bold_font = Font(bold=True)
+    summary_fill = PatternFill(start_color="E7E6E6", end_color="E7E6E6", fill_type="solid")
     green_font = Font(bold=True, color="008000")
     red_font = Font(bold=True, color="FF0000")
     blue_font = Font(bold=True, color="0000FF")
     border = Border(left=Side(style='thin'), right=Side(style='thin'), 
                    top=Side(style='thin'), bottom=Side(style='thin'))
     
+    def styled(value, font=None, fill=None, number_format=None, alignment=None, bordered=True):
+        cell = WriteOnlyCell(ws, value=value)
+        if font:
+            cell.font = font
+        if fill:
+            cell.fill = fill
+        if number_format:
+            cell.number_format = number_format
+        if alignment:
+            cell.alignment = alignment
+        if bordered:
+            cell.border = border
+        return cell
+    
+    # Column widths
+    for column, width in zip("ABCDEFG", [15, 30, 25, 15, 15, 15, 20]):
+        ws.column_dimensions[column].width = width
+    
     # Title
-    ws.merge_cells('A1:G1')
-    ws['A1'] = "Day Book - All Transactions"
-    ws['A1'].font = title_font
-    ws['A1'].fill = title_fill
-    ws['A1'].alignment = Alignment(horizontal='center', vertical='center')
     ws.row_dimensions[1].height = 30
+    ws.append([styled(daybook_export_title(start_date, end_date, purpose), title_font, title_fill,
+                      alignment=Alignment(horizontal='center', vertical='center'), bordered=False)])
+    ws.append([])
     
     # Headers
-    row = 3
     headers = ['Date', 'Description', 'Purpose', 'Credit (In)', 'Debit (Out)', 'Balance', 'Created At']
-    for col_num, header in enumerate(headers, 1):
-        cell = ws.cell(row=row, column=col_num)
-        cell.value = header
-        cell.fill = header_fill
-        cell.font = header_font
-        cell.alignment = Alignment(horizontal='center', vertical='center')
-        cell.border = border
+    ws.append([styled(header, header_font, header_fill, alignment=Alignment(horizontal='center', vertical='center'))
+               for header in headers])
+    
+    # Opening balance brought forward from before the range
+    if with_opening:
+        ws.append([
+            styled(start_date[:10]), styled("Opening Balance", Font(bold=True)), styled(""),
+            styled(None), styled(None),
+            styled(opening_balance, blue_font, number_format='₹#,##0.00'), styled("")
+        ])
     
     # Data rows
-    row = 4
     total_debit = 0
     total_credit = 0
     
-    for entry in entries:
-        ws.cell(row=row, column=1, value=entry.get('date', ''))
-        ws.cell(row=row, column=2, value=entry.get('description', ''))
-        ws.cell(row=row, column=3, value=entry.get('purpose', ''))
-        
-        credit_cell = ws.cell(row=row, column=4, value=entry.get('credit', 0))
-        credit_cell.number_format = '₹#,##0.00'
-        if entry.get('credit', 0) > 0:
-            credit_cell.font = green_font  # Credit = Money IN = Green
-        
-        debit_cell = ws.cell(row=row, column=5, value=entry.get('debit', 0))
-        debit_cell.number_format = '₹#,##0.00'
-        if entry.get('debit', 0) > 0:
-            debit_cell.font = red_font  # Debit = Money OUT = Red
-        
-        balance_cell = ws.cell(row=row, column=6, value=entry.get('balance', 0))
-        balance_cell.number_format = '₹#,##0.00'
-        balance_cell.font = blue_font
-        
-        ws.cell(row=row, column=7, value=entry.get('created_at', ''))
-        
-        # Apply borders
-        for col in range(1, 8):
-            ws.cell(row=row, column=col).border = border
-        
-        total_credit += entry.get('credit', 0)
-        total_debit += entry.get('debit', 0)
-        row += 1
-    
-    # Summary row
-    row += 1
-    ws.merge_cells(f'A{row}:C{row}')
-    summary_cell = ws.cell(row=row, column=1, value="TOTAL")
-    summary_cell.font = Font(bold=True, size=12)
-    summary_cell.fill = PatternFill(start_color="E7E6E6", end_color="E7E6E6", fill_type="solid")
-    summary_cell.alignment = Alignment(horizontal='center', vertical='center')
-    
-    total_credit_cell = ws.cell(row=row, column=4, value=total_credit)
-    total_credit_cell.number_format = '₹#,##0.00'
-    total_credit_cell.font = Font(bold=True, color="008000", size=12)  # Green for IN
-    total_credit_cell.fill = PatternFill(start_color="E7E6E6", end_color="E7E6E6", fill_type="solid")
-    
-    total_debit_cell = ws.cell(row=row, column=5, value=total_debit)
-    total_debit_cell.number_format = '₹#,##0.00'
-    total_debit_cell.font = Font(bold=True, color="FF0000", size=12)  # Red for OUT
-    total_debit_cell.fill = PatternFill(start_color="E7E6E6", end_color="E7E6E6", fill_type="solid")
-    
-    final_balance = total_credit - total_debit  # Credit - Debit
-    final_balance_cell = ws.cell(row=row, column=6, value=final_balance)
-    final_balance_cell.number_format = '₹#,##0.00'
-    final_balance_cell.font = Font(bold=True, color="0000FF", size=12)
-    final_balance_cell.fill = PatternFill(start_color="E7E6E6", end_color="E7E6E6", fill_type="solid")
-    
-    ws.cell(row=row, column=7, value="")
-    
-    # Apply borders to summary
-    for col in range(1, 8):
-        ws.cell(row=row, column=col).border = border
+    async for entry in iter_daybook_rows(query):
+        credit = entry.get('credit', 0)
+        debit = entry.get('debit', 0)
+        ws.append([
+            styled(entry.get('date', '')),
+            styled(entry.get('description', '')),
+            styled(entry.get('purpose', '')),
+            styled(credit, green_font if credit > 0 else None, number_format='₹#,##0.00'),  # Credit = Money IN = Green
+            styled(debit, red_font if debit > 0 else None, number_format='₹#,##0.00'),  # Debit = Money OUT = Red
+            styled(entry.get('balance', 0) if not purpose else total_credit + credit - total_debit - debit,
+                   blue_font, number_format='₹#,##0.00'),  # Purpose exports run their own net balance
+            styled(entry.get('created_at', ''))
+        ])
+        total_credit += credit
+        total_debit += debit
+    
+    # Summary row: closing balance for a full range, net movement when filtered by purpose
+    final_balance = opening_balance + total_credit - total_debit
+    ws.append([])
+    ws.append([
+        styled("TOTAL", Font(bold=True, size=12), summary_fill, alignment=Alignment(horizontal='center', vertical='center')),
+        styled("", fill=summary_fill),
+        styled("", fill=summary_fill),
+        styled(total_credit, Font(bold=True, color="008000", size=12), summary_fill, '₹#,##0.00'),  # Green for IN
+        styled(total_debit, Font(bold=True, color="FF0000", size=12), summary_fill, '₹#,##0.00'),  # Red for OUT
+        styled(final_balance, Font(bold=True, color="0000FF", size=12), summary_fill, '₹#,##0.00'),
+        styled("")
+    ])
     
-    # Column widths
-    ws.column_dimensions['A'].width = 15
-    ws.column_dimensions['B'].width = 30
-    ws.column_dimensions['C'].width = 25
-    ws.column_dimensions['D'].width = 15
-    ws.column_dimensions['E'].width = 15
-    ws.column_dimensions['F'].width = 15
-    ws.column_dimensions['G'].width = 20
-    
-    excel_buffer = io.BytesIO()
-    wb.save(excel_buffer)
-    excel_buffer.seek(0)
+    excel_buffer = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+    await asyncio.to_thread(wb.save, excel_buffer)
     
     filename = f"daybook_{datetime.now(timezone.utc).strftime('%Y%m%d')}.xlsx"
     
     return StreamingResponse(
-        excel_buffer,
+        iter_file_chunks(excel_buffer),
         media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
         headers={"Content-Disposition": f"attachment; filename={filename}"}
     )
 
 
 @api_router.get("/daybook/export-pdf")
-async def export_daybook_pdf():
-    """Export Day Book to PDF"""
-    entries = await db.daybook.find({}, {"_id": 0}).to_list(length=None)
-    entries.sort(key=lambda x: x['date'])
+async def export_daybook_pdf(start_date: Optional[str] = None, end_date: Optional[str] = None, purpose: Optional[str] = None):
+    """Export Day Book to PDF, optionally limited to a date range and purpose"""
+    query = daybook_range_query(start_date, end_date, purpose)
+    # A purpose-filtered export totals that purpose's movements only, so it has no opening balance
+    with_opening = bool(start_date) and not purpose
+    opening_balance = await get_daybook_opening_balance(query["sort_key"]["$gte"]) if with_opening else 0.0
     
-    pdf_buffer = io.BytesIO()
-    doc = SimpleDocTemplate(pdf_buffer, pagesize=A4, leftMargin=20, rightMargin=20, topMargin=30, bottomMargin=30)
-    elements = []
+    pdf_buffer = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+    writer = PdfPageWriter(pdf_buffer)
     
     styles = getSampleStyleSheet()
     title_style = ParagraphStyle('CustomTitle', parent=styles['Heading1'], fontSize=18,
                                  textColor=colors.HexColor('#1a1a1a'), spaceAfter=15, alignment=TA_CENTER)
     
     # Title
-    title = Paragraph("<b>Day Book - All Transactions</b>", title_style)
-    elements.append(title)
-    elements.append(Spacer(1, 0.2*inch))
+    title = Paragraph(f"<b>{daybook_export_title(start_date, end_date, purpose)}</b>", title_style)
+    await asyncio.to_thread(writer.add, title, 15 + 0.2*inch)
+    
+    header = ['Date', 'Description', 'Purpose', 'Credit (In)', 'Debit (Out)', 'Balance']
+    col_widths = [0.8*inch, 1.8*inch, 1.3*inch, 1*inch, 1*inch, 1*inch]
+    row_style = [
+        # Header row
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#366092')),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, 0), 10),
+        ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
+        ('VALIGN', (0, 0), (-1, 0), 'MIDDLE'),
+        ('BOTTOMPADDING', (0, 0), (-1, 0), 8),
+        ('TOPPADDING', (0, 0), (-1, 0), 8),
+        
+        # Data rows
+        ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
+        ('FONTSIZE', (0, 1), (-1, -1), 8),
+        ('ALIGN', (3, 1), (5, -1), 'RIGHT'),
+        ('VALIGN', (0, 1), (-1, -1), 'MIDDLE'),
+        ('BOTTOMPADDING', (0, 1), (-1, -1), 5),
+        ('TOPPADDING', (0, 1), (-1, -1), 5),
+        
+        # Alternating row colors
+        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#F5F5F5')]),
+        
+        # Grid
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+    ]
+    
+    # Rows are laid out and drawn one fixed-size table at a time, then dropped
+    async def flush(rows):
+        table = Table([header] + rows, colWidths=col_widths, repeatRows=1, style=TableStyle(row_style))
+        await asyncio.to_thread(writer.add, table)
     
-    # Table data
-    table_data = [['Date', 'Description', 'Purpose', 'Credit (In)', 'Debit (Out)', 'Balance']]
+    table_rows = []
+    if with_opening:
+        table_rows.append([start_date[:10], 'Opening Balance', '', '-', '-', f"₹{opening_balance:,.2f}"])
     
     total_credit = 0
     total_debit = 0
     
-    for entry in entries:
+    async for entry in iter_daybook_rows(query):
         date_str = entry.get('date', '')
         if isinstance(date_str, str) and 'T' in date_str:
             date_str = date_str.split('T')[0]
         
         credit_str = f"₹{entry.get('credit', 0):,.2f}" if entry.get('credit', 0) > 0 else "-"
         debit_str = f"₹{entry.get('debit', 0):,.2f}" if entry.get('debit', 0) > 0 else "-"
-        balance_str = f"₹{entry.get('balance', 0):,.2f}"
+        total_credit += entry.get('credit', 0)
+        total_debit += entry.get('debit', 0)
+        # Purpose exports run their own net balance instead of the book-wide one
+        balance = entry.get('balance', 0) if not purpose else total_credit - total_debit
+        balance_str = f"₹{balance:,.2f}"
         
-        table_data.append([
+        table_rows.append([
             date_str,
             entry.get('description', '')[:30],
             entry.get('purpose', '')[:20] or '-',
@@ -3660,140 +5417,103 @@ async def export_daybook_pdf():
             balance_str
         ])
         
-        total_credit += entry.get('credit', 0)
-        total_debit += entry.get('debit', 0)
+        if len(table_rows) >= DAYBOOK_PDF_ROWS_PER_TABLE:
+            await flush(table_rows)
+            table_rows = []
     
-    # Add summary row
-    final_balance = total_credit - total_debit  # Credit - Debit
-    table_data.append([
+    if table_rows:
+        await flush(table_rows)
+    
+    # Summary row: closing balance for a full range, net movement when filtered by purpose
+    final_balance = opening_balance + total_credit - total_debit
+    summary = Table([[
         '',
         'TOTAL',
         '',
         f"₹{total_credit:,.2f}",
         f"₹{total_debit:,.2f}",
         f"₹{final_balance:,.2f}"
-    ])
-    
-    # Create table
-    col_widths = [0.8*inch, 1.8*inch, 1.3*inch, 1*inch, 1*inch, 1*inch]
-    table = Table(table_data, colWidths=col_widths, repeatRows=1)
-    
-    table.setStyle(TableStyle([
-        # Header row
-        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#366092')),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 10),
-        ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
-        ('VALIGN', (0, 0), (-1, 0), 'MIDDLE'),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 8),
-        ('TOPPADDING', (0, 0), (-1, 0), 8),
-        
-        # Data rows
-        ('FONTNAME', (0, 1), (-1, -2), 'Helvetica'),
-        ('FONTSIZE', (0, 1), (-1, -2), 8),
-        ('ALIGN', (3, 1), (5, -1), 'RIGHT'),
-        ('VALIGN', (0, 1), (-1, -1), 'MIDDLE'),
-        ('BOTTOMPADDING', (0, 1), (-1, -1), 5),
-        ('TOPPADDING', (0, 1), (-1, -1), 5),
-        
-        # Alternating row colors
-        ('ROWBACKGROUNDS', (0, 1), (-1, -2), [colors.white, colors.HexColor('#F5F5F5')]),
-        
-        # Summary row
-        ('BACKGROUND', (0, -1), (-1, -1), colors.HexColor('#E7E6E6')),
-        ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, -1), (-1, -1), 10),
-        ('TEXTCOLOR', (3, -1), (3, -1), colors.HexColor('#008000')),
-        ('TEXTCOLOR', (4, -1), (4, -1), colors.HexColor('#FF0000')),
-        ('TEXTCOLOR', (5, -1), (5, -1), colors.HexColor('#0000FF')),
-        
-        # Grid
+    ]], colWidths=col_widths)
+    summary.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#E7E6E6')),
+        ('FONTNAME', (0, 0), (-1, -1), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, -1), 10),
+        ('ALIGN', (3, 0), (5, 0), 'RIGHT'),
+        ('TEXTCOLOR', (3, 0), (3, 0), colors.HexColor('#008000')),
+        ('TEXTCOLOR', (4, 0), (4, 0), colors.HexColor('#FF0000')),
+        ('TEXTCOLOR', (5, 0), (5, 0), colors.HexColor('#0000FF')),
         ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
     ]))
-    
-    elements.append(table)
-    
-    # Build PDF
-    doc.build(elements)
-    pdf_buffer.seek(0)
+    await asyncio.to_thread(writer.add, summary)
+    await asyncio.to_thread(writer.close)
     
     filename = f"daybook_{datetime.now(timezone.utc).strftime('%Y%m%d')}.pdf"
     
     return StreamingResponse(
-        pdf_buffer,
+        iter_file_chunks(pdf_buffer),
         media_type="application/pdf",
         headers={"Content-Disposition": f"attachment; filename={filename}"}
     )
 
 @api_router.delete("/daybook/{entry_id}")
 async def delete_daybook_entry(entry_id: str):
-    """Delete a day book entry and recalculate balances"""
-    # Delete the entry
-    result = await db.daybook.delete_one({"id": entry_id})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Entry not found")
-    
-    # Recalculate all balances
-    all_entries = await db.daybook.find({}, {"_id": 0}).to_list(length=None)
-    all_entries.sort(key=lambda x: x['date'])
-    
-    running_balance = 0.0
-    for entry in all_entries:
-        running_balance += entry['credit'] - entry['debit']  # Bank statement format
-        await db.daybook.update_one(
-            {"id": entry['id']},
-            {"$set": {"balance": running_balance}}
+    """Delete a day book entry and shift the balances that follow it"""
+    async with daybook_write_lock():
+        existing_entry = await db.daybook.find_one({"id": entry_id}, {"_id": 0})
+        if not existing_entry:
+            raise HTTPException(status_code=404, detail="Entry not found")
+        
+        await db.daybook.delete_one({"id": entry_id})
+        
+        sort_key = existing_entry.get('sort_key') or daybook_sort_key(
+            existing_entry['date'], existing_entry.get('created_at', ''), entry_id
         )
+        credit = existing_entry.get('credit', 0)
+        debit = existing_entry.get('debit', 0)
+        await shift_daybook_after(sort_key, debit - credit)
+        await apply_daybook_checkpoint(sort_key[:7], -credit, -debit, -1)
     
     return {"message": "Entry deleted and balances recalculated"}
 
 
 @api_router.put("/daybook/{entry_id}", response_model=DayBookEntry)
 async def update_daybook_entry(entry_id: str, entry_data: DayBookEntryCreate):
-    """Update a day book entry and recalculate all balances"""
-    # Check if entry exists
-    existing_entry = await db.daybook.find_one({"id": entry_id}, {"_id": 0})
-    if not existing_entry:
-        raise HTTPException(status_code=404, detail="Entry not found")
-    
-    # Parse date
-    entry_date = datetime.fromisoformat(entry_data.date.replace('Z', '+00:00'))
-    
-    # Update the entry (without balance for now)
-    update_data = {
-        "date": entry_date.isoformat(),
-        "description": entry_data.description,
-        "purpose": entry_data.purpose,
-        "debit": entry_data.debit,
-        "credit": entry_data.credit
-    }
+    """Update a day book entry; only rows after the old and new positions in their months are touched"""
+    entry_date = parse_entry_date(entry_data.date)
     
-    await db.daybook.update_one(
-        {"id": entry_id},
-        {"$set": update_data}
-    )
-    
-    # Recalculate all balances in chronological order
-    all_entries = await db.daybook.find({}, {"_id": 0}).to_list(length=None)
-    all_entries.sort(key=lambda x: x['date'])
-    
-    running_balance = 0.0
-    for entry in all_entries:
-        running_balance += entry['credit'] - entry['debit']  # Bank statement format
-        await db.daybook.update_one(
-            {"id": entry['id']},
-            {"$set": {"balance": running_balance}}
+    async with daybook_write_lock():
+        existing_entry = await db.daybook.find_one({"id": entry_id}, {"_id": 0})
+        if not existing_entry:
+            raise HTTPException(status_code=404, detail="Entry not found")
+        
+        old_key = existing_entry.get('sort_key') or daybook_sort_key(
+            existing_entry['date'], existing_entry.get('created_at', ''), entry_id
         )
-    
-    # Get updated entry
-    updated_entry = await db.daybook.find_one({"id": entry_id}, {"_id": 0})
-    if isinstance(updated_entry.get('date'), str):
-        updated_entry['date'] = datetime.fromisoformat(updated_entry['date'])
-    if isinstance(updated_entry.get('created_at'), str):
-        updated_entry['created_at'] = datetime.fromisoformat(updated_entry['created_at'])
-    
-    return updated_entry
+        old_credit = existing_entry.get('credit', 0)
+        old_debit = existing_entry.get('debit', 0)
+        new_key = daybook_sort_key(entry_date, existing_entry.get('created_at', ''), entry_id)
+        
+        # Take the old amounts out at the old position...
+        await shift_daybook_after(old_key, old_debit - old_credit, exclude_id=entry_id)
+        await apply_daybook_checkpoint(old_key[:7], -old_credit, -old_debit, -1)
+        
+        # ...and put the new amounts in at the new position
+        net = entry_data.credit - entry_data.debit
+        update_data = {
+            "date": entry_date.isoformat(),
+            "description": entry_data.description,
+            "purpose": entry_data.purpose,
+            "debit": entry_data.debit,
+            "credit": entry_data.credit,
+            "month_balance": await get_month_balance_before(new_key, exclude_id=entry_id) + net,
+            "sort_key": new_key
+        }
+        await db.daybook.update_one({"id": entry_id}, {"$set": update_data})
+        await shift_daybook_after(new_key, net, exclude_id=entry_id)
+        await apply_daybook_checkpoint(new_key[:7], entry_data.credit, entry_data.debit, 1)
+        
+        updated_entry = await db.daybook.find_one({"id": entry_id}, {"_id": 0})
+    return parse_daybook_entry((await add_daybook_balances([updated_entry]))[0])
 
 
 
@@ -4074,11 +5794,17 @@ async def create_credit_note(cn_data: CreditNoteCreate):
         igst_amount=totals['igst_amount'], total_gst=totals['total_gst'],
         credit_amount=totals['grand_total'], stock_restored=True
     )
-    await restore_stock_on_return(cn_data.items)
     doc = cn_obj.model_dump()
     doc['credit_note_date'] = doc['credit_note_date'].isoformat()
     doc['created_at'] = doc['created_at'].isoformat()
-    await db.credit_notes.insert_one(doc)
+    
+    async def post_credit_note(session):
+        await restore_stock_on_return(cn_data.items, session=session,
+                                      source_id=cn_obj.id, source_number=cn_number,
+                                      occurred_at=cn_obj.credit_note_date)
+        await db.credit_notes.insert_one(dict(doc), session=session)
+    
+    await run_transaction(post_credit_note)
     return cn_obj
 
 @api_router.get("/credit-notes", response_model=List[CreditNote])
@@ -4110,15 +5836,18 @@ async def delete_credit_note(cn_id: str):
     if not cn:
         raise HTTPException(status_code=404, detail="Credit note not found")
     
-    # If stock was restored, reverse it
-    if cn.get('stock_restored'):
-        for item in cn.get('items', []):
-            await db.products.update_one(
-                {"id": item['product_id']},
-                {"$inc": {"stock_quantity": -item['quantity']}}
-            )
-    
-    result = await db.credit_notes.delete_one({"id": cn_id})
+    # If stock was restored, reverse it in the same transaction as the delete
+    async def remove_credit_note(session):
+        if cn.get('stock_restored'):
+            await apply_stock_movements([
+                stock_movement("product", item['product_id'], -item['quantity'], "credit_note_delete",
+                               cn_id, cn.get('credit_note_number', ''), item.get('product_name', ''),
+                               occurred_at=cn.get('credit_note_date'))
+                for item in cn.get('items', [])
+            ], session=session)
+        await db.credit_notes.delete_one({"id": cn_id}, session=session)
+    
+    await run_transaction(remove_credit_note)
     return {"message": "Credit note deleted successfully"}
 
 
@@ -4144,18 +5873,17 @@ async def get_sales_report(
     
     total_sales = sum(inv.get('grand_total', 0) for inv in invoices)
     
+    # Every sold line through the tax engine in one pass
+    all_items = [item for inv in invoices for item in inv.get('items', [])]
+    line_taxes = calculate_totals_batch([(all_items, False, "percentage", 0.0)], include_lines=True)[0]['lines']
+    
     product_sales = {}
-    for inv in invoices:
-        for item in inv.get('items', []):
-            pid = item['product_id']
-            if pid not in product_sales:
-                product_sales[pid] = {"product_name": item['product_name'], "quantity_sold": 0, "total_revenue": 0}
-            item_total = item['quantity'] * item['price']
-            item_discount = item_total * (item.get('discount_percent', 0) / 100)
-            item_taxable = item_total - item_discount
-            item_gst = item_taxable * (item.get('gst_rate', 0) / 100)
-            product_sales[pid]["quantity_sold"] += item['quantity']
-            product_sales[pid]["total_revenue"] += item_taxable + item_gst
+    for item, line_tax in zip(all_items, line_taxes):
+        pid = item['product_id']
+        if pid not in product_sales:
+            product_sales[pid] = {"product_name": item['product_name'], "quantity_sold": 0, "total_revenue": 0}
+        product_sales[pid]["quantity_sold"] += item['quantity']
+        product_sales[pid]["total_revenue"] += line_tax['taxable'] + line_tax['gst']
     
     return {
         "summary": {"total_invoices": len(invoices), "total_sales": round(total_sales, 2)},
@@ -4163,6 +5891,116 @@ async def get_sales_report(
         "invoices": invoices
     }
 
+async def ensure_invoice_hsn_summary():
+    """Index invoices by date for period reports and store the HSN breakdown on invoices saved before it was kept"""
+    await db.invoices.create_index("invoice_date")
+    
+    query = {"hsn_summary": {"$exists": False}}
+    projection = {"_id": 0, "id": 1, "items": 1, "is_interstate": 1,
+                  "overall_discount_type": 1, "overall_discount_value": 1}
+    while True:
+        invoices = await db.invoices.find(query, projection).limit(IMPORT_CHUNK_SIZE).to_list(IMPORT_CHUNK_SIZE)
+        if not invoices:
+            break
+        all_totals = calculate_totals_batch([
+            (inv.get('items', []), inv.get('is_interstate', False),
+             inv.get('overall_discount_type'), inv.get('overall_discount_value'))
+            for inv in invoices
+        ], include_lines=True)
+        await db.invoices.bulk_write([
+            UpdateOne({"id": inv['id']}, {"$set": {"hsn_summary": hsn_tax_summary(inv.get('items', []), totals['lines'])}})
+            for inv, totals in zip(invoices, all_totals)
+        ], ordered=False)
+
+
+@api_router.get("/reports/gst/hsn-summary")
+async def get_gst_hsn_summary(
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None
+):
+    """Taxable value and CGST/SGST/IGST by HSN code, GST rate and unit for a period, plus the
+    B2B (customer has a GSTIN) / B2C split by GST rate. Aggregated from the breakdown stored on each invoice."""
+    query = {}
+    if start_date or end_date:
+        query['invoice_date'] = {}
+        if start_date:
+            query['invoice_date']['$gte'] = start_date
+        if end_date:
+            # A plain date includes the whole day
+            query['invoice_date']['$lte'] = end_date + "T23:59:59.999999" if len(end_date) == 10 else end_date
+    
+    amount_sums = {
+        field: {"$sum": f"$hsn_summary.{field}"}
+        for field in ("quantity", "taxable_amount", "cgst_amount", "sgst_amount", "igst_amount", "total_gst", "total_value")
+    }
+    pipeline = [
+        {"$match": query},
+        {"$project": {
+            "_id": 0,
+            "is_interstate": 1,
+            "hsn_summary": 1,
+            "customer_type": {"$cond": [{"$in": [{"$ifNull": ["$customer_gst", ""]}, ["", None]]}, "B2C", "B2B"]}
+        }},
+        {"$unwind": {"path": "$hsn_summary", "includeArrayIndex": "line_index"}},
+        {"$facet": {
+            "hsn": [
+                {"$group": {
+                    "_id": {"hsn_code": "$hsn_summary.hsn_code", "gst_rate": "$hsn_summary.gst_rate", "unit": "$hsn_summary.unit"},
+                    **amount_sums
+                }},
+                {"$sort": {"_id.hsn_code": 1, "_id.gst_rate": 1, "_id.unit": 1}}
+            ],
+            "customer_types": [
+                {"$group": {
+                    "_id": {"customer_type": "$customer_type", "gst_rate": "$hsn_summary.gst_rate",
+                            "is_interstate": "$is_interstate"},
+                    **amount_sums
+                }},
+                {"$sort": {"_id.customer_type": 1, "_id.gst_rate": 1, "_id.is_interstate": 1}}
+            ],
+            # Each invoice once, through its first breakdown line
+            "invoice_counts": [
+                {"$match": {"line_index": 0}},
+                {"$group": {"_id": "$customer_type", "count": {"$sum": 1}}}
+            ]
+        }}
+    ]
+    facets = (await db.invoices.aggregate(pipeline).to_list(1))
+    facets = facets[0] if facets else {"hsn": [], "customer_types": [], "invoice_counts": []}
+    invoice_counts = {row['_id']: row['count'] for row in facets['invoice_counts']}
+    
+    def amounts(row):
+        return {
+            "quantity": round(row['quantity'], 3),
+            **{field: round(row[field], 2) for field in
+               ("taxable_amount", "cgst_amount", "sgst_amount", "igst_amount", "total_gst", "total_value")}
+        }
+    
+    hsn_rows = [{**row['_id'], **amounts(row)} for row in facets['hsn']]
+    customer_type_rows = [{**row['_id'], **amounts(row)} for row in facets['customer_types']]
+    
+    split = {}
+    for customer_type in ("B2B", "B2C"):
+        rows = [row for row in customer_type_rows if row['customer_type'] == customer_type]
+        split[customer_type] = {
+            field: round(sum(row[field] for row in rows), 2)
+            for field in ("taxable_amount", "cgst_amount", "sgst_amount", "igst_amount", "total_gst", "total_value")
+        }
+        split[customer_type]['invoice_count'] = invoice_counts.get(customer_type, 0)
+        split[customer_type]['by_rate'] = rows
+    
+    return {
+        "start_date": start_date,
+        "end_date": end_date,
+        "hsn_summary": hsn_rows,
+        "b2b": split["B2B"],
+        "b2c": split["B2C"],
+        "totals": {
+            field: round(sum(row[field] for row in hsn_rows), 2)
+            for field in ("taxable_amount", "cgst_amount", "sgst_amount", "igst_amount", "total_gst", "total_value")
+        }
+    }
+
 @api_router.get("/reports/customer-ledger/{customer_id}")
 async def get_customer_ledger(customer_id: str):
     """Get customer ledger with invoices, credit notes, payments, and journal entries"""
@@ -4536,6 +6374,7 @@ async def get_dashboard_stats():
     
     total_products = await db.products.count_documents({})
     total_customers = await db.customers.count_documents({})
+    low_stock_items = await db.reorder_list.count_documents({})
     
     return {
         "total_invoices": total_invoices,
@@ -4544,7 +6383,8 @@ async def get_dashboard_stats():
         "total_products": total_products,
         "total_customers": total_customers,
         "paid_invoices": len([inv for inv in invoices if inv.get('payment_status') == 'paid']),
-        "unpaid_invoices": len(unpaid_invoices)
+        "unpaid_invoices": len(unpaid_invoices),
+        "low_stock_items": low_stock_items
     }
 
 
@@ -4552,15 +6392,208 @@ async def get_dashboard_stats():
 
 # ========== BOM ROUTES ==========
 
+async def load_bom_graph(product_ids, overrides: dict = None) -> dict:
+    """BOM lines for the given products and every sub-assembly below them, one query per level.
+    overrides holds lines that replace the stored ones (a BOM that is about to be saved)."""
+    boms = dict(overrides or {})
+    expanded = set()
+    frontier = set(product_ids)
+    while frontier:
+        missing = [product_id for product_id in frontier if product_id not in boms]
+        if missing:
+            async for bom in db.boms.find(
+                {"product_id": {"$in": missing}}, {"_id": 0, "product_id": 1, "materials": 1}
+            ).sort("created_at", 1):
+                boms.setdefault(bom['product_id'], bom.get('materials', []))
+        expanded |= frontier
+        frontier = {
+            child for product_id in frontier
+            for child in sub_assembly_ids(boms.get(product_id, []))
+        } - expanded
+    return boms
+
+
+async def get_bom_explosions(product_ids) -> dict:
+    """Flattened per-unit requirements for each product that has a BOM.
+    Served from bom_explosions; products not cached yet are exploded and stored,
+    together with the sub-assemblies flattened on the way."""
+    product_ids = list(set(product_ids))
+    explosions = {}
+    async for cached in db.bom_explosions.find({"product_id": {"$in": product_ids}}, {"_id": 0}):
+        explosions[cached['product_id']] = cached['materials']
+    
+    missing = [product_id for product_id in product_ids if product_id not in explosions]
+    if not missing:
+        return explosions
+    
+    boms = await load_bom_graph(missing)
+    memo = {}
+    for product_id in missing:
+        if product_id in boms:
+            flatten_bom(product_id, boms, memo)
+    
+    now = datetime.now(timezone.utc).isoformat()
+    operations = []
+    for product_id, totals in memo.items():
+        lines = [
+            {"material_type": item_type, "material_id": item_id, **line}
+            for (item_type, item_id), line in totals.items()
+        ]
+        if product_id in missing:
+            explosions[product_id] = lines
+        operations.append(UpdateOne(
+            {"product_id": product_id}, {"$set": {"materials": lines, "computed_at": now}}, upsert=True
+        ))
+    if operations:
+        await db.bom_explosions.bulk_write(operations, ordered=False)
+    return explosions
+
+
+async def get_bom_ancestors(product_ids) -> set:
+    """The given products plus every product that uses them, directly or through other sub-assemblies"""
+    affected = set(product_ids)
+    frontier = set(product_ids)
+    while frontier:
+        parents = set(await db.boms.distinct("product_id", {
+            "materials": {"$elemMatch": {"material_type": "product", "material_id": {"$in": list(frontier)}}}
+        }))
+        frontier = parents - affected
+        affected |= frontier
+    return affected
+
+
+async def invalidate_bom_explosions(product_id: str) -> set:
+    """Drop the cached explosion of a product and of its ancestors; returns the affected product ids"""
+    affected = await get_bom_ancestors([product_id])
+    await db.bom_explosions.delete_many({"product_id": {"$in": list(affected)}})
+    return affected
+
+
+# Standard cost bases: cheapest and average supplier quote, net cost of the latest purchase invoice line
+PRODUCT_COST_BASES = ("cheapest", "average", "last_purchased")
+
+
+async def refresh_product_costs(product_ids):
+    """Recompute the materialized standard cost of the given products from their flattened BOM:
+    cheapest and average supplier quote, and what the material last cost on a purchase invoice"""
+    product_ids = list(set(product_ids))
+    if not product_ids:
+        return
+    
+    explosions = await get_bom_explosions(product_ids)
+    material_ids = list({
+        line['material_id'] for lines in explosions.values() for line in lines if line['material_type'] != "product"
+    })
+    prices = {}
+    last_purchased = {}
+    if material_ids:
+        pipeline = [
+            {"$match": {"material_id": {"$in": material_ids}}},
+            {"$group": {
+                "_id": "$material_id",
+                "cheapest": {"$min": "$price"},
+                "average": {"$avg": "$price"}
+            }}
+        ]
+        async for row in db.supplier_prices.aggregate(pipeline):
+            prices[row['_id']] = row
+        purchase_pipeline = [
+            {"$match": {"items.item_id": {"$in": material_ids}}},
+            {"$unwind": "$items"},
+            {"$match": {"items.item_id": {"$in": material_ids}}},
+            {"$sort": {"invoice_date": 1, "created_at": 1}},
+            {"$group": {
+                "_id": "$items.item_id",
+                "price": {"$last": "$items.price"},
+                "discount_percent": {"$last": "$items.discount_percent"}
+            }}
+        ]
+        async for row in db.purchase_invoices.aggregate(purchase_pipeline):
+            last_purchased[row['_id']] = row['price'] * (1 - (row.get('discount_percent') or 0) / 100)
+    
+    now = datetime.now(timezone.utc).isoformat()
+    operations = []
+    for product_id, lines in explosions.items():
+        costs = dict.fromkeys(PRODUCT_COST_BASES, 0.0)
+        unpriced = []
+        unpurchased = []
+        for line in lines:
+            price = prices.get(line['material_id'])
+            if price is None:
+                unpriced.append(line['material_id'])
+            else:
+                costs['cheapest'] += line['quantity'] * price['cheapest']
+                costs['average'] += line['quantity'] * price['average']
+            if line['material_id'] in last_purchased:
+                costs['last_purchased'] += line['quantity'] * last_purchased[line['material_id']]
+            else:
+                unpurchased.append(line['material_id'])
+        operations.append(UpdateOne({"product_id": product_id}, {"$set": {
+            **{f"{basis}_cost": round(cost, 4) for basis, cost in costs.items()},
+            "unpriced_materials": unpriced,
+            "unpurchased_materials": unpurchased,
+            "computed_at": now
+        }}, upsert=True))
+    if operations:
+        await db.product_costs.bulk_write(operations, ordered=False)
+    
+    without_bom = [product_id for product_id in product_ids if product_id not in explosions]
+    if without_bom:
+        await db.product_costs.delete_many({"product_id": {"$in": without_bom}})
+
+
+async def refresh_costs_for_material(material_id: str):
+    """Re-roll the cost of every product whose BOM tree contains the material"""
+    users = await db.boms.distinct("product_id", {"materials.material_id": material_id})
+    if users:
+        await refresh_product_costs(await get_bom_ancestors(users))
+
+
+async def validate_bom_structure(product_id: str, materials: list):
+    """Reject a BOM whose sub-assemblies lead back to its own product"""
+    boms = await load_bom_graph([product_id], overrides={product_id: materials})
+    cycle = find_bom_cycle(product_id, boms)
+    if cycle:
+        names = {
+            p['id']: p.get('name', p['id'])
+            async for p in db.products.find({"id": {"$in": cycle}}, {"_id": 0, "id": 1, "name": 1})
+        }
+        raise HTTPException(
+            status_code=400,
+            detail=f"BOM would be circular: {' -> '.join(names.get(pid, pid) for pid in cycle)}"
+        )
+
+
+async def ensure_bom_explosions():
+    """Index BOM lookups and start with an empty explosion cache, rebuilt on demand"""
+    await db.boms.create_index("product_id")
+    await db.boms.create_index("materials.material_id")
+    await db.bom_explosions.create_index("product_id", unique=True)
+    await db.bom_explosions.delete_many({})
+
+
+async def ensure_product_costs():
+    """Index the product cost rollup and recompute it for every product with a BOM"""
+    await db.product_costs.create_index("product_id", unique=True)
+    await db.supplier_prices.create_index([("material_id", 1), ("updated_at", 1)])
+    await db.purchase_invoices.create_index("items.item_id")
+    product_ids = await db.boms.distinct("product_id")
+    await db.product_costs.delete_many({"product_id": {"$nin": product_ids}})
+    for start in range(0, len(product_ids), DAYBOOK_BATCH_SIZE):
+        await refresh_product_costs(product_ids[start:start + DAYBOOK_BATCH_SIZE])
+
+
 @api_router.post("/bom", response_model=BOM)
 async def create_bom(bom: BOMCreate):
     """Create a new BOM for a product"""
+    await validate_bom_structure(bom.product_id, [m.model_dump() for m in bom.materials])
     bom_data = bom.model_dump()
     bom_data['id'] = str(uuid4())
     bom_data['created_at'] = datetime.now(timezone.utc).isoformat()
     bom_data['updated_at'] = datetime.now(timezone.utc).isoformat()
     
     await db.boms.insert_one(bom_data)
+    await refresh_product_costs(await invalidate_bom_explosions(bom.product_id))
     return bom_data
 
 @api_router.get("/bom", response_model=List[BOM])
@@ -4577,6 +6610,35 @@ async def get_bom_by_product(product_id: str):
         raise HTTPException(status_code=404, detail="BOM not found for this product")
     return bom
 
+@api_router.get("/bom/product/{product_id}/explosion")
+async def get_bom_explosion(product_id: str, quantity: float = 1.0):
+    """Raw and packing materials needed for a quantity of a product, through all sub-assembly levels"""
+    explosions = await get_bom_explosions([product_id])
+    if product_id not in explosions:
+        raise HTTPException(status_code=404, detail="BOM not found for this product")
+    return {
+        "product_id": product_id,
+        "quantity": quantity,
+        "materials": [
+            {**line, "quantity": line['quantity'] * quantity}
+            for line in explosions[product_id]
+        ]
+    }
+
+@api_router.get("/bom/product/{product_id}/cost")
+async def get_product_cost(product_id: str):
+    """Materialized standard cost of a product from its BOM rollup"""
+    cost = await db.product_costs.find_one({"product_id": product_id}, {"_id": 0})
+    if not cost:
+        raise HTTPException(status_code=404, detail="No BOM cost for this product")
+    return cost
+
+@api_router.get("/product-costs")
+async def get_product_costs():
+    """Materialized standard costs of all products that have a BOM"""
+    costs = await db.product_costs.find({}, {"_id": 0}).to_list(length=None)
+    return costs
+
 @api_router.get("/bom/{bom_id}", response_model=BOM)
 async def get_bom(bom_id: str):
     """Get a specific BOM"""
@@ -4591,6 +6653,12 @@ async def update_bom(bom_id: str, bom_update: BOMUpdate):
     update_data = {k: v for k, v in bom_update.model_dump().items() if v is not None}
     update_data['updated_at'] = datetime.now(timezone.utc).isoformat()
     
+    existing = await db.boms.find_one({"id": bom_id}, {"_id": 0, "product_id": 1})
+    if not existing:
+        raise HTTPException(status_code=404, detail="BOM not found")
+    if 'materials' in update_data:
+        await validate_bom_structure(existing['product_id'], update_data['materials'])
+    
     result = await db.boms.update_one(
         {"id": bom_id},
         {"$set": update_data}
@@ -4598,6 +6666,8 @@ async def update_bom(bom_id: str, bom_update: BOMUpdate):
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="BOM not found")
+    if 'materials' in update_data:
+        await refresh_product_costs(await invalidate_bom_explosions(existing['product_id']))
     
     updated_bom = await db.boms.find_one({"id": bom_id}, {"_id": 0})
     return updated_bom
@@ -4605,12 +6675,193 @@ async def update_bom(bom_id: str, bom_update: BOMUpdate):
 @api_router.delete("/bom/{bom_id}")
 async def delete_bom(bom_id: str):
     """Delete a BOM"""
-    result = await db.boms.delete_one({"id": bom_id})
-    if result.deleted_count == 0:
+    deleted = await db.boms.find_one_and_delete({"id": bom_id}, projection={"_id": 0, "product_id": 1})
+    if deleted is None:
         raise HTTPException(status_code=404, detail="BOM not found")
+    await refresh_product_costs(await invalidate_bom_explosions(deleted['product_id']))
     return {"message": "BOM deleted successfully"}
 
 
+# ========== MRP ROUTES ==========
+
+# Purchase orders in these states will not bring in any more stock
+CLOSED_PO_STATUSES = ["received", "cancelled", "completed"]
+
+
+async def run_mrp() -> dict:
+    """Plan material purchases for every approved sales order that has not been produced yet.
+    Reads each collection once; the netting itself is array math indexed by product / material."""
+    orders = await db.sales_orders.find(
+        {
+            "approval_status": "approved",
+            "production_status": {"$ne": "completed"},
+            "so_status": {"$nin": ["invoiced", "cancelled", "rejected"]}
+        },
+        {"_id": 0, "id": 1, "items.product_id": 1, "items.product_name": 1, "items.quantity": 1}
+    ).to_list(length=None)
+    
+    products = ArrayIndex()
+    product_names = {}
+    demand_ids, demand_quantities = [], []
+    for order in orders:
+        for item in order.get('items', []):
+            demand_ids.append(item['product_id'])
+            demand_quantities.append(item.get('quantity', 0))
+            product_names.setdefault(item['product_id'], item.get('product_name', ''))
+    demand_positions = products.lookup(demand_ids)
+    
+    # Direct BOM lines of every product down the tree: sub-assembly lines are netted against the
+    # sub-assembly's own stock level by level, material lines go to purchasing
+    boms = await load_bom_graph(products.keys)
+    materials = ArrayIndex()
+    material_info = {}
+    sub_parents, sub_children, sub_quantities = [], [], []
+    bom_products, bom_materials, bom_quantities = [], [], []
+    for product_id, lines in boms.items():
+        parent = products.add(product_id)
+        for line in lines:
+            if line.get('material_type') == "product":
+                sub_parents.append(parent)
+                sub_children.append(products.add(line['material_id']))
+                sub_quantities.append(line['quantity'])
+                product_names.setdefault(line['material_id'], line.get('material_name', ''))
+            elif line.get('material_type') in MATERIAL_ITEM_TYPES:
+                key = (MATERIAL_ITEM_TYPES[line['material_type']], line['material_id'])
+                bom_products.append(parent)
+                bom_materials.append(materials.add(key))
+                bom_quantities.append(line['quantity'])
+                material_info.setdefault(key, {"material_name": line.get('material_name', ''),
+                                               "unit": line.get('unit', '')})
+    
+    product_stock_by_id = {
+        p['id']: p.get('stock_quantity', 0)
+        async for p in db.products.find({"id": {"$in": products.keys}}, {"_id": 0, "id": 1, "stock_quantity": 1})
+    }
+    
+    material_stock = {}
+    purchase_prices = {}
+    for item_type in {item_type for item_type, _ in materials.keys}:
+        ids = [item_id for (key_type, item_id) in materials.keys if key_type == item_type]
+        async for material in db[STOCK_COLLECTIONS[item_type]].find(
+            {"id": {"$in": ids}}, {"_id": 0, "id": 1, "name": 1, "unit": 1, "stock_quantity": 1, "purchase_price": 1}
+        ):
+            key = (item_type, material['id'])
+            material_stock[key] = material.get('stock_quantity', 0)
+            purchase_prices[key] = material.get('purchase_price', 0)
+            material_info[key] = {"material_name": material.get('name', ''), "unit": material.get('unit', '')}
+    
+    # Open purchase orders: quantity still to arrive per material. Request-generated POs
+    # carry material_id/material_type on their items, manual ones item_id/item_type.
+    on_order_pipeline = [
+        {"$match": {"status": {"$nin": CLOSED_PO_STATUSES}}},
+        {"$unwind": "$items"},
+        {"$group": {
+            "_id": {
+                "item_type": {"$ifNull": ["$items.item_type", "$items.material_type"]},
+                "item_id": {"$ifNull": ["$items.item_id", "$items.material_id"]}
+            },
+            "quantity": {"$sum": "$items.quantity"}
+        }}
+    ]
+    on_order_by_key = {}
+    async for row in db.purchase_orders.aggregate(on_order_pipeline):
+        item_type = MATERIAL_ITEM_TYPES.get(row['_id']['item_type'], row['_id']['item_type'])
+        on_order_by_key[(item_type, row['_id']['item_id'])] = row['quantity']
+    
+    demand = sum_by_index(demand_positions, demand_quantities, len(products))
+    product_stock = np.array([product_stock_by_id.get(pid, 0) for pid in products.keys], dtype=np.float64)
+    material_on_hand = np.array([material_stock.get(key, 0) for key in materials.keys], dtype=np.float64)
+    material_on_order = np.array([on_order_by_key.get(key, 0) for key in materials.keys], dtype=np.float64)
+    
+    requirement, to_produce, gross_requirement, shortage = net_requirements(
+        demand, product_stock,
+        np.array(sub_parents, dtype=np.int64), np.array(sub_children, dtype=np.int64),
+        np.array(sub_quantities, dtype=np.float64),
+        np.array(bom_products, dtype=np.int64), np.array(bom_materials, dtype=np.int64),
+        np.array(bom_quantities, dtype=np.float64),
+        material_on_hand, material_on_order
+    )
+    
+    production_plan = [
+        {
+            "product_id": product_id,
+            "product_name": product_names.get(product_id, ''),
+            "demand": float(demand[i]),
+            "dependent_demand": round(float(requirement[i] - demand[i]), 3),
+            "stock_quantity": float(product_stock[i]),
+            "to_produce": round(float(to_produce[i]), 3),
+            "has_bom": product_id in boms
+        }
+        for i, product_id in enumerate(products.keys)
+        if requirement[i] > 0
+    ]
+    
+    short_positions = np.flatnonzero(shortage > 0)
+    short_keys = [materials.keys[i] for i in short_positions]
+    cheapest = await get_cheapest_supplier_prices([item_id for _, item_id in short_keys])
+    
+    shortages = []
+    request_items = []
+    for i, key in zip(short_positions, short_keys):
+        item_type, item_id = key
+        supplier = cheapest.get(item_id, {})
+        unit_cost = supplier.get('price', purchase_prices.get(key, 0)) or 0
+        quantity = round(float(shortage[i]), 3)
+        shortages.append({
+            "material_type": item_type,
+            "material_id": item_id,
+            **material_info.get(key, {"material_name": "", "unit": ""}),
+            "gross_requirement": round(float(gross_requirement[i]), 3),
+            "stock_quantity": float(material_on_hand[i]),
+            "on_order": float(material_on_order[i]),
+            "shortage": quantity,
+            "cheapest_supplier_id": supplier.get('supplier_id'),
+            "cheapest_supplier_name": supplier.get('supplier_name'),
+            "lead_time_days": supplier.get('lead_time_days')
+        })
+        request_items.append({
+            "material_type": item_type,
+            "material_id": item_id,
+            "material_name": material_info.get(key, {}).get('material_name', ''),
+            "unit": material_info.get(key, {}).get('unit', ''),
+            "quantity": quantity,
+            "estimated_cost": round(quantity * unit_cost, 2)
+        })
+    shortages.sort(key=lambda x: (x['material_type'], x['material_name']))
+    
+    return {
+        "run_at": datetime.now(timezone.utc).isoformat(),
+        "sales_orders": len(orders),
+        "production_plan": production_plan,
+        "products_without_bom": [p['product_id'] for p in production_plan if p['to_produce'] > 0 and not p['has_bom']],
+        "shortages": shortages,
+        "suggested_purchase_request": {
+            "items": request_items,
+            "total_estimated_cost": round(sum(item['estimated_cost'] for item in request_items), 2)
+        }
+    }
+
+
+@api_router.post("/mrp/run")
+async def run_mrp_plan(run_data: dict = None):
+    """Run MRP over all approved, unproduced sales orders.
+    Pass {"create_purchase_request": true, "requested_by": "..."} to raise the suggested purchase request."""
+    run_data = run_data or {}
+    result = await run_mrp()
+    result['purchase_request'] = None
+    
+    suggestion = result['suggested_purchase_request']
+    if run_data.get("create_purchase_request") and suggestion['items']:
+        result['purchase_request'] = await create_purchase_request(PurchaseRequestCreate(
+            requested_by=run_data.get("requested_by", "MRP"),
+            items=suggestion['items'],
+            total_estimated_cost=suggestion['total_estimated_cost'],
+            notes=f"Generated by MRP run at {result['run_at']} for {result['sales_orders']} sales orders"
+        ))
+    
+    return result
+
+
 # ========== PRODUCTION ORDER ROUTES ==========
 
 @api_router.post("/production-orders", response_model=ProductionOrder)
@@ -4782,49 +7033,106 @@ async def start_production(order_id: str):
     updated_order = await db.production_orders.find_one({"id": order_id}, {"_id": 0})
     return updated_order
 
+async def complete_production_orders(order_ids: List[str], session=None) -> dict:
+    """Complete in-progress production orders together.
+    The status precondition is part of the claim update, so an order completes at most once;
+    material consumption and finished goods for every claimed order go out as one bulk_write per collection."""
+    now = datetime.now(timezone.utc).isoformat()
+    completed_fields = {"status": "completed", "completion_date": now, "updated_at": now}
+    
+    orders = await db.production_orders.find({"id": {"$in": order_ids}}, {"_id": 0}, session=session).to_list(length=None)
+    found = {order['id']: order for order in orders}
+    skipped = [{"id": order_id, "reason": "Production order not found"} for order_id in order_ids if order_id not in found]
+    ready = []
+    for order in orders:
+        if order['status'] == 'in_progress':
+            ready.append(order)
+        else:
+            skipped.append({"id": order['id'], "reason": "Production must be in progress to complete"})
+    
+    if session is not None:
+        if ready:
+            result = await db.production_orders.bulk_write([
+                UpdateOne({"id": order['id'], "status": "in_progress"}, {"$set": completed_fields})
+                for order in ready
+            ], ordered=False, session=session)
+            if result.modified_count != len(ready):
+                raise HTTPException(status_code=409, detail="Production order changed while completing, please retry")
+        claimed = ready
+    else:
+        # Without a transaction each claim has to be atomic on its own
+        claimed = []
+        for order in ready:
+            result = await db.production_orders.update_one(
+                {"id": order['id'], "status": "in_progress"},
+                {"$set": completed_fields}
+            )
+            if result.modified_count:
+                claimed.append(order)
+            else:
+                skipped.append({"id": order['id'], "reason": "Production order already completed"})
+    
+    # Deduct materials from stock and add finished goods to product stock
+    movements = []
+    for order in claimed:
+        movements.extend(
+            stock_movement(BOM_ITEM_TYPES[material['material_type']], material['material_id'],
+                           -material['required_quantity'], "production_consume",
+                           order['id'], order.get('order_number', ''), material.get('material_name', ''))
+            for material in order.get('materials_required', [])
+            if material['material_type'] in BOM_ITEM_TYPES
+        )
+        movements.append(stock_movement("product", order['product_id'], order['quantity_to_produce'],
+                                        "production_output", order['id'], order.get('order_number', ''),
+                                        order.get('product_name', '')))
+    await apply_stock_movements(movements, session=session)
+    
+    # Linked sales orders are produced once none of their production orders are still open
+    sales_order_ids = list({order['sales_order_id'] for order in claimed if order.get('sales_order_id')})
+    if sales_order_ids:
+        still_open = await db.production_orders.distinct(
+            "sales_order_id",
+            {"sales_order_id": {"$in": sales_order_ids}, "status": {"$ne": "completed"}},
+            session=session
+        )
+        produced = [so_id for so_id in sales_order_ids if so_id not in still_open]
+        if produced:
+            await db.sales_orders.update_many(
+                {"id": {"$in": produced}},
+                {"$set": {"production_status": "completed"}},
+                session=session
+            )
+    
+    return {"completed": [order['id'] for order in claimed], "skipped": skipped}
+
+
+@api_router.post("/production-orders/complete-batch")
+async def complete_production_batch(batch_data: dict):
+    """Complete many in-progress production orders in one transaction"""
+    order_ids = list(dict.fromkeys(batch_data.get("order_ids", [])))
+    if not order_ids:
+        raise HTTPException(status_code=400, detail="order_ids is required")
+    
+    return await run_transaction(lambda session: complete_production_orders(order_ids, session))
+
+
 @api_router.post("/production-orders/{order_id}/complete")
 async def complete_production(order_id: str):
     """Complete production - deduct materials and add finished goods to stock"""
-    order = await db.production_orders.find_one({"id": order_id}, {"_id": 0})
+    order = await db.production_orders.find_one({"id": order_id}, {"_id": 0, "status": 1})
     if not order:
         raise HTTPException(status_code=404, detail="Production order not found")
     
     if order['status'] != 'in_progress':
         raise HTTPException(status_code=400, detail="Production must be in progress to complete")
     
-    # Deduct materials from stock
-    for material in order.get('materials_required', []):
-        if material['material_type'] == 'raw':
-            await db.raw_materials.update_one(
-                {"id": material['material_id']},
-                {"$inc": {"stock_quantity": -material['required_quantity']}}
-            )
-        elif material['material_type'] == 'packing':
-            await db.packing_materials.update_one(
-                {"id": material['material_id']},
-                {"$inc": {"stock_quantity": -material['required_quantity']}}
-            )
-    
-    # Add finished goods to product stock
-    await db.products.update_one(
-        {"id": order['product_id']},
-        {"$inc": {"stock_quantity": order['quantity_to_produce']}}
-    )
+    result = await run_transaction(lambda session: complete_production_orders([order_id], session))
+    if not result['completed']:
+        # Lost the race to a concurrent completion (e.g. a double-click)
+        raise HTTPException(status_code=400, detail=result['skipped'][0]['reason'])
     
-    # Update production order status
-    await db.production_orders.update_one(
-        {"id": order_id},
-        {"$set": {
-            "status": "completed",
-            "completion_date": datetime.now(timezone.utc).isoformat(),
-            "updated_at": datetime.now(timezone.utc).isoformat()
-        }}
-    )
-    
-    # Update linked sales order production status if exists
-    if order.get('sales_order_id'):
-        # Check if all production orders for this sales order are completed
-        sales_order_id = order['sales_order_id']
+    updated_order = await db.production_orders.find_one({"id": order_id}, {"_id": 0})
+    return updated_order
 
 
 # ========== MATERIAL REQUEST ROUTES ==========
@@ -5053,6 +7361,7 @@ async def export_customer_ledger_excel(customer_id: str):
         all_txns.append(('journal', je.get('entry_date'), je))
     
     all_txns.sort(key=lambda x: x[1] if x[1] else datetime.min)
+    line_taxes = ledger_line_taxes(ledger_response)
     
     for txn_type, txn_date, data in all_txns:
         date_str = txn_date.strftime('%d/%m/%y') if isinstance(txn_date, datetime) else str(txn_date)
@@ -5060,12 +7369,9 @@ async def export_customer_ledger_excel(customer_id: str):
         if txn_type == 'invoice':
             if data.get('items'):
                 # Each item gets its own row with individual amount and balance
-                for idx, item in enumerate(data.get('items', [])):
-                    item_total = item.get('quantity', 0) * item.get('price', 0)
-                    disc_amt = item_total * (item.get('discount_percent', 0) / 100)
-                    taxable = item_total - disc_amt
-                    tax_amt = taxable * (item.get('gst_rate', 0) / 100)
-                    item_final = taxable + tax_amt
+                for idx, (item, line_tax) in enumerate(zip(data.get('items', []), line_taxes[data.get('id')])):
+                    tax_amt = line_tax['gst']
+                    item_final = line_tax['final_taxable'] + tax_amt
                     
                     # Update running balance for each item
                     running_balance += item_final
@@ -5117,12 +7423,9 @@ async def export_customer_ledger_excel(customer_id: str):
         
         elif txn_type == 'credit_note':
             if data.get('items'):
-                for idx, item in enumerate(data.get('items', [])):
-                    item_total = item.get('quantity', 0) * item.get('price', 0)
-                    disc_amt = item_total * (item.get('discount_percent', 0) / 100)
-                    taxable = item_total - disc_amt
-                    tax_amt = taxable * (item.get('gst_rate', 0) / 100)
-                    item_final = taxable + tax_amt
+                for idx, (item, line_tax) in enumerate(zip(data.get('items', []), line_taxes[data.get('id')])):
+                    tax_amt = line_tax['gst']
+                    item_final = line_tax['final_taxable'] + tax_amt
                     
                     # Update running balance for each item
                     running_balance -= item_final
@@ -5342,18 +7645,16 @@ async def export_customer_ledger_pdf(customer_id: str):
         all_txns.append(('journal', je.get('entry_date'), je))
     
     all_txns.sort(key=lambda x: x[1] if x[1] else datetime.min)
+    line_taxes = ledger_line_taxes(ledger_response)
     
     for txn_type, txn_date, data in all_txns:
         date_str = txn_date.strftime('%d/%m/%y') if isinstance(txn_date, datetime) else str(txn_date)
         
         if txn_type == 'invoice':
             if data.get('items'):
-                for idx, item in enumerate(data.get('items', [])):
-                    item_total = item.get('quantity', 0) * item.get('price', 0)
-                    disc_amt = item_total * (item.get('discount_percent', 0) / 100)
-                    taxable = item_total - disc_amt
-                    tax_amt = taxable * (item.get('gst_rate', 0) / 100)
-                    item_final = taxable + tax_amt
+                for idx, (item, line_tax) in enumerate(zip(data.get('items', []), line_taxes[data.get('id')])):
+                    tax_amt = line_tax['gst']
+                    item_final = line_tax['final_taxable'] + tax_amt
                     
                     # Update balance for each item
                     running_balance += item_final
@@ -5384,12 +7685,9 @@ async def export_customer_ledger_pdf(customer_id: str):
         
         elif txn_type == 'credit_note':
             if data.get('items'):
-                for idx, item in enumerate(data.get('items', [])):
-                    item_total = item.get('quantity', 0) * item.get('price', 0)
-                    disc_amt = item_total * (item.get('discount_percent', 0) / 100)
-                    taxable = item_total - disc_amt
-                    tax_amt = taxable * (item.get('gst_rate', 0) / 100)
-                    item_final = taxable + tax_amt
+                for idx, (item, line_tax) in enumerate(zip(data.get('items', []), line_taxes[data.get('id')])):
+                    tax_amt = line_tax['gst']
+                    item_final = line_tax['final_taxable'] + tax_amt
                     
                     running_balance -= item_final
                     
@@ -5982,20 +8280,21 @@ async def get_inventory_dashboard_stats():
     total_raw_materials = await db.raw_materials.count_documents({})
     total_finished_goods = await db.finished_goods.count_documents({})
     total_packing_materials = await db.packing_materials.count_documents({})
-    low_stock_items = await db.raw_materials.count_documents({"quantity": {"$lt": 100}})
+    low_stock_items = await db.reorder_list.count_documents({})
     pending_approvals = await db.purchase_requests.count_documents({"approval_status": "pending"})
-    total_stock_value = 0
     
-    # Calculate total stock value
-    raw_materials = await db.raw_materials.find({}).to_list(1000)
-    for item in raw_materials:
-        total_stock_value += item.get('quantity', 0) * item.get('rate', 0)
+    # Running valuation totals - one small read instead of a collection scan
+    total_stock_value = sum((await get_inventory_value()).values())
+    
+    # Most urgent reorders from the materialized reorder list
+    reorder_items = await db.reorder_list.find({}, {"_id": 0, "key": 0}).sort("shortfall", -1).limit(5).to_list(5)
     
     return {
         "total_raw_materials": total_raw_materials,
         "total_finished_goods": total_finished_goods,
         "total_packing_materials": total_packing_materials,
         "low_stock_items": low_stock_items,
+        "reorder_items": reorder_items,
         "pending_approvals": pending_approvals,
         "total_stock_value": round(total_stock_value, 2)
     }
@@ -6052,6 +8351,7 @@ async def get_purchase_dashboard_stats():
     total_purchase_orders = await db.purchase_orders.count_documents({})
     pending_purchase_orders = await db.purchase_orders.count_documents({"status": {"$in": ["pending", "approved"]}})
     pending_grns = await db.grns.count_documents({"status": "pending"})
+    materials_to_reorder = await db.reorder_list.count_documents({"item_type": {"$ne": "product"}})
     
     # Calculate total purchase value
     purchase_orders = await db.purchase_orders.find({"status": "completed"}).to_list(1000)
@@ -6063,6 +8363,7 @@ async def get_purchase_dashboard_stats():
         "total_purchase_orders": total_purchase_orders,
         "pending_purchase_orders": pending_purchase_orders,
         "pending_grns": pending_grns,
+        "materials_to_reorder": materials_to_reorder,
         "total_purchase_value": round(total_purchase_value, 2)
     }
 
@@ -6101,13 +8402,17 @@ async def get_finance_dashboard_stats():
 
 # ========== USER & ROLE MANAGEMENT ROUTES ==========
 
+# Changing roles and users needs the "admin" module: admin users, or a role granted it
+require_admin = require_permission("admin")
+
 # Role Management
-@api_router.post("/admin/roles", response_model=Role)
+@api_router.post("/admin/roles", response_model=Role, dependencies=[Depends(require_admin)])
 async def create_role(role: RoleCreate):
     role_obj = Role(**role.model_dump())
     doc = role_obj.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
     await db.roles.insert_one(doc)
+    await refresh_role_permissions(role_obj.id)
     return role_obj
 
 @api_router.get("/admin/roles", response_model=List[Role])
@@ -6127,7 +8432,7 @@ async def get_role(role_id: str):
         role['created_at'] = datetime.fromisoformat(role['created_at'])
     return role
 
-@api_router.put("/admin/roles/{role_id}")
+@api_router.put("/admin/roles/{role_id}", dependencies=[Depends(require_admin)])
 async def update_role(role_id: str, role_update: dict):
     result = await db.roles.update_one(
         {"id": role_id},
@@ -6135,18 +8440,22 @@ async def update_role(role_id: str, role_update: dict):
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Role not found")
+    invalidate_auth_role(role_id)
+    await refresh_role_permissions(role_id)
     return {"message": "Role updated successfully"}
 
-@api_router.delete("/admin/roles/{role_id}")
+@api_router.delete("/admin/roles/{role_id}", dependencies=[Depends(require_admin)])
 async def delete_role(role_id: str):
     result = await db.roles.delete_one({"id": role_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Role not found")
+    invalidate_auth_role(role_id)
+    await refresh_role_permissions(role_id)
     return {"message": "Role deleted successfully"}
 
 
 # User Management
-@api_router.post("/admin/users", response_model=UserWithRole)
+@api_router.post("/admin/users", response_model=UserWithRole, dependencies=[Depends(require_admin)])
 async def create_user(user: UserCreate):
     # Check if username already exists
     existing_user = await db.users.find_one({"username": user.username})
@@ -6154,15 +8463,127 @@ async def create_user(user: UserCreate):
         raise HTTPException(status_code=400, detail="Username already exists")
     
     # Create user with hashed password
-    hashed_password = pwd_context.hash(user.password)
+    hashed_password = await hash_password_async(user.password)
     user_obj = UserWithRole(**user.model_dump(exclude={'password'}))
     doc = user_obj.model_dump()
     doc['hashed_password'] = hashed_password
     doc['created_at'] = doc['created_at'].isoformat()
     
-    await db.users.insert_one(doc)
+    try:
+        await db.users.insert_one(doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Username already exists")
+    invalidate_auth_user(user_obj.id, user_obj.username)
     return user_obj
 
+async def ensure_user_indexes():
+    """Usernames are unique; the index also backs login, token resolution and the bulk duplicate check"""
+    await ensure_unique_index("users", "username")
+    await db.users.create_index("id")
+
+
+async def read_bulk_user_rows(request: Request) -> list:
+    """(row_number, {field: value}) for every user in a bulk request. Accepts a CSV/XLSX file upload,
+    a text/csv body, or JSON: a list of users, {"users": [...]} or {"csv": "<csv text>"}."""
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        upload = (await request.form()).get("file")
+        if upload is None or isinstance(upload, str):
+            raise HTTPException(status_code=400, detail="Upload the users as 'file'")
+        return await asyncio.to_thread(lambda: list(iter_import_rows(upload)))
+    if content_type.startswith("text/csv"):
+        text = (await request.body()).decode("utf-8-sig")
+        return list(iter_header_rows(csv.reader(io.StringIO(text))))
+    
+    try:
+        body = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Send a CSV file, CSV text or a JSON list of users")
+    if isinstance(body, dict) and isinstance(body.get("csv"), str):
+        return list(iter_header_rows(csv.reader(io.StringIO(body["csv"]))))
+    users = body.get("users") if isinstance(body, dict) else body
+    if not isinstance(users, list):
+        raise HTTPException(status_code=400, detail="Send a CSV file, CSV text or a JSON list of users")
+    return [(index, user if isinstance(user, dict) else {}) for index, user in enumerate(users, start=1)]
+
+
+@api_router.post("/admin/users/bulk", dependencies=[Depends(require_admin)])
+async def create_users_bulk(request: Request):
+    """Create many users at once (see read_bulk_user_rows for the accepted formats).
+    Rows without a role become employees. Usernames are checked with one query, passwords are hashed
+    in parallel and the users inserted together; every row gets its own result."""
+    rows = await read_bulk_user_rows(request)
+    if not rows:
+        raise HTTPException(status_code=400, detail="No users provided")
+    
+    results = {}
+    candidates = []
+    seen_usernames = set()
+    for row_number, values in rows:
+        values = {"role": "employee", **values}
+        try:
+            user = UserCreate(**values)
+        except ValidationError as e:
+            results[row_number] = {"row": row_number, "username": values.get("username", ""), "success": False,
+                                   "error": "; ".join(f"{'.'.join(str(part) for part in err['loc'])}: {err['msg']}"
+                                                      for err in e.errors())}
+            continue
+        if user.username in seen_usernames:
+            results[row_number] = {"row": row_number, "username": user.username, "success": False,
+                                   "error": "Username repeated in this import"}
+            continue
+        seen_usernames.add(user.username)
+        candidates.append((row_number, user))
+    
+    existing = {
+        user['username']
+        async for user in db.users.find({"username": {"$in": list(seen_usernames)}}, {"_id": 0, "username": 1})
+    }
+    new_users = []
+    for row_number, user in candidates:
+        if user.username in existing:
+            results[row_number] = {"row": row_number, "username": user.username, "success": False,
+                                   "error": "Username already exists"}
+        else:
+            new_users.append((row_number, user))
+    
+    hashed_passwords = await hash_passwords_bulk([user.password for _, user in new_users])
+    docs = []
+    for (row_number, user), hashed_password in zip(new_users, hashed_passwords):
+        doc = UserWithRole(**user.model_dump(exclude={'password'})).model_dump()
+        doc['hashed_password'] = hashed_password
+        doc['created_at'] = doc['created_at'].isoformat()
+        docs.append(doc)
+    
+    failed_inserts = {}
+    if docs:
+        try:
+            await db.users.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # A username created since the check above (another import or a single create) fails on the unique index
+            failed_inserts = {
+                error['index']: "Username already exists" if error.get('code') == 11000 else error.get('errmsg', 'Insert failed')
+                for error in e.details.get('writeErrors', [])
+            }
+        created_usernames = {doc['username'] for doc in docs}
+        invalidate_auth_cache(lambda context: context['user'].get('username') in created_usernames)
+    
+    for index, ((row_number, user), doc) in enumerate(zip(new_users, docs)):
+        if index in failed_inserts:
+            results[row_number] = {"row": row_number, "username": user.username, "success": False,
+                                   "error": failed_inserts[index]}
+        else:
+            results[row_number] = {"row": row_number, "username": user.username, "success": True, "id": doc['id']}
+    
+    ordered_results = [results[row_number] for row_number, _ in rows]
+    created = sum(1 for result in ordered_results if result['success'])
+    return {
+        "total": len(rows),
+        "created": created,
+        "failed": len(rows) - created,
+        "results": ordered_results
+    }
+
 @api_router.get("/admin/users", response_model=List[UserWithRole])
 async def get_users():
     users = await db.users.find({}, {"_id": 0, "hashed_password": 0}).to_list(1000)
@@ -6180,11 +8601,11 @@ async def get_user(user_id: str):
         user['created_at'] = datetime.fromisoformat(user['created_at'])
     return user
 
-@api_router.put("/admin/users/{user_id}")
+@api_router.put("/admin/users/{user_id}", dependencies=[Depends(require_admin)])
 async def update_user(user_id: str, user_update: dict):
     # If password is being updated, hash it
     if 'password' in user_update:
-        user_update['hashed_password'] = pwd_context.hash(user_update['password'])
+        user_update['hashed_password'] = await hash_password_async(user_update['password'])
         del user_update['password']
     
     result = await db.users.update_one(
@@ -6193,28 +8614,31 @@ async def update_user(user_id: str, user_update: dict):
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    invalidate_auth_user(user_id)
     return {"message": "User updated successfully"}
 
-@api_router.delete("/admin/users/{user_id}")
+@api_router.delete("/admin/users/{user_id}", dependencies=[Depends(require_admin)])
 async def delete_user(user_id: str):
     result = await db.users.delete_one({"id": user_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    invalidate_auth_user(user_id)
     return {"message": "User deleted successfully"}
 
-@api_router.post("/admin/users/{user_id}/reset-password")
+@api_router.post("/admin/users/{user_id}/reset-password", dependencies=[Depends(require_admin)])
 async def reset_user_password(user_id: str, password_data: dict):
     new_password = password_data.get('password')
     if not new_password:
         raise HTTPException(status_code=400, detail="Password is required")
     
-    hashed_password = pwd_context.hash(new_password)
+    hashed_password = await hash_password_async(new_password)
     result = await db.users.update_one(
         {"id": user_id},
         {"$set": {"hashed_password": hashed_password}}
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    invalidate_auth_user(user_id)
     return {"message": "Password reset successfully"}
 
 
@@ -6222,12 +8646,20 @@ app.include_router(api_router)
 app.include_router(whatsapp_router)
 app.include_router(recovery_router)
 
+
+@app.exception_handler(DuplicateKeyError)
+async def duplicate_key_handler(request: Request, exc: DuplicateKeyError):
+    """A write that hit a unique index (usernames, invoice numbers) is the caller's conflict, not a 500"""
+    fields = ", ".join((exc.details or {}).get('keyValue', {})) or "value"
+    return JSONResponse(status_code=400, content={"detail": f"A record with this {fields} already exists"})
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Total-Count"],
 )
 
 # Configure logging
@@ -6237,791 +8669,48 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def init_db_indexes():
+    await ensure_daybook_indexes()
+    # Product costs first: they value the opening stock of products
+    await ensure_bom_explosions()
+    await ensure_product_costs()
+    await ensure_stock_journal()
+    await ensure_inventory_valuation()
+    await ensure_reorder_list()
+    await ensure_supplier_price_history()
+    await ensure_invoice_hsn_summary()
+    await ensure_invoice_numbering()
+    await ensure_import_indexes()
+    await ensure_user_indexes()
+
+
+# Background tasks started with the app and cancelled on shutdown
+background_tasks = []
+
+@app.on_event("startup")
+async def init_company_settings_cache():
+    await load_company_settings()
+    background_tasks.append(asyncio.create_task(watch_company_settings()))
+
+@app.on_event("startup")
+async def init_whatsapp():
+    await start_whatsapp_client()
+    background_tasks.append(asyncio.create_task(probe_whatsapp_service()))
+    await ensure_whatsapp_jobs()
+    await ensure_reminder_campaigns()
+    background_tasks.extend(start_whatsapp_workers())
+
+@app.on_event("startup")
+async def init_role_permissions():
+    await load_role_permissions()
+    background_tasks.append(asyncio.create_task(watch_role_permissions()))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()# Invoice Management Backend APIs
-# Add this section to your server.py
-
-from typing import List, Optional
-from datetime import datetime, timezone
-from uuid import uuid4
-import os
-from reportlab.lib.pagesizes import A4
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
-from reportlab.lib import colors
-from reportlab.lib.enums import TA_CENTER, TA_RIGHT
-
-# Invoice Models
-class InvoiceItem(BaseModel):
-    model_config = ConfigDict(extra="ignore")
-    
-    item_name: str
-    description: Optional[str] = ""
-    quantity: float
-    unit_price: float
-    tax_rate: Optional[float] = 0
-    amount: float
-
-class Invoice(BaseModel):
-    model_config = ConfigDict(extra="ignore")
-    
-    id: str = Field(default_factory=lambda: str(uuid4()))
-    invoice_number: str
-    invoice_date: str
-    due_date: str
-    
-    # Customer/Dealer Info
-    customer_id: Optional[str] = None
-    customer_name: str
-    customer_phone: str
-    customer_email: Optional[str] = ""
-    customer_address: Optional[str] = ""
-    customer_gstin: Optional[str] = ""
-    
-    # Invoice Items
-    items: List[InvoiceItem]
-    
-    # Amounts
-    subtotal: float
-    tax_amount: float
-    discount_amount: Optional[float] = 0
-    total_amount: float
-    
-    # Payment Info
-    payment_terms: Optional[str] = "Net 30"
-    payment_status: str = "unpaid"  # unpaid, partially_paid, paid
-    paid_amount: Optional[float] = 0
-    
-    # WhatsApp
-    send_whatsapp: Optional[bool] = False
-    whatsapp_sent: Optional[bool] = False
-    whatsapp_sent_at: Optional[str] = None
-    
-    # Metadata
-    notes: Optional[str] = ""
-    status: str = "draft"  # draft, sent, paid, cancelled
-    created_by: Optional[str] = None
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
-    updated_at: Optional[str] = None
-
-class InvoiceCreate(BaseModel):
-    invoice_number: str
-    invoice_date: str
-    due_date: str
-    customer_name: str
-    customer_phone: str
-    customer_email: Optional[str] = ""
-    customer_address: Optional[str] = ""
-    customer_gstin: Optional[str] = ""
-    items: List[InvoiceItem]
-    subtotal: float
-    tax_amount: float
-    discount_amount: Optional[float] = 0
-    total_amount: float
-    payment_terms: Optional[str] = "Net 30"
-    notes: Optional[str] = ""
-    send_whatsapp: Optional[bool] = False
-
-# PDF Generation Function
-async def generate_invoice_pdf(invoice: Invoice) -> str:
-    """Generate PDF for invoice and return file path"""
-    try:
-        # Create invoices directory if doesn't exist
-        invoices_dir = Path("/app/invoices")
-        invoices_dir.mkdir(exist_ok=True)
-        
-        pdf_filename = f"Invoice_{invoice.invoice_number}.pdf"
-        pdf_path = invoices_dir / pdf_filename
-        
-        # Create PDF
-        doc = SimpleDocTemplate(str(pdf_path), pagesize=A4)
-        story = []
-        styles = getSampleStyleSheet()
-        
-        # Title
-        title_style = ParagraphStyle(
-            'CustomTitle',
-            parent=styles['Heading1'],
-            fontSize=24,
-            textColor=colors.HexColor('#1a56db'),
-            spaceAfter=30,
-            alignment=TA_CENTER
-        )
-        story.append(Paragraph("INVOICE", title_style))
-        story.append(Spacer(1, 0.3*inch))
-        
-        # Company Info & Invoice Details (side by side)
-        company_invoice_data = [
-            [
-                Paragraph("<b>Nectar</b><br/>Your Business Address<br/>Phone: +91-XXXXXXXXXX<br/>Email: info@nectar.com", styles['Normal']),
-                Paragraph(f"<b>Invoice #:</b> {invoice.invoice_number}<br/><b>Date:</b> {invoice.invoice_date[:10]}<br/><b>Due Date:</b> {invoice.due_date[:10]}", styles['Normal'])
-            ]
-        ]
-        
-        company_invoice_table = Table(company_invoice_data, colWidths=[3*inch, 3*inch])
-        company_invoice_table.setStyle(TableStyle([
-            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-            ('ALIGN', (1, 0), (1, 0), 'RIGHT'),
-        ]))
-        story.append(company_invoice_table)
-        story.append(Spacer(1, 0.3*inch))
-        
-        # Bill To
-        story.append(Paragraph("<b>Bill To:</b>", styles['Heading3']))
-        bill_to_text = f"{invoice.customer_name}<br/>"
-        if invoice.customer_address:
-            bill_to_text += f"{invoice.customer_address}<br/>"
-        bill_to_text += f"Phone: {invoice.customer_phone}<br/>"
-        if invoice.customer_email:
-            bill_to_text += f"Email: {invoice.customer_email}<br/>"
-        if invoice.customer_gstin:
-            bill_to_text += f"GSTIN: {invoice.customer_gstin}"
-        
-        story.append(Paragraph(bill_to_text, styles['Normal']))
-        story.append(Spacer(1, 0.3*inch))
-        
-        # Items Table
-        items_data = [['Item', 'Description', 'Qty', 'Rate', 'Tax', 'Amount']]
-        
-        for item in invoice.items:
-            items_data.append([
-                item.item_name,
-                item.description or '-',
-                str(item.quantity),
-                f"₹{item.unit_price:,.2f}",
-                f"{item.tax_rate}%",
-                f"₹{item.amount:,.2f}"
-            ])
-        
-        items_table = Table(items_data, colWidths=[1.5*inch, 2*inch, 0.7*inch, 1*inch, 0.7*inch, 1*inch])
-        items_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#1a56db')),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 10),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -1), colors.white),
-            ('TEXTCOLOR', (0, 1), (-1, -1), colors.black),
-            ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
-            ('FONTSIZE', (0, 1), (-1, -1), 9),
-            ('GRID', (0, 0), (-1, -1), 1, colors.grey),
-            ('ALIGN', (2, 1), (2, -1), 'CENTER'),
-            ('ALIGN', (3, 1), (-1, -1), 'RIGHT'),
-        ]))
-        story.append(items_table)
-        story.append(Spacer(1, 0.3*inch))
-        
-        # Totals
-        totals_data = [
-            ['Subtotal:', f"₹{invoice.subtotal:,.2f}"],
-            ['Tax:', f"₹{invoice.tax_amount:,.2f}"],
-        ]
-        
-        if invoice.discount_amount and invoice.discount_amount > 0:
-            totals_data.append(['Discount:', f"-₹{invoice.discount_amount:,.2f}"])
-        
-        totals_data.append(['<b>Total Amount:</b>', f"<b>₹{invoice.total_amount:,.2f}</b>"])
-        
-        totals_table = Table(totals_data, colWidths=[4.5*inch, 1.5*inch])
-        totals_table.setStyle(TableStyle([
-            ('ALIGN', (0, 0), (-1, -1), 'RIGHT'),
-            ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, -1), (-1, -1), 12),
-            ('TEXTCOLOR', (0, -1), (-1, -1), colors.HexColor('#1a56db')),
-            ('LINEABOVE', (0, -1), (-1, -1), 2, colors.HexColor('#1a56db')),
-        ]))
-        story.append(totals_table)
-        story.append(Spacer(1, 0.3*inch))
-        
-        # Payment Terms & Notes
-        if invoice.payment_terms:
-            story.append(Paragraph(f"<b>Payment Terms:</b> {invoice.payment_terms}", styles['Normal']))
-            story.append(Spacer(1, 0.1*inch))
-        
-        if invoice.notes:
-            story.append(Paragraph(f"<b>Notes:</b><br/>{invoice.notes}", styles['Normal']))
-            story.append(Spacer(1, 0.2*inch))
-        
-        # Footer
-        footer_style = ParagraphStyle(
-            'Footer',
-            parent=styles['Normal'],
-            fontSize=9,
-            textColor=colors.grey,
-            alignment=TA_CENTER
-        )
-        story.append(Spacer(1, 0.5*inch))
-        story.append(Paragraph("Thank you for your business!", footer_style))
-        
-        # Build PDF
-        doc.build(story)
-        
-        return str(pdf_path)
-        
-    except Exception as e:
-        print(f"Error generating PDF: {e}")
-        raise HTTPException(status_code=500, detail=f"Failed to generate PDF: {str(e)}")
-
-# Invoice Routes
-@api_router.post("/invoices", response_model=Invoice)
-async def create_invoice(invoice_data: InvoiceCreate):
-    """Create a new invoice"""
-    try:
-        invoice = Invoice(**invoice_data.dict())
-        invoice.status = "sent"
-        
-        # Generate PDF
-        pdf_path = await generate_invoice_pdf(invoice)
-        
-        # Save to database
-        await db.invoices.insert_one(invoice.dict())
-        
-        # Send via WhatsApp if requested
-        if invoice.send_whatsapp and invoice.customer_phone:
-            try:
-                async with httpx.AsyncClient() as client:
-                    whatsapp_data = {
-                        "phone_number": invoice.customer_phone,
-                        "invoice_number": invoice.invoice_number,
-                        "dealer_name": invoice.customer_name,
-                        "amount": str(invoice.total_amount),
-                        "due_date": invoice.due_date[:10],
-                        "pdf_path": pdf_path
-                    }
-                    
-                    response = await client.post(
-                        "http://localhost:3001/send-invoice",
-                        json=whatsapp_data,
-                        timeout=60.0
-                    )
-                    
-                    if response.json().get('success'):
-                        invoice.whatsapp_sent = True
-                        invoice.whatsapp_sent_at = datetime.now(timezone.utc).isoformat()
-                        
-                        # Update in database
-                        await db.invoices.update_one(
-                            {"id": invoice.id},
-                            {"$set": {
-                                "whatsapp_sent": True,
-                                "whatsapp_sent_at": invoice.whatsapp_sent_at
-                            }}
-                        )
-            except Exception as e:
-                print(f"WhatsApp send failed: {e}")
-                # Continue even if WhatsApp fails
-        
-        return invoice
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to create invoice: {str(e)}")
-
-@api_router.get("/invoices", response_model=List[Invoice])
-async def get_invoices(
-    status: Optional[str] = None,
-    customer_name: Optional[str] = None,
-    limit: int = 100
-):
-    """Get all invoices with optional filters"""
-    try:
-        query = {}
-        
-        if status:
-            query["status"] = status
-        
-        if customer_name:
-            query["customer_name"] = {"$regex": customer_name, "$options": "i"}
-        
-        invoices = await db.invoices.find(query, {"_id": 0}).sort("created_at", -1).limit(limit).to_list(limit)
-        return invoices
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-
-@api_router.get("/invoices/{invoice_id}", response_model=Invoice)
-async def get_invoice(invoice_id: str):
-    """Get invoice by ID"""
-    invoice = await db.invoices.find_one({"id": invoice_id}, {"_id": 0})
-    if not invoice:
-        raise HTTPException(status_code=404, detail="Invoice not found")
-    return invoice
-
-@api_router.put("/invoices/{invoice_id}", response_model=Invoice)
-async def update_invoice(invoice_id: str, invoice_data: InvoiceCreate):
-    """Update invoice"""
-    invoice = await db.invoices.find_one({"id": invoice_id}, {"_id": 0})
-    if not invoice:
-        raise HTTPException(status_code=404, detail="Invoice not found")
-    
-    updated_data = invoice_data.dict()
-    updated_data["updated_at"] = datetime.now(timezone.utc).isoformat()
-    
-    await db.invoices.update_one(
-        {"id": invoice_id},
-        {"$set": updated_data}
-    )
-    
-    updated_invoice = await db.invoices.find_one({"id": invoice_id}, {"_id": 0})
-    return updated_invoice
-
-@api_router.delete("/invoices/{invoice_id}")
-async def delete_invoice(invoice_id: str):
-    """Delete invoice"""
-    result = await db.invoices.delete_one({"id": invoice_id})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Invoice not found")
-    return {"message": "Invoice deleted successfully"}
-
-@api_router.post("/invoices/{invoice_id}/send-whatsapp")
-async def resend_invoice_whatsapp(invoice_id: str):
-    """Resend invoice via WhatsApp"""
-    invoice_data = await db.invoices.find_one({"id": invoice_id}, {"_id": 0})
-    if not invoice_data:
-        raise HTTPException(status_code=404, detail="Invoice not found")
-    
-    invoice = Invoice(**invoice_data)
-    
-    # Find PDF
-    pdf_path = f"/app/invoices/Invoice_{invoice.invoice_number}.pdf"
-    
-    if not os.path.exists(pdf_path):
-        # Regenerate PDF if not found
-        pdf_path = await generate_invoice_pdf(invoice)
-    
-    try:
-        async with httpx.AsyncClient() as client:
-            whatsapp_data = {
-                "phone_number": invoice.customer_phone,
-                "invoice_number": invoice.invoice_number,
-                "dealer_name": invoice.customer_name,
-                "amount": str(invoice.total_amount),
-                "due_date": invoice.due_date[:10],
-                "pdf_path": pdf_path
-            }
-            
-            response = await client.post(
-                "http://localhost:3001/send-invoice",
-                json=whatsapp_data,
-                timeout=60.0
-            )
-            
-            if response.json().get('success'):
-                # Update database
-                await db.invoices.update_one(
-                    {"id": invoice_id},
-                    {"$set": {
-                        "whatsapp_sent": True,
-                        "whatsapp_sent_at": datetime.now(timezone.utc).isoformat()
-                    }}
-                )
-                return {"success": True, "message": "Invoice sent via WhatsApp"}
-            else:
-                return {"success": False, "message": "Failed to send via WhatsApp"}
-                
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to send WhatsApp: {str(e)}")
-
-@api_router.get("/invoices/{invoice_id}/pdf")
-async def download_invoice_pdf(invoice_id: str):
-    """Download invoice PDF"""
-    invoice_data = await db.invoices.find_one({"id": invoice_id}, {"_id": 0})
-    if not invoice_data:
-        raise HTTPException(status_code=404, detail="Invoice not found")
-    
-    invoice = Invoice(**invoice_data)
-    pdf_path = f"/app/invoices/Invoice_{invoice.invoice_number}.pdf"
-    
-    if not os.path.exists(pdf_path):
-        # Generate PDF if not found
-        pdf_path = await generate_invoice_pdf(invoice)
-    
-    from fastapi.responses import FileResponse
-    return FileResponse(
-        pdf_path,
-        media_type='application/pdf',
-        filename=f"Invoice_{invoice.invoice_number}.pdf"
-    )
-# Recovery Module Backend APIs
-# Payment Recovery and Follow-up Management
-
-from typing import List, Optional
-from datetime import datetime, timezone, timedelta
-from uuid import uuid4
-
-# Models for Recovery
-class PaymentRecord(BaseModel):
-    model_config = ConfigDict(extra="ignore")
-    
-    id: str = Field(default_factory=lambda: str(uuid4()))
-    invoice_id: str
-    invoice_number: str
-    payment_date: str
-    amount: float
-    payment_method: str  # cash, cheque, bank_transfer, upi, etc.
-    reference_number: Optional[str] = ""
-    notes: Optional[str] = ""
-    recorded_by: str
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
-
-class FollowUpNote(BaseModel):
-    model_config = ConfigDict(extra="ignore")
-    
-    id: str = Field(default_factory=lambda: str(uuid4()))
-    invoice_id: str
-    invoice_number: str
-    follow_up_date: str
-    contacted_person: Optional[str] = ""
-    contact_method: str  # phone, email, whatsapp, visit
-    notes: str
-    next_follow_up_date: Optional[str] = None
-    status: str  # contacted, promised_payment, disputed, no_response
-    recorded_by: str
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
-
-# Recovery Dashboard Stats
-@api_router.get("/recovery/stats")
-async def get_recovery_stats():
-    """Get recovery dashboard statistics"""
-    try:
-        # Get all invoices
-        all_invoices = await db.invoices.find({"status": {"$ne": "cancelled"}}, {"_id": 0}).to_list(1000)
-        
-        today = datetime.now(timezone.utc)
-        
-        stats = {
-            "total_outstanding": 0,
-            "overdue_count": 0,
-            "overdue_amount": 0,
-            "due_this_week": 0,
-            "due_this_week_amount": 0,
-            "partially_paid_count": 0,
-            "partially_paid_amount": 0,
-            "critical_overdue": 0,  # >30 days
-            "critical_overdue_amount": 0,
-            "by_age": {
-                "0-7": {"count": 0, "amount": 0},
-                "8-15": {"count": 0, "amount": 0},
-                "16-30": {"count": 0, "amount": 0},
-                "31-60": {"count": 0, "amount": 0},
-                "60+": {"count": 0, "amount": 0}
-            }
-        }
-        
-        for invoice in all_invoices:
-            if invoice.get('payment_status') == 'paid':
-                continue
-                
-            due_date = datetime.fromisoformat(invoice['due_date'].replace('Z', '+00:00'))
-            days_overdue = (today - due_date).days
-            
-            outstanding = invoice['total_amount'] - invoice.get('paid_amount', 0)
-            stats['total_outstanding'] += outstanding
-            
-            # Overdue invoices
-            if days_overdue > 0:
-                stats['overdue_count'] += 1
-                stats['overdue_amount'] += outstanding
-                
-                # Critical overdue (>30 days)
-                if days_overdue > 30:
-                    stats['critical_overdue'] += 1
-                    stats['critical_overdue_amount'] += outstanding
-                
-                # Age buckets
-                if days_overdue <= 7:
-                    stats['by_age']['0-7']['count'] += 1
-                    stats['by_age']['0-7']['amount'] += outstanding
-                elif days_overdue <= 15:
-                    stats['by_age']['8-15']['count'] += 1
-                    stats['by_age']['8-15']['amount'] += outstanding
-                elif days_overdue <= 30:
-                    stats['by_age']['16-30']['count'] += 1
-                    stats['by_age']['16-30']['amount'] += outstanding
-                elif days_overdue <= 60:
-                    stats['by_age']['31-60']['count'] += 1
-                    stats['by_age']['31-60']['amount'] += outstanding
-                else:
-                    stats['by_age']['60+']['count'] += 1
-                    stats['by_age']['60+']['amount'] += outstanding
-            
-            # Due this week
-            if 0 <= days_overdue <= 7:
-                stats['due_this_week'] += 1
-                stats['due_this_week_amount'] += outstanding
-            
-            # Partially paid
-            if invoice.get('payment_status') == 'partially_paid':
-                stats['partially_paid_count'] += 1
-                stats['partially_paid_amount'] += outstanding
-        
-        return stats
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-
-# Get Overdue Invoices
-@api_router.get("/recovery/overdue-invoices")
-async def get_overdue_invoices(
-    days_overdue: Optional[int] = None,
-    customer_name: Optional[str] = None,
-    min_amount: Optional[float] = None
-):
-    """Get all overdue invoices with filters"""
-    try:
-        query = {
-            "status": {"$ne": "cancelled"},
-            "payment_status": {"$in": ["unpaid", "partially_paid"]}
-        }
-        
-        if customer_name:
-            query["customer_name"] = {"$regex": customer_name, "$options": "i"}
-        
-        invoices = await db.invoices.find(query, {"_id": 0}).to_list(1000)
-        
-        today = datetime.now(timezone.utc)
-        overdue_invoices = []
-        
-        for invoice in invoices:
-            due_date = datetime.fromisoformat(invoice['due_date'].replace('Z', '+00:00'))
-            days_past = (today - due_date).days
-            
-            if days_past > 0:  # Only overdue
-                outstanding = invoice['total_amount'] - invoice.get('paid_amount', 0)
-                
-                # Apply filters
-                if days_overdue and days_past < days_overdue:
-                    continue
-                if min_amount and outstanding < min_amount:
-                    continue
-                
-                invoice['days_overdue'] = days_past
-                invoice['outstanding_amount'] = outstanding
-                
-                # Get last follow-up
-                last_followup = await db.follow_ups.find_one(
-                    {"invoice_id": invoice['id']},
-                    {"_id": 0},
-                    sort=[("created_at", -1)]
-                )
-                invoice['last_follow_up'] = last_followup
-                
-                # Get payment history
-                payments = await db.payment_records.find(
-                    {"invoice_id": invoice['id']},
-                    {"_id": 0}
-                ).to_list(100)
-                invoice['payment_history'] = payments
-                
-                overdue_invoices.append(invoice)
-        
-        # Sort by days overdue (most critical first)
-        overdue_invoices.sort(key=lambda x: x['days_overdue'], reverse=True)
-        
-        return overdue_invoices
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-
-# Record Payment
-@api_router.post("/recovery/record-payment")
-async def record_payment(payment: PaymentRecord):
-    """Record a payment against an invoice"""
-    try:
-        # Get invoice
-        invoice = await db.invoices.find_one({"id": payment.invoice_id}, {"_id": 0})
-        if not invoice:
-            raise HTTPException(status_code=404, detail="Invoice not found")
-        
-        # Save payment record
-        await db.payment_records.insert_one(payment.dict())
-        
-        # Update invoice
-        paid_amount = invoice.get('paid_amount', 0) + payment.amount
-        
-        if paid_amount >= invoice['total_amount']:
-            payment_status = 'paid'
-        elif paid_amount > 0:
-            payment_status = 'partially_paid'
-        else:
-            payment_status = 'unpaid'
-        
-        await db.invoices.update_one(
-            {"id": payment.invoice_id},
-            {"$set": {
-                "paid_amount": paid_amount,
-                "payment_status": payment_status,
-                "updated_at": datetime.now(timezone.utc).isoformat()
-            }}
-        )
-        
-        return {
-            "success": True,
-            "message": "Payment recorded successfully",
-            "paid_amount": paid_amount,
-            "payment_status": payment_status
-        }
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-
-# Add Follow-up Note
-@api_router.post("/recovery/follow-up")
-async def add_follow_up(follow_up: FollowUpNote):
-    """Add a follow-up note for an invoice"""
-    try:
-        await db.follow_ups.insert_one(follow_up.dict())
-        return {"success": True, "message": "Follow-up note added successfully"}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-
-# Get Follow-up History
-@api_router.get("/recovery/follow-ups/{invoice_id}")
-async def get_follow_ups(invoice_id: str):
-    """Get all follow-ups for an invoice"""
-    try:
-        follow_ups = await db.follow_ups.find(
-            {"invoice_id": invoice_id},
-            {"_id": 0}
-        ).sort("created_at", -1).to_list(100)
-        return follow_ups
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-
-# Get Payment History
-@api_router.get("/recovery/payments/{invoice_id}")
-async def get_payment_history(invoice_id: str):
-    """Get payment history for an invoice"""
-    try:
-        payments = await db.payment_records.find(
-            {"invoice_id": invoice_id},
-            {"_id": 0}
-        ).sort("payment_date", -1).to_list(100)
-        return payments
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-
-# Send Payment Reminder via WhatsApp
-@api_router.post("/recovery/send-reminder/{invoice_id}")
-async def send_payment_reminder(invoice_id: str):
-    """Send payment reminder via WhatsApp"""
-    try:
-        invoice = await db.invoices.find_one({"id": invoice_id}, {"_id": 0})
-        if not invoice:
-            raise HTTPException(status_code=404, detail="Invoice not found")
-        
-        today = datetime.now(timezone.utc)
-        due_date = datetime.fromisoformat(invoice['due_date'].replace('Z', '+00:00'))
-        days_overdue = (today - due_date).days
-        
-        outstanding = invoice['total_amount'] - invoice.get('paid_amount', 0)
-        
-        # Create reminder message
-        message = f"""🔔 Payment Reminder - Nectar
-
-Dear {invoice['customer_name']},
-
-This is a friendly reminder regarding:
-
-📄 Invoice: {invoice['invoice_number']}
-💰 Amount Due: ₹{outstanding:,.2f}
-📅 Due Date: {invoice['due_date'][:10]}
-⚠️ Days Overdue: {days_overdue} days
-
-Please process the payment at your earliest convenience.
-
-For any queries, contact us.
-
-Thank you!"""
-
-        # Send via WhatsApp
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "http://localhost:3001/send-message",
-                json={
-                    "phone_number": invoice['customer_phone'],
-                    "message": message
-                },
-                timeout=30.0
-            )
-            
-            if response.json().get('success'):
-                # Record follow-up
-                follow_up = FollowUpNote(
-                    invoice_id=invoice_id,
-                    invoice_number=invoice['invoice_number'],
-                    follow_up_date=datetime.now(timezone.utc).isoformat(),
-                    contact_method="whatsapp",
-                    notes=f"Payment reminder sent via WhatsApp. Days overdue: {days_overdue}",
-                    status="contacted",
-                    recorded_by="System"
-                )
-                await db.follow_ups.insert_one(follow_up.dict())
-                
-                return {"success": True, "message": "Payment reminder sent via WhatsApp"}
-            else:
-                return {"success": False, "message": "Failed to send WhatsApp reminder"}
-                
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-
-# Get Customer Outstanding Summary
-@api_router.get("/recovery/customer-summary")
-async def get_customer_summary():
-    """Get outstanding summary by customer"""
-    try:
-        invoices = await db.invoices.find(
-            {
-                "status": {"$ne": "cancelled"},
-                "payment_status": {"$in": ["unpaid", "partially_paid"]}
-            },
-            {"_id": 0}
-        ).to_list(1000)
-        
-        customer_summary = {}
-        today = datetime.now(timezone.utc)
-        
-        for invoice in invoices:
-            customer_name = invoice['customer_name']
-            
-            if customer_name not in customer_summary:
-                customer_summary[customer_name] = {
-                    "customer_name": customer_name,
-                    "customer_phone": invoice['customer_phone'],
-                    "customer_email": invoice.get('customer_email', ''),
-                    "total_outstanding": 0,
-                    "invoice_count": 0,
-                    "oldest_invoice_days": 0,
-                    "invoices": []
-                }
-            
-            outstanding = invoice['total_amount'] - invoice.get('paid_amount', 0)
-            due_date = datetime.fromisoformat(invoice['due_date'].replace('Z', '+00:00'))
-            days_overdue = (today - due_date).days
-            
-            if days_overdue > 0:
-                customer_summary[customer_name]['total_outstanding'] += outstanding
-                customer_summary[customer_name]['invoice_count'] += 1
-                customer_summary[customer_name]['oldest_invoice_days'] = max(
-                    customer_summary[customer_name]['oldest_invoice_days'],
-                    days_overdue
-                )
-                customer_summary[customer_name]['invoices'].append({
-                    "invoice_number": invoice['invoice_number'],
-                    "invoice_date": invoice['invoice_date'],
-                    "due_date": invoice['due_date'],
-                    "days_overdue": days_overdue,
-                    "outstanding": outstanding
-                })
-        
-        # Convert to list and sort by total outstanding
-        result = list(customer_summary.values())
-        result.sort(key=lambda x: x['total_outstanding'], reverse=True)
-        
-        return result
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    shutdown_password_pools()
+    await close_whatsapp_client()
+    client.close()
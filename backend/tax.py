@@ -0,0 +1,282 @@
+# GST Tax Engine
+# Exact document and line totals in integer paise. Every amount is rounded half-up to the paisa
+# at one defined point, so documents always add up:
+#   line gross       = quantity x price
+#   line discount    = gross x discount %                     (rounded per line)
+#   overall discount = taxable x % (or the flat amount), shared across lines in proportion
+#                      to their taxable value; leftover paise go to the largest remainders
+#   line GST         = (taxable - overall share) x GST rate   (rounded per line)
+#   CGST / SGST      = half each, the odd paisa to CGST; IGST = all of it when interstate
+#   document totals  = sums of the line amounts
+# Lines of many documents are computed together with NumPy integer arrays; a single document
+# takes the same steps on Python ints. No database access.
+# document_totals is the plain float loop, for single documents whose line amounts are not stored
+# (quotations, orders, purchases): per call it is cheaper than the exact steps in Python.
+
+import numpy as np
+
+# Fixed-point scales of the inputs: quantity to 0.001, price to the paisa, percentages to 0.01%
+QUANTITY_SCALE = 1000
+PAISE = 100
+PERCENT_SCALE = 10000  # basis points of a whole
+
+# Products of two amounts above this could overflow int64; such batches fall back to Python ints
+INT64_SAFE = 2 ** 62
+
+
+def _fixed(values, scale: int) -> np.ndarray:
+    if not isinstance(values, np.ndarray):
+        values = np.fromiter(values, dtype=np.float64, count=len(values))
+    return np.rint(values * scale).astype(np.int64)
+
+
+def _div_half_up(numerator, denominator):
+    """Integer division rounded half away from zero (numerators here are never negative)"""
+    return (2 * numerator + denominator) // (2 * denominator)
+
+
+def _allocate(amounts, weights, weight_totals, groups):
+    """Split amounts[group] across the rows of each group in proportion to weights, exactly:
+    floor shares first, then one paisa each to the rows with the largest remainders (earlier rows win ties)"""
+    discounted = amounts[groups] > 0
+    if not discounted.all():
+        # Only the rows of discounted documents take a share
+        shares = np.zeros(len(groups), dtype=np.int64)
+        shares[discounted] = _allocate(amounts, weights[discounted], weight_totals, groups[discounted])
+        return shares
+    if int(amounts.max()) * int(max(weights.max(initial=0), 1)) >= INT64_SAFE:
+        return _allocate_exact(amounts, weights, weight_totals, groups)
+
+    safe_totals = np.where(weight_totals == 0, 1, weight_totals)
+    numerators = amounts[groups] * weights
+    shares = numerators // safe_totals[groups]
+    remainders = numerators % safe_totals[groups]
+
+    leftover = amounts - np.bincount(groups, weights=shares, minlength=len(amounts)).astype(np.int64)
+    leftover = np.where(weight_totals == 0, 0, leftover)
+    # Rank by remainder only the rows of groups with paise left over
+    rows = np.flatnonzero(leftover[groups] > 0)
+    top = int(remainders.max(initial=0))
+    if len(amounts) * (top + 1) < INT64_SAFE:
+        # Group, then largest remainder, in one stable sort key (a single key sorts far faster than lexsort)
+        ranked = rows[np.argsort(groups[rows] * (top + 1) + (top - remainders[rows]), kind="stable")]
+    else:
+        ranked = rows[np.lexsort((rows, -remainders[rows], groups[rows]))]
+    ranked_groups = groups[ranked]
+    group_starts = np.searchsorted(ranked_groups, np.arange(len(amounts)))
+    shares[ranked] += np.arange(len(ranked)) - group_starts[ranked_groups] < leftover[ranked_groups]
+    return shares
+
+
+def _largest_remainder(amount: int, weights: list, total: int) -> list:
+    """Python-int split of amount across weights (summing to total), same rule as _allocate"""
+    if not total:
+        return [0] * len(weights)
+    parts = [divmod(amount * weight, total) for weight in weights]
+    shares = [share for share, _ in parts]
+    leftover = amount - sum(shares)
+    for i in sorted(range(len(parts)), key=lambda i: -parts[i][1])[:leftover]:
+        shares[i] += 1
+    return shares
+
+
+def _allocate_exact(amounts, weights, weight_totals, groups):
+    """Same split with Python integers, for amounts too large for int64 products"""
+    shares = [0] * len(groups)
+    rows_by_group = {}
+    for row, group in enumerate(groups.tolist()):
+        rows_by_group.setdefault(group, []).append(row)
+    for group, rows in rows_by_group.items():
+        split = _largest_remainder(int(amounts[group]), [int(weights[row]) for row in rows], int(weight_totals[group]))
+        for row, share in zip(rows, split):
+            shares[row] = share
+    return np.asarray(shares, dtype=np.int64)
+
+
+def compute_tax_batch(quantities, prices, discount_percents, gst_rates, documents, document_count: int,
+                      overall_discount_types=None, overall_discount_values=None, interstate=None) -> dict:
+    """Line and document amounts, in paise, for the lines of document_count documents.
+    Line inputs are parallel sequences; documents[i] is the document position of line i.
+    Per-document inputs: overall discount type ("percentage" or "amount"), its value, interstate flag."""
+    documents = np.asarray(documents, dtype=np.int64)
+    gross = _div_half_up(_fixed(quantities, QUANTITY_SCALE) * _fixed(prices, PAISE), QUANTITY_SCALE)
+    discount = _div_half_up(gross * _fixed(discount_percents, PAISE), PERCENT_SCALE)
+    taxable = gross - discount
+
+    def per_document(values):
+        return np.bincount(documents, weights=values, minlength=document_count).astype(np.int64)
+
+    document_taxable = per_document(taxable)
+
+    overall = np.zeros(document_count, dtype=np.int64)
+    if overall_discount_values is not None:
+        values = np.asarray(overall_discount_values, dtype=np.float64)
+        by_amount = np.asarray([t == "amount" for t in overall_discount_types], dtype=bool)
+        percent_discount = _div_half_up(document_taxable * _fixed(np.where(by_amount, 0, values), PAISE), PERCENT_SCALE)
+        overall = np.where(by_amount, _fixed(np.where(by_amount, values, 0), PAISE), percent_discount)
+        # A document can't be discounted below zero
+        overall = np.clip(overall, 0, document_taxable)
+
+    if overall.any():
+        share = _allocate(overall, taxable, document_taxable, documents)
+    else:
+        share = np.zeros_like(taxable)
+    final_taxable = taxable - share
+
+    gst = _div_half_up(final_taxable * _fixed(gst_rates, PAISE), PERCENT_SCALE)
+    line_interstate = np.zeros(len(documents), dtype=bool) if interstate is None \
+        else np.asarray(interstate, dtype=bool)[documents]
+    igst = np.where(line_interstate, gst, 0)
+    intrastate_gst = gst - igst
+    cgst = intrastate_gst - intrastate_gst // 2
+    sgst = intrastate_gst // 2
+
+    lines = {
+        "gross": gross, "discount": discount, "taxable": taxable, "overall_discount": share,
+        "final_taxable": final_taxable, "gst": gst, "cgst": cgst, "sgst": sgst, "igst": igst
+    }
+    totals = {
+        "subtotal": per_document(gross),
+        "total_discount": per_document(discount),
+        "overall_discount_amount": per_document(share),
+        "taxable_amount": per_document(final_taxable),
+        "cgst_amount": per_document(cgst),
+        "sgst_amount": per_document(sgst),
+        "igst_amount": per_document(igst),
+        "total_gst": per_document(gst),
+    }
+    totals["grand_total"] = totals["taxable_amount"] + totals["total_gst"]
+    return {"lines": lines, "documents": totals}
+
+
+def to_rupees(paise) -> float:
+    return int(paise) / PAISE
+
+
+def to_rupee_lists(amounts: dict) -> dict:
+    """{key: paise array} -> {key: list of rupee floats}"""
+    return {key: (values / PAISE).tolist() for key, values in amounts.items()}
+
+
+def document_totals(lines: list, is_interstate: bool = False, overall_discount_type: str = "percentage",
+                    overall_discount_value: float = 0.0) -> dict:
+    """Totals of one document in rupee floats, unrounded, in one pass over
+    (quantity, price, discount_percent, gst_rate) tuples. The overall discount scales every line's
+    taxable value by the same factor, so the GST is scaled once instead of per line."""
+    subtotal = total_discount = line_gst = 0.0
+    for quantity, price, discount_percent, gst_rate in lines:
+        item_total = quantity * price
+        subtotal += item_total
+        if discount_percent:
+            discount_amount = item_total * (discount_percent / 100)
+            total_discount += discount_amount
+            item_total -= discount_amount
+        line_gst += item_total * gst_rate
+    amount_after_item_discount = subtotal - total_discount
+
+    overall_discount_amount = 0.0
+    if overall_discount_value > 0:
+        if overall_discount_type == "percentage":
+            overall_discount_amount = amount_after_item_discount * (overall_discount_value / 100)
+        else:
+            overall_discount_amount = overall_discount_value
+    taxable_amount = amount_after_item_discount - overall_discount_amount
+    total_gst = line_gst / 100
+    if overall_discount_amount and amount_after_item_discount > 0:
+        total_gst *= taxable_amount / amount_after_item_discount
+
+    igst_amount = total_gst if is_interstate else 0.0
+    return {
+        "subtotal": subtotal,
+        "total_discount": total_discount,
+        "overall_discount_amount": overall_discount_amount,
+        "taxable_amount": taxable_amount,
+        "cgst_amount": (total_gst - igst_amount) / 2,
+        "sgst_amount": (total_gst - igst_amount) / 2,
+        "igst_amount": igst_amount,
+        "total_gst": total_gst,
+        "grand_total": taxable_amount + total_gst
+    }
+
+
+def compute_document_tax(lines: list, is_interstate: bool = False, overall_discount_type: str = "percentage",
+                         overall_discount_value: float = 0.0, include_lines: bool = False) -> dict:
+    """Totals of one document in rupees. lines are (quantity, price, discount_percent, gst_rate) tuples.
+    With include_lines, also returns the per-line amounts under "lines", in the same order.
+    Same arithmetic as compute_tax_batch on Python ints - for a handful of lines array setup costs more than the math.
+    Used where the line amounts are kept (the invoice HSN summary), so they add up to the stored totals."""
+    gross, taxable, rates = [], [], []
+    total_discount = 0
+    for quantity, price, discount_percent, gst_rate in lines:
+        line_gross = (2 * round(quantity * QUANTITY_SCALE) * round(price * PAISE) + QUANTITY_SCALE) // (2 * QUANTITY_SCALE)
+        line_discount = (2 * line_gross * round(discount_percent * PAISE) + PERCENT_SCALE) // (2 * PERCENT_SCALE) \
+            if discount_percent else 0
+        gross.append(line_gross)
+        taxable.append(line_gross - line_discount)
+        rates.append(round(gst_rate * PAISE))
+        total_discount += line_discount
+    document_taxable = sum(taxable)
+
+    overall = 0
+    if overall_discount_value:
+        if overall_discount_type == "amount":
+            overall = round(overall_discount_value * PAISE)
+        else:
+            overall = _div_half_up(document_taxable * round(overall_discount_value * PAISE), PERCENT_SCALE)
+        overall = min(max(overall, 0), document_taxable)
+    final_taxable = [t - s for t, s in zip(taxable, _largest_remainder(overall, taxable, document_taxable))] \
+        if overall else taxable
+    gst = [(2 * amount * rate + PERCENT_SCALE) // (2 * PERCENT_SCALE) for amount, rate in zip(final_taxable, rates)]
+
+    taxable_amount = sum(final_taxable)
+    total_gst = sum(gst)
+    if is_interstate:
+        cgst_amount = sgst_amount = 0
+        igst_amount = total_gst
+    else:
+        # Each line's odd paisa goes to its CGST, so the document's SGST is the sum of the line halves
+        sgst_amount = sum(line_gst // 2 for line_gst in gst)
+        cgst_amount = total_gst - sgst_amount
+        igst_amount = 0
+    totals = {
+        "subtotal": sum(gross) / PAISE,
+        "total_discount": total_discount / PAISE,
+        "overall_discount_amount": overall / PAISE,
+        "taxable_amount": taxable_amount / PAISE,
+        "cgst_amount": cgst_amount / PAISE,
+        "sgst_amount": sgst_amount / PAISE,
+        "igst_amount": igst_amount / PAISE,
+        "total_gst": total_gst / PAISE,
+        "grand_total": (taxable_amount + total_gst) / PAISE
+    }
+
+    if include_lines:
+        totals["lines"] = []
+        for line_gross, line_taxable, line_final, line_gst in zip(gross, taxable, final_taxable, gst):
+            igst = line_gst if is_interstate else 0
+            sgst = (line_gst - igst) // 2
+            totals["lines"].append({
+                "gross": line_gross / PAISE, "discount": (line_gross - line_taxable) / PAISE,
+                "taxable": line_taxable / PAISE, "overall_discount": (line_taxable - line_final) / PAISE,
+                "final_taxable": line_final / PAISE, "gst": line_gst / PAISE,
+                "cgst": (line_gst - igst - sgst) / PAISE, "sgst": sgst / PAISE, "igst": igst / PAISE
+            })
+    return totals
+
+
+def group_line_tax(keys: list, quantities: list, lines: list) -> list:
+    """Sum line amounts (rupee dicts as returned under "lines") per key, in paise so the groups add up exactly.
+    Returns (key, quantity, amounts) in first-seen key order; amounts are taxable_amount, cgst_amount,
+    sgst_amount, igst_amount and total_gst in rupees."""
+    fields = (("taxable_amount", "final_taxable"), ("cgst_amount", "cgst"), ("sgst_amount", "sgst"),
+              ("igst_amount", "igst"), ("total_gst", "gst"))
+    groups = {}
+    for key, quantity, line in zip(keys, quantities, lines):
+        group = groups.setdefault(key, [0.0, dict.fromkeys((name for name, _ in fields), 0)])
+        group[0] += quantity
+        for name, field in fields:
+            group[1][name] += round(line[field] * PAISE)
+    return [
+        (key, quantity, {name: paise / PAISE for name, paise in amounts.items()})
+        for key, (quantity, amounts) in groups.items()
+    ]
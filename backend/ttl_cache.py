@@ -0,0 +1,49 @@
+# In-process LRU cache with a time-to-live
+# Entries expire ttl seconds after they were stored; once maxsize is reached the least recently
+# used entry is evicted. Not shared between worker processes - keep the ttl short where other
+# workers can change the underlying data.
+
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key, _MISSING)
+        if entry is _MISSING:
+            return default
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self.entries[key]
+            return default
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def pop(self, key):
+        self.entries.pop(key, None)
+
+    def pop_where(self, predicate) -> int:
+        """Drop every entry whose value matches predicate; returns how many were dropped"""
+        keys = [key for key, (_, value) in self.entries.items() if predicate(value)]
+        for key in keys:
+            del self.entries[key]
+        return len(keys)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,111 @@
+# Inventory Valuation Engine
+# Keeps a running quantity/value per item as stock moves, using either
+# weighted average cost or FIFO cost layers. Pure functions - no database access.
+
+WEIGHTED_AVERAGE = "weighted_average"
+FIFO = "fifo"
+VALUATION_METHODS = (WEIGHTED_AVERAGE, FIFO)
+
+# Quantities closer to zero than this are treated as zero (float noise from repeated $inc)
+QUANTITY_EPSILON = 1e-9
+
+
+def new_item_state(item_type: str, item_id: str, item_name: str = "") -> dict:
+    """Empty valuation state for an item that has never been valued"""
+    return {
+        "key": f"{item_type}:{item_id}",
+        "item_type": item_type,
+        "item_id": item_id,
+        "item_name": item_name,
+        "quantity": 0.0,
+        "value": 0.0,
+        "average_cost": 0.0,
+        "layers": [],  # FIFO only: [{"quantity", "unit_cost"}], oldest first
+        "version": 0
+    }
+
+
+def receive(state: dict, quantity: float, unit_cost: float, method: str) -> float:
+    """Add quantity at unit_cost; returns the value added"""
+    value = quantity * unit_cost
+
+    if method == FIFO:
+        remaining = quantity
+        # Stock that went negative is made good first and never becomes a layer
+        if state['quantity'] < 0:
+            remaining -= min(quantity, -state['quantity'])
+        if remaining > QUANTITY_EPSILON:
+            state['layers'].append({"quantity": remaining, "unit_cost": unit_cost})
+
+    prior_quantity = state['quantity']
+    state['quantity'] += quantity
+    if prior_quantity < 0:
+        # The receipt covers the negative part at its own cost; what is left on hand is valued at that cost
+        state['value'] = state['quantity'] * unit_cost
+    else:
+        state['value'] += value
+    if method == FIFO and state['quantity'] >= 0:
+        state['value'] = sum(layer['quantity'] * layer['unit_cost'] for layer in state['layers'])
+    if abs(state['quantity']) <= QUANTITY_EPSILON:
+        state['quantity'] = 0.0
+        state['value'] = 0.0
+    if state['quantity'] > 0:
+        state['average_cost'] = state['value'] / state['quantity']
+    elif unit_cost:
+        state['average_cost'] = unit_cost
+    return value
+
+
+def issue(state: dict, quantity: float, method: str) -> float:
+    """Take quantity out; returns its cost (the value removed)"""
+    if method == FIFO:
+        cost = 0.0
+        remaining = quantity
+        layers = state['layers']
+        while remaining > QUANTITY_EPSILON and layers:
+            layer = layers[0]
+            taken = min(remaining, layer['quantity'])
+            cost += taken * layer['unit_cost']
+            layer['quantity'] -= taken
+            remaining -= taken
+            if layer['quantity'] <= QUANTITY_EPSILON:
+                layers.pop(0)
+        # Issuing more than is on hand: cost the shortfall at the last known cost
+        cost += remaining * state['average_cost']
+    else:
+        cost = quantity * state['average_cost']
+
+    state['quantity'] -= quantity
+    state['value'] -= cost
+    if abs(state['quantity']) <= QUANTITY_EPSILON:
+        state['quantity'] = 0.0
+        state['value'] = 0.0
+        state['layers'] = []
+    if state['quantity'] > 0:
+        state['average_cost'] = state['value'] / state['quantity']
+    return cost
+
+
+def value_movements(state: dict, movements: list, method: str, consumed_cost: dict = None) -> float:
+    """Post an item's movements in order, writing unit_cost and signed value onto each movement.
+    Receipts without a unit_cost come in at the current average cost, except production output,
+    which carries the cost of the materials consumed for the same production order (consumed_cost).
+    Returns the change in the item's value."""
+    value_before = state['value']
+    for movement in movements:
+        quantity = movement['quantity']
+        if quantity < 0:
+            cost = issue(state, -quantity, method)
+            movement['value'] = -cost
+            movement['unit_cost'] = cost / -quantity
+            if consumed_cost is not None and movement['source_type'] == "production_consume":
+                consumed_cost[movement['source_id']] = consumed_cost.get(movement['source_id'], 0.0) + cost
+        elif quantity > 0:
+            unit_cost = movement.get('unit_cost')
+            if unit_cost is None and movement['source_type'] == "production_output" and consumed_cost is not None:
+                unit_cost = consumed_cost.get(movement['source_id'], 0.0) / quantity
+            if unit_cost is None:
+                unit_cost = state['average_cost']
+            movement['value'] = receive(state, quantity, unit_cost, method)
+            movement['unit_cost'] = unit_cost
+    return state['value'] - value_before
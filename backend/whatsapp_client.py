@@ -0,0 +1,259 @@
+# WhatsApp Service Client
+# One pooled keep-alive HTTP client to the WhatsApp service for the whole application, opened at
+# startup and closed at shutdown. The connection limits cap how many calls run at once.
+# Failed calls are retried with exponential backoff: GETs on any connection error, timeout or 5xx,
+# sends (POST) only when the request never reached the service, so a message is not sent twice.
+# Latency is recorded per endpoint.
+# A circuit breaker keeps a dead or logged-out service from tying up requests: it opens after
+# WHATSAPP_BREAKER_FAILURES consecutive failed calls, or when /status (or /qr) reports the service
+# disconnected. Waiting too long for a free pooled connection (PoolTimeout) is our own congestion,
+# not the service failing, so it doesn't count. While open, calls fail at once with
+# WhatsAppUnavailable - all of them when the service is failing, only sends when it is up but
+# logged out (/status, /qr and /disconnect still pass so the QR login works). A background probe
+# checks /status every WHATSAPP_BREAKER_RESET_SECONDS (half-open) and closes the breaker once the
+# service answers connected.
+
+import asyncio
+import os
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Optional
+
+import httpx
+
+WHATSAPP_SERVICE_URL = os.environ.get('WHATSAPP_SERVICE_URL', 'http://localhost:3001')
+WHATSAPP_MAX_CONNECTIONS = int(os.environ.get('WHATSAPP_MAX_CONNECTIONS', '10'))
+WHATSAPP_MAX_KEEPALIVE = int(os.environ.get('WHATSAPP_MAX_KEEPALIVE', '5'))
+WHATSAPP_CONNECT_TIMEOUT = float(os.environ.get('WHATSAPP_CONNECT_TIMEOUT', '5'))
+# How long a call may wait for a free connection when all are busy
+WHATSAPP_POOL_TIMEOUT = float(os.environ.get('WHATSAPP_POOL_TIMEOUT', '30'))
+WHATSAPP_RETRIES = int(os.environ.get('WHATSAPP_RETRIES', '2'))
+WHATSAPP_BACKOFF_SECONDS = float(os.environ.get('WHATSAPP_BACKOFF_SECONDS', '0.5'))
+WHATSAPP_BREAKER_FAILURES = int(os.environ.get('WHATSAPP_BREAKER_FAILURES', '5'))
+WHATSAPP_BREAKER_RESET_SECONDS = float(os.environ.get('WHATSAPP_BREAKER_RESET_SECONDS', '15'))
+WHATSAPP_PROBE_TIMEOUT = 5.0
+
+# Calls that still go through while the service is reachable but logged out
+CONTROL_PATHS = ("/status", "/qr", "/disconnect")
+
+# Latency samples kept per endpoint for the percentiles
+LATENCY_SAMPLES = 500
+
+_client: Optional[httpx.AsyncClient] = None
+_metrics = {}
+
+
+class WhatsAppUnavailable(Exception):
+    """Raised without calling the service while the circuit breaker is open"""
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"  # closed, open, half_open
+        self.reason = None  # failing, disconnected
+        self.failures = 0
+        self.last_error = None
+        self.opened_at = None
+        self.probe_at = 0.0  # monotonic time of the next half-open probe
+
+    def allows(self, path: str) -> bool:
+        if self.state == "closed":
+            return True
+        return self.reason == "disconnected" and path in CONTROL_PATHS
+
+    def check(self, path: str):
+        if not self.allows(path):
+            raise WhatsAppUnavailable(f"WhatsApp service unavailable ({self.reason}): {self.last_error}")
+
+    def trip(self, reason: str, error: str):
+        if self.state != "open" or self.reason != reason:
+            self.opened_at = datetime.now(timezone.utc).isoformat()
+        self.state = "open"
+        self.reason = reason
+        self.last_error = error
+        self.probe_at = time.monotonic() + self.reset_seconds
+
+    def close(self):
+        self.state = "closed"
+        self.reason = None
+        self.failures = 0
+        self.opened_at = None
+
+    def record_success(self):
+        self.failures = 0
+        if self.reason == "failing":
+            self.close()
+
+    def record_failure(self, error: str):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.trip("failing", error)
+        else:
+            self.last_error = error
+
+    def record_connected(self, connected: bool):
+        if connected:
+            self.close()
+        else:
+            self.failures = 0
+            self.trip("disconnected", "WhatsApp is not connected")
+
+    def probe_due(self) -> bool:
+        return self.state == "open" and time.monotonic() >= self.probe_at
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state,
+            "reason": self.reason,
+            "consecutive_failures": self.failures,
+            "last_error": self.last_error,
+            "opened_at": self.opened_at,
+            "next_probe_in_seconds": round(max(0.0, self.probe_at - time.monotonic()), 1)
+            if self.state == "open" else None
+        }
+
+
+breaker = CircuitBreaker(WHATSAPP_BREAKER_FAILURES, WHATSAPP_BREAKER_RESET_SECONDS)
+
+
+def _new_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        base_url=WHATSAPP_SERVICE_URL,
+        limits=httpx.Limits(max_connections=WHATSAPP_MAX_CONNECTIONS,
+                            max_keepalive_connections=WHATSAPP_MAX_KEEPALIVE),
+        timeout=httpx.Timeout(10.0, connect=WHATSAPP_CONNECT_TIMEOUT, pool=WHATSAPP_POOL_TIMEOUT)
+    )
+
+
+async def start_whatsapp_client():
+    global _client
+    if _client is None:
+        _client = _new_client()
+
+
+async def close_whatsapp_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def get_whatsapp_client() -> httpx.AsyncClient:
+    """The shared client; opened on first use if startup hasn't run (scripts, tests)"""
+    global _client
+    if _client is None:
+        _client = _new_client()
+    return _client
+
+
+def _retryable(method: str, error: Exception) -> bool:
+    # Nothing was sent if the connection couldn't be made or no pooled connection came free
+    if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return True
+    if method != "GET":
+        return False
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+def _record(path: str, elapsed_ms: float, failed: bool, retried: bool):
+    metric = _metrics.setdefault(path, {
+        "calls": 0, "errors": 0, "retries": 0, "total_ms": 0.0, "max_ms": 0.0,
+        "samples": deque(maxlen=LATENCY_SAMPLES)
+    })
+    metric['calls'] += 1
+    metric['errors'] += failed
+    metric['retries'] += retried
+    metric['total_ms'] += elapsed_ms
+    metric['max_ms'] = max(metric['max_ms'], elapsed_ms)
+    metric['samples'].append(elapsed_ms)
+
+
+def _error_text(error: Exception) -> str:
+    return str(error) or type(error).__name__
+
+
+async def whatsapp_request(method: str, path: str, json: dict = None, timeout: float = 10.0) -> dict:
+    """Call the WhatsApp service and return its JSON reply. timeout bounds each attempt's wait for the reply.
+    Raises the last httpx error once retries are used up, or WhatsAppUnavailable while the breaker is open."""
+    breaker.check(path)
+    client = get_whatsapp_client()
+    request_timeout = httpx.Timeout(timeout, connect=WHATSAPP_CONNECT_TIMEOUT, pool=WHATSAPP_POOL_TIMEOUT)
+    attempt = 0
+    while True:
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, path, json=json, timeout=request_timeout)
+            if method == "GET":
+                response.raise_for_status()
+            result = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            retry = attempt < WHATSAPP_RETRIES and _retryable(method, e)
+            _record(path, (time.perf_counter() - started) * 1000, failed=True, retried=retry)
+            if not retry:
+                # A pool timeout never reached the service, so it says nothing about its health
+                if not isinstance(e, httpx.PoolTimeout):
+                    breaker.record_failure(_error_text(e))
+                raise
+            await asyncio.sleep(WHATSAPP_BACKOFF_SECONDS * 2 ** attempt)
+            attempt += 1
+            continue
+        _record(path, (time.perf_counter() - started) * 1000, failed=False, retried=False)
+        # Sends return the service's error body as is; a 5xx still counts against the breaker
+        if response.status_code >= 500:
+            breaker.record_failure(f"{path} returned {response.status_code}: {result}")
+        else:
+            breaker.record_success()
+            if isinstance(result, dict) and 'connected' in result and path in ("/status", "/qr"):
+                breaker.record_connected(bool(result['connected']))
+        return result
+
+
+async def probe_whatsapp_service():
+    """Background task: while the breaker is open, ask /status whether the service is back (half-open)"""
+    while True:
+        await asyncio.sleep(min(1.0, WHATSAPP_BREAKER_RESET_SECONDS))
+        if not breaker.probe_due():
+            continue
+        breaker.state = "half_open"
+        try:
+            response = await get_whatsapp_client().get(
+                "/status", timeout=httpx.Timeout(WHATSAPP_PROBE_TIMEOUT, connect=WHATSAPP_CONNECT_TIMEOUT)
+            )
+            response.raise_for_status()
+            connected = bool(response.json().get('connected'))
+        except (httpx.HTTPError, ValueError) as e:
+            breaker.record_failure(_error_text(e))
+        else:
+            breaker.record_connected(connected)
+
+
+def _percentile(ordered: list, fraction: float) -> float:
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def get_whatsapp_metrics() -> dict:
+    """Per-endpoint call counts and latency (ms) of calls to the WhatsApp service, one entry per attempt"""
+    endpoints = {}
+    for path, metric in _metrics.items():
+        ordered = sorted(metric['samples'])
+        endpoints[path] = {
+            "calls": metric['calls'],
+            "errors": metric['errors'],
+            "retries": metric['retries'],
+            "avg_ms": round(metric['total_ms'] / metric['calls'], 1),
+            "p50_ms": round(_percentile(ordered, 0.50), 1),
+            "p95_ms": round(_percentile(ordered, 0.95), 1),
+            "p99_ms": round(_percentile(ordered, 0.99), 1),
+            "max_ms": round(metric['max_ms'], 1)
+        }
+    return {
+        "service_url": WHATSAPP_SERVICE_URL,
+        "max_connections": WHATSAPP_MAX_CONNECTIONS,
+        "circuit": breaker.snapshot(),
+        "endpoints": endpoints
+    }
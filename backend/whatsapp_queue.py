@@ -0,0 +1,224 @@
+# WhatsApp Outbound Queue
+# Sends are saved as jobs in the whatsapp_jobs collection and delivered by background workers, so a
+# request that sends something on WhatsApp returns as soon as the job is stored.
+# - A worker claims a job with a lease; if the worker dies the job is picked up again once the lease ends.
+# - Rate limits per phone number and overall are fixed one-minute windows counted in Mongo, so they
+#   hold across all worker processes. A job over a limit waits for the next window.
+# - Failed sends are retried with exponential backoff, then marked failed after WHATSAPP_JOB_MAX_ATTEMPTS.
+#   Delivery is at least once: a send that timed out may have gone through before it is retried.
+# - While the WhatsApp circuit breaker is open, jobs wait for its next probe instead of using up attempts.
+# - invoice_id only links a job to its invoice for lookups; sending does not change the invoice.
+# - Other modules follow outcomes through job_finished_hooks (e.g. reminder campaigns, by campaign_id).
+
+import asyncio
+import logging
+import os
+import socket
+from datetime import datetime, timezone, timedelta
+from uuid import uuid4
+
+from pymongo import ReturnDocument
+
+from whatsapp_client import whatsapp_request, breaker, WHATSAPP_BREAKER_RESET_SECONDS
+
+WHATSAPP_QUEUE_WORKERS = int(os.environ.get('WHATSAPP_QUEUE_WORKERS', '2'))
+# Longer than the slowest send (60 s reply timeout plus the client's own retries)
+WHATSAPP_JOB_LEASE_SECONDS = float(os.environ.get('WHATSAPP_JOB_LEASE_SECONDS', '180'))
+WHATSAPP_JOB_MAX_ATTEMPTS = int(os.environ.get('WHATSAPP_JOB_MAX_ATTEMPTS', '5'))
+WHATSAPP_JOB_BACKOFF_SECONDS = float(os.environ.get('WHATSAPP_JOB_BACKOFF_SECONDS', '30'))
+WHATSAPP_JOB_MAX_BACKOFF_SECONDS = 3600
+# Sends per minute
+WHATSAPP_RATE_PER_NUMBER = int(os.environ.get('WHATSAPP_RATE_PER_NUMBER', '6'))
+WHATSAPP_RATE_GLOBAL = int(os.environ.get('WHATSAPP_RATE_GLOBAL', '30'))
+# Idle workers look for due jobs this often (new jobs from this process wake them at once)
+WHATSAPP_QUEUE_POLL_SECONDS = float(os.environ.get('WHATSAPP_QUEUE_POLL_SECONDS', '2'))
+
+# Job kind -> (WhatsApp service endpoint, reply timeout)
+JOB_KINDS = {
+    "message": ("/send-message", 30.0),
+    "document": ("/send-document", 60.0),
+    "invoice": ("/send-invoice", 60.0)
+}
+JOB_STATUSES = ("queued", "sending", "sent", "failed")
+
+logger = logging.getLogger(__name__)
+_wakeup = asyncio.Event()
+
+# Coroutines called as hook(job, status, error) once a job is sent or has failed for good
+job_finished_hooks = []
+
+
+def get_db():
+    """Get database connection from server module"""
+    from server import db
+    return db
+
+
+async def ensure_whatsapp_jobs():
+    db = get_db()
+    await db.whatsapp_jobs.create_index("id", unique=True)
+    await db.whatsapp_jobs.create_index([("status", 1), ("next_attempt_at", 1)])
+    await db.whatsapp_jobs.create_index([("status", 1), ("lease_until", 1)])
+    await db.whatsapp_jobs.create_index("invoice_id")
+    await db.whatsapp_jobs.create_index("campaign_id")
+    await db.whatsapp_rate_limits.create_index("expires_at", expireAfterSeconds=0)
+
+
+def new_whatsapp_job(kind: str, payload: dict, invoice_id: str = None, campaign_id: str = None) -> dict:
+    """A queued job, not saved yet. payload is the WhatsApp service request body."""
+    if kind not in JOB_KINDS:
+        raise ValueError(f"Unknown WhatsApp job kind: {kind}")
+    now = datetime.now(timezone.utc).isoformat()
+    return {
+        "id": str(uuid4()),
+        "kind": kind,
+        "payload": payload,
+        "phone_number": payload.get("phone_number", ""),
+        "invoice_id": invoice_id,
+        "campaign_id": campaign_id,
+        "status": "queued",
+        "attempts": 0,
+        "next_attempt_at": now,
+        "lease_until": None,
+        "leased_by": None,
+        "last_error": None,
+        "result": None,
+        "created_at": now,
+        "updated_at": now,
+        "sent_at": None
+    }
+
+
+async def enqueue_whatsapp_job(kind: str, payload: dict, invoice_id: str = None) -> dict:
+    """Save a send for the workers and return the job"""
+    job = new_whatsapp_job(kind, payload, invoice_id=invoice_id)
+    await get_db().whatsapp_jobs.insert_one(dict(job))
+    _wakeup.set()
+    return job
+
+
+async def enqueue_whatsapp_jobs(jobs: list):
+    """Save jobs built with new_whatsapp_job in one write"""
+    if jobs:
+        await get_db().whatsapp_jobs.insert_many([dict(job) for job in jobs])
+        _wakeup.set()
+
+
+async def run_job_finished_hooks(job: dict, status: str, error: str = None):
+    for hook in job_finished_hooks:
+        try:
+            await hook(job, status, error)
+        except Exception as e:
+            logger.warning(f"WhatsApp job {job['id']} {status} hook failed: {e}")
+
+
+async def get_whatsapp_job(job_id: str):
+    return await get_db().whatsapp_jobs.find_one({"id": job_id}, {"_id": 0})
+
+
+async def claim_whatsapp_job(worker_id: str):
+    """Lease the next due job: queued ones whose time has come, or ones whose worker's lease ran out"""
+    now = datetime.now(timezone.utc)
+    return await get_db().whatsapp_jobs.find_one_and_update(
+        {"$or": [
+            {"status": "queued", "next_attempt_at": {"$lte": now.isoformat()}},
+            {"status": "sending", "lease_until": {"$lt": now.isoformat()}}
+        ]},
+        {"$set": {
+            "status": "sending",
+            "lease_until": (now + timedelta(seconds=WHATSAPP_JOB_LEASE_SECONDS)).isoformat(),
+            "leased_by": worker_id,
+            "updated_at": now.isoformat()
+        }},
+        sort=[("next_attempt_at", 1)],
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+
+
+async def take_rate_slot(key: str, limit: int, now: datetime) -> bool:
+    """Count one send against key's current minute; False once the minute's limit is used up"""
+    window = now.strftime("%Y%m%d%H%M")
+    counter = await get_db().whatsapp_rate_limits.find_one_and_update(
+        {"_id": f"{key}:{window}"},
+        {"$inc": {"count": 1}, "$setOnInsert": {"expires_at": now + timedelta(minutes=2)}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter['count'] <= limit
+
+
+async def update_leased_job(job: dict, worker_id: str, fields: dict):
+    """Write a job's outcome, unless another worker has taken it over since (lease expired)"""
+    fields = {**fields, "lease_until": None, "updated_at": datetime.now(timezone.utc).isoformat()}
+    result = await get_db().whatsapp_jobs.update_one(
+        {"id": job['id'], "status": "sending", "leased_by": worker_id},
+        {"$set": fields}
+    )
+    return result.matched_count == 1
+
+
+async def process_whatsapp_job(job: dict, worker_id: str):
+    now = datetime.now(timezone.utc)
+    path, timeout = JOB_KINDS[job['kind']]
+    if not breaker.allows(path):
+        await update_leased_job(job, worker_id, {
+            "status": "queued", "last_error": breaker.last_error,
+            "next_attempt_at": (now + timedelta(seconds=WHATSAPP_BREAKER_RESET_SECONDS)).isoformat()
+        })
+        return
+    if not (await take_rate_slot(f"number:{job['phone_number']}", WHATSAPP_RATE_PER_NUMBER, now)
+            and await take_rate_slot("global", WHATSAPP_RATE_GLOBAL, now)):
+        next_window = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        await update_leased_job(job, worker_id, {"status": "queued", "next_attempt_at": next_window.isoformat()})
+        return
+
+    attempts = job['attempts'] + 1
+    try:
+        result = await whatsapp_request("POST", path, json=job['payload'], timeout=timeout)
+        error = None if result.get('success') else (
+            result.get('error') or result.get('message') or "WhatsApp service reported a failure")
+    except Exception as e:
+        result, error = None, str(e) or type(e).__name__
+
+    now = datetime.now(timezone.utc)
+    if error is None:
+        sent_at = now.isoformat()
+        if await update_leased_job(job, worker_id, {"status": "sent", "attempts": attempts, "result": result,
+                                                    "last_error": None, "sent_at": sent_at}):
+            await run_job_finished_hooks(job, "sent")
+    elif attempts >= WHATSAPP_JOB_MAX_ATTEMPTS:
+        if await update_leased_job(job, worker_id, {"status": "failed", "attempts": attempts, "result": result,
+                                                    "last_error": error}):
+            await run_job_finished_hooks(job, "failed", error)
+    else:
+        delay = min(WHATSAPP_JOB_BACKOFF_SECONDS * 2 ** (attempts - 1), WHATSAPP_JOB_MAX_BACKOFF_SECONDS)
+        await update_leased_job(job, worker_id, {
+            "status": "queued", "attempts": attempts, "result": result, "last_error": error,
+            "next_attempt_at": (now + timedelta(seconds=delay)).isoformat()
+        })
+
+
+async def whatsapp_worker(worker_id: str):
+    while True:
+        try:
+            job = await claim_whatsapp_job(worker_id)
+            if job is None:
+                _wakeup.clear()
+                try:
+                    await asyncio.wait_for(_wakeup.wait(), WHATSAPP_QUEUE_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await process_whatsapp_job(job, worker_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"WhatsApp worker {worker_id} failed, retrying: {e}")
+            await asyncio.sleep(WHATSAPP_QUEUE_POLL_SECONDS)
+
+
+def start_whatsapp_workers() -> list:
+    """Worker tasks for this process; the caller cancels them on shutdown"""
+    prefix = f"{socket.gethostname()}-{os.getpid()}"
+    return [asyncio.create_task(whatsapp_worker(f"{prefix}-{n}")) for n in range(WHATSAPP_QUEUE_WORKERS)]
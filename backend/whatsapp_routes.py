@@ -1,14 +1,14 @@
 # WhatsApp Integration Routes
 # Add this to your FastAPI backend
 
-import httpx
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 from typing import Optional
 
-whatsapp_router = APIRouter(prefix="/api/whatsapp", tags=["whatsapp"])
+from whatsapp_client import whatsapp_request, get_whatsapp_metrics, breaker, WhatsAppUnavailable
+from whatsapp_queue import JOB_KINDS, JOB_STATUSES, enqueue_whatsapp_job, get_whatsapp_job, get_db
 
-WHATSAPP_SERVICE_URL = "http://localhost:3001"
+whatsapp_router = APIRouter(prefix="/api/whatsapp", tags=["whatsapp"])
 
 class SendMessageRequest(BaseModel):
     phone_number: str
@@ -28,13 +28,18 @@ class SendInvoiceRequest(BaseModel):
     due_date: Optional[str] = "N/A"
     pdf_path: str
 
+class QueueJobRequest(BaseModel):
+    kind: str  # message, document, invoice
+    payload: dict  # body for the WhatsApp service, e.g. {"phone_number", "message"}
+    invoice_id: Optional[str] = None  # links the job to an invoice for lookups
+
 @whatsapp_router.get("/qr")
 async def get_whatsapp_qr():
     """Get QR code for WhatsApp authentication"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{WHATSAPP_SERVICE_URL}/qr", timeout=10.0)
-            return response.json()
+        return await whatsapp_request("GET", "/qr", timeout=10.0)
+    except WhatsAppUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get QR code: {str(e)}")
 
@@ -42,26 +47,28 @@ async def get_whatsapp_qr():
 async def get_whatsapp_status():
     """Get WhatsApp connection status"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{WHATSAPP_SERVICE_URL}/status", timeout=10.0)
-            return response.json()
+        status = await whatsapp_request("GET", "/status", timeout=10.0)
+    except WhatsAppUnavailable as e:
+        return {"connected": False, "error": str(e), "circuit": breaker.snapshot()}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get status: {str(e)}")
+    return {**status, "circuit": breaker.snapshot()}
 
 @whatsapp_router.post("/send-message")
 async def send_whatsapp_message(request: SendMessageRequest):
     """Send text message via WhatsApp"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{WHATSAPP_SERVICE_URL}/send-message",
-                json={
-                    "phone_number": request.phone_number,
-                    "message": request.message
-                },
-                timeout=30.0
-            )
-            return response.json()
+        return await whatsapp_request(
+            "POST",
+            "/send-message",
+            json={
+                "phone_number": request.phone_number,
+                "message": request.message
+            },
+            timeout=30.0
+        )
+    except WhatsAppUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to send message: {str(e)}")
 
@@ -69,18 +76,19 @@ async def send_whatsapp_message(request: SendMessageRequest):
 async def send_whatsapp_document(request: SendDocumentRequest):
     """Send document via WhatsApp"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{WHATSAPP_SERVICE_URL}/send-document",
-                json={
-                    "phone_number": request.phone_number,
-                    "file_path": request.file_path,
-                    "file_name": request.file_name,
-                    "caption": request.caption
-                },
-                timeout=60.0
-            )
-            return response.json()
+        return await whatsapp_request(
+            "POST",
+            "/send-document",
+            json={
+                "phone_number": request.phone_number,
+                "file_path": request.file_path,
+                "file_name": request.file_name,
+                "caption": request.caption
+            },
+            timeout=60.0
+        )
+    except WhatsAppUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to send document: {str(e)}")
 
@@ -88,20 +96,21 @@ async def send_whatsapp_document(request: SendDocumentRequest):
 async def send_invoice_whatsapp(request: SendInvoiceRequest):
     """Send invoice with PDF via WhatsApp"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{WHATSAPP_SERVICE_URL}/send-invoice",
-                json={
-                    "phone_number": request.phone_number,
-                    "invoice_number": request.invoice_number,
-                    "dealer_name": request.dealer_name,
-                    "amount": request.amount,
-                    "due_date": request.due_date,
-                    "pdf_path": request.pdf_path
-                },
-                timeout=60.0
-            )
-            return response.json()
+        return await whatsapp_request(
+            "POST",
+            "/send-invoice",
+            json={
+                "phone_number": request.phone_number,
+                "invoice_number": request.invoice_number,
+                "dealer_name": request.dealer_name,
+                "amount": request.amount,
+                "due_date": request.due_date,
+                "pdf_path": request.pdf_path
+            },
+            timeout=60.0
+        )
+    except WhatsAppUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to send invoice: {str(e)}")
 
@@ -109,8 +118,48 @@ async def send_invoice_whatsapp(request: SendInvoiceRequest):
 async def disconnect_whatsapp():
     """Disconnect from WhatsApp"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(f"{WHATSAPP_SERVICE_URL}/disconnect", timeout=10.0)
-            return response.json()
+        return await whatsapp_request("POST", "/disconnect", timeout=10.0)
+    except WhatsAppUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to disconnect: {str(e)}")
+
+@whatsapp_router.get("/metrics")
+async def get_whatsapp_service_metrics():
+    """Latency and error counts of calls to the WhatsApp service"""
+    return get_whatsapp_metrics()
+
+@whatsapp_router.post("/jobs")
+async def queue_whatsapp_job(request: QueueJobRequest):
+    """Queue a send for the background workers; returns at once with the job id"""
+    if request.kind not in JOB_KINDS:
+        raise HTTPException(status_code=400, detail=f"Invalid kind. Use one of: {', '.join(JOB_KINDS)}")
+    if not request.payload.get("phone_number"):
+        raise HTTPException(status_code=400, detail="payload.phone_number is required")
+    job = await enqueue_whatsapp_job(request.kind, request.payload, request.invoice_id)
+    return {"success": True, "job_id": job['id'], "status": job['status']}
+
+@whatsapp_router.get("/jobs")
+async def get_whatsapp_jobs(status: Optional[str] = None, invoice_id: Optional[str] = None, limit: int = 100):
+    """Recent jobs (newest first) and the number of jobs in each status"""
+    if status and status not in JOB_STATUSES:
+        raise HTTPException(status_code=400, detail=f"Invalid status. Use one of: {', '.join(JOB_STATUSES)}")
+    query = {}
+    if status:
+        query['status'] = status
+    if invoice_id:
+        query['invoice_id'] = invoice_id
+    jobs = await get_db().whatsapp_jobs.find(query, {"_id": 0}).sort("created_at", -1).to_list(min(limit, 1000))
+    counts = {
+        row['_id']: row['count']
+        async for row in get_db().whatsapp_jobs.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}])
+    }
+    return {"counts": {status_name: counts.get(status_name, 0) for status_name in JOB_STATUSES}, "jobs": jobs}
+
+@whatsapp_router.get("/jobs/{job_id}")
+async def get_whatsapp_job_status(job_id: str):
+    """Status of a queued send: queued, sending, sent or failed, with attempts and the last error"""
+    job = await get_whatsapp_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="WhatsApp job not found")
+    return job
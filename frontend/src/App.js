@@ -1,5 +1,6 @@
 import { useState, useEffect } from 'react';
 import { BrowserRouter, Routes, Route, Navigate } from 'react-router-dom';
+import axios from 'axios';
 import '@/App.css';
 import Layout from '@/components/Layout';
 import Login from '@/pages/Login';
@@ -81,6 +82,15 @@ import EmployeePortal from '@/pages/EmployeePortal';
 import EnhancedEmployeePortal from '@/pages/EnhancedEmployeePortal';
 import { Toaster } from '@/components/ui/sonner';
 
+// Send the login token with every API call; role and user changes require it
+axios.interceptors.request.use((config) => {
+  const token = localStorage.getItem('token');
+  if (token) {
+    config.headers.Authorization = `Bearer ${token}`;
+  }
+  return config;
+});
+
 function App() {
   const [user, setUser] = useState(null);
   const [loading, setLoading] = useState(true);
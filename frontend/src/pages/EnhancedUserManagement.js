@@ -87,50 +87,25 @@ const EnhancedUserManagement = () => {
 
   const handleBulkImport = async () => {
     try {
-      // Parse CSV/JSON data
-      const lines = bulkData.trim().split('\n');
-      const results = { success: [], failed: [] };
-      
-      for (let i = 1; i < lines.length; i++) { // Skip header
-        const line = lines[i].trim();
-        if (!line) continue;
-        
-        const [username, email, full_name, password, role] = line.split(',').map(s => s.trim());
-        
-        if (!username || !email || !full_name || !password) {
-          results.failed.push({ row: i + 1, reason: 'Missing required fields' });
-          continue;
-        }
-        
-        try {
-          await axios.post(`${API}/admin/users`, {
-            username,
-            email,
-            full_name,
-            password,
-            role: role || 'employee',
-            is_active: true
-          });
-          results.success.push({ row: i + 1, username });
-        } catch (error) {
-          results.failed.push({ 
-            row: i + 1, 
-            username, 
-            reason: error.response?.data?.detail || 'Failed to create' 
-          });
-        }
+      // Rows pasted without the header row use the template's column order
+      let csvData = bulkData.trim();
+      if (!csvData.toLowerCase().startsWith('username')) {
+        csvData = `username,email,full_name,password,role\n${csvData}`;
       }
       
-      toast.success(`Created ${results.success.length} users. ${results.failed.length} failed.`);
-      if (results.failed.length > 0) {
-        console.error('Failed users:', results.failed);
+      const response = await axios.post(`${API}/admin/users/bulk`, { csv: csvData });
+      const { created, failed, results } = response.data;
+      
+      toast.success(`Created ${created} users. ${failed} failed.`);
+      if (failed > 0) {
+        console.error('Failed users:', results.filter(result => !result.success));
       }
       
       setBulkData('');
       setShowBulkImport(false);
       fetchUsers();
     } catch (error) {
-      toast.error('Bulk import failed');
+      toast.error(error.response?.data?.detail || 'Bulk import failed');
     }
   };
 
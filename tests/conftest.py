@@ -0,0 +1,48 @@
+import os
+import sys
+
+import pytest
+
+# The backend modules import each other by bare name (python server.py / uvicorn server:app from backend/)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+
+class SessionlessCollection:
+    """Collection that drops session=, since mongomock has no sessions. Reads made "in a transaction"
+    still see its earlier writes, as they do inside a real one; nothing is rolled back on abort."""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, session=None, **kwargs):
+            return attr(*args, **kwargs)
+        return call
+
+
+class SessionlessDatabase:
+    def __init__(self, database):
+        self._database = database
+
+    def __getattr__(self, name):
+        return SessionlessCollection(getattr(self._database, name))
+
+    def __getitem__(self, name):
+        return SessionlessCollection(self._database[name])
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """The server module on a fresh in-memory database"""
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    os.environ.setdefault("DB_NAME", "test")
+    import server as server_module
+    client = mongomock_motor.AsyncMongoMockClient()
+    monkeypatch.setattr(server_module, "client", client)
+    monkeypatch.setattr(server_module, "db", SessionlessDatabase(client["test"]))
+    return server_module
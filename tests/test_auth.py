@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+
+@pytest.fixture
+def user(server):
+    server.auth_cache.clear()
+    asyncio.run(server.db.users.insert_one({"id": "u1", "username": "ravi", "full_name": "Ravi", "role": "employee",
+                                            "role_id": "r1", "is_active": True, "hashed_password": "x"}))
+    return server.create_access_token({"sub": "ravi"})
+
+
+def me(server, token):
+    return asyncio.run(server.get_current_user(None, token))
+
+
+def auth(server, token):
+    return asyncio.run(server.get_current_auth(None, token))
+
+
+def test_me_is_served_from_the_cache(server, user):
+    assert me(server, user)['full_name'] == "Ravi"
+    # A write behind the routes' back is not seen until the entry expires
+    asyncio.run(server.db.users.update_one({"id": "u1"}, {"$set": {"full_name": "Ravi K"}}))
+    assert me(server, user)['full_name'] == "Ravi"
+
+
+@pytest.mark.parametrize("write", [
+    lambda server: server.update_user("u1", {"full_name": "Ravi K"}),
+    lambda server: server.reset_user_password("u1", {"password": "secret"}),
+])
+def test_user_writes_drop_the_cached_user(server, user, write):
+    auth(server, user)
+    asyncio.run(write(server))
+    assert server.auth_cache.get("ravi") is None
+
+
+def test_deactivated_user_is_refused(server, user):
+    auth(server, user)
+    asyncio.run(server.update_user("u1", {"is_active": False}))
+    with pytest.raises(HTTPException) as raised:
+        auth(server, user)
+    assert raised.value.status_code == 401
+
+
+def test_deleted_user_is_not_found(server, user):
+    me(server, user)
+    asyncio.run(server.delete_user("u1"))
+    with pytest.raises(HTTPException) as raised:
+        me(server, user)
+    assert raised.value.status_code == 404
+    with pytest.raises(HTTPException) as raised:
+        auth(server, user)
+    assert raised.value.status_code == 401
+
+
+def test_role_update_drops_its_users(server, user):
+    asyncio.run(server.db.roles.insert_one({"id": "r1", "name": "Sales", "permissions": []}))
+    assert auth(server, user)['role']['name'] == "Sales"
+    asyncio.run(server.update_role("r1", {"name": "Sales Team"}))
+    assert auth(server, user)['role']['name'] == "Sales Team"
+
+
+def test_lookup_racing_a_write_is_not_cached(server, user, monkeypatch):
+    class WriteDuringLookup:
+        def __init__(self, db):
+            self.db = db
+
+        def __getattr__(self, name):
+            return getattr(self.db, name)
+
+        @property
+        def users(self):
+            users = self.db.users
+            find_one = users.find_one
+
+            async def find_then_write(*args, **kwargs):
+                found = await find_one(*args, **kwargs)
+                server.invalidate_auth_user("u1")
+                return found
+            users.find_one = find_then_write
+            return users
+    monkeypatch.setattr(server, "db", WriteDuringLookup(server.db))
+    assert auth(server, user)['user']['username'] == "ravi"
+    assert server.auth_cache.get("ravi") is None
+
+
+def test_role_changes_need_the_admin_permission(server, user, monkeypatch):
+    from fastapi.testclient import TestClient
+    client = TestClient(server.app)
+    monkeypatch.setattr(server, "role_permissions", {"r1": server.compile_role_permissions(
+        {"permissions": [{"module": "sales", "pages": ["/invoices"]}]})})
+    role = {"name": "Packers", "permissions": []}
+
+    assert client.post("/api/admin/roles", json=role).status_code == 401
+    response = client.post("/api/admin/roles", json=role, headers={"Authorization": f"Bearer {user}"})
+    assert response.status_code == 403
+    assert asyncio.run(server.db.roles.count_documents({})) == 0
+
+    asyncio.run(server.db.users.insert_one({"id": "u2", "username": "admin", "full_name": "Admin", "role": "admin"}))
+    admin_token = server.create_access_token({"sub": "admin"})
+    response = client.post("/api/admin/roles", json=role, headers={"Authorization": f"Bearer {admin_token}"})
+    assert response.status_code == 200
+    assert client.delete(f"/api/admin/users/u2?token={user}").status_code == 403
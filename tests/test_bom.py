@@ -0,0 +1,74 @@
+import pytest
+
+from bom import find_bom_cycle, flatten_bom, sub_assembly_ids
+
+
+def line(material_type, material_id, quantity, unit="kg"):
+    return {"material_type": material_type, "material_id": material_id, "material_name": material_id.upper(),
+            "quantity": quantity, "unit": unit}
+
+
+def test_sub_assembly_ids_are_the_product_lines():
+    assert sub_assembly_ids([line("raw", "r1", 1), line("product", "p2", 2), line("packing", "k1", 1)]) == ["p2"]
+
+
+def test_acyclic_graph_has_no_cycle():
+    boms = {
+        "a": [line("product", "b", 1), line("product", "c", 1)],
+        "b": [line("product", "c", 2)],
+        "c": [line("raw", "r1", 1)],
+    }
+    assert find_bom_cycle("a", boms) is None
+
+
+def test_product_using_itself_is_a_cycle():
+    assert find_bom_cycle("a", {"a": [line("product", "a", 1)]}) == ["a", "a"]
+
+
+def test_indirect_cycle_returns_the_path():
+    boms = {
+        "a": [line("raw", "r1", 1), line("product", "b", 1)],
+        "b": [line("product", "c", 1)],
+        "c": [line("product", "a", 1)],
+    }
+    assert find_bom_cycle("a", boms) == ["a", "b", "c", "a"]
+
+
+def test_cycle_found_past_a_shared_dead_end():
+    # d is reached twice without leading back; the cycle runs through e
+    boms = {
+        "a": [line("product", "b", 1), line("product", "d", 1), line("product", "e", 1)],
+        "b": [line("product", "d", 1)],
+        "d": [line("raw", "r1", 1)],
+        "e": [line("product", "a", 1)],
+    }
+    assert find_bom_cycle("a", boms) == ["a", "e", "a"]
+
+
+def test_flatten_multiplies_through_sub_assemblies():
+    boms = {
+        "a": [line("product", "b", 3), line("raw", "r2", 1)],
+        "b": [line("raw", "r1", 2), line("packing", "k1", 1, unit="pcs")],
+    }
+    flat = flatten_bom("a", boms, {})
+    assert flat[("raw_material", "r1")]['quantity'] == 6
+    assert flat[("packing_material", "k1")] == {"material_name": "K1", "unit": "pcs", "quantity": 3}
+    assert flat[("raw_material", "r2")]['quantity'] == 1
+
+
+def test_flatten_adds_shared_sub_assemblies_once_per_use():
+    boms = {
+        "a": [line("product", "b", 1), line("product", "c", 2)],
+        "b": [line("product", "c", 3)],
+        "c": [line("raw", "r1", 0.5)],
+    }
+    memo = {}
+    flat = flatten_bom("a", boms, memo)
+    # 1 x 3 x 0.5 through b, plus 2 x 0.5 directly
+    assert flat[("raw_material", "r1")]['quantity'] == pytest.approx(2.5)
+    assert set(memo) == {"a", "b", "c"}
+
+
+def test_sub_assembly_without_a_bom_stays_a_product_line():
+    flat = flatten_bom("a", {"a": [line("product", "bought", 4, unit="pcs")]}, {})
+    assert flat == {("product", "bought"): {"material_name": "BOUGHT", "unit": "pcs", "quantity": 4}}
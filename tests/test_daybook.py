@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+
+def add(server, date, credit=0.0, debit=0.0, purpose=""):
+    entry = server.DayBookEntryCreate(date=date, description=f"{date} {credit}-{debit}", purpose=purpose,
+                                      credit=credit, debit=debit)
+    return asyncio.run(server.create_daybook_entry(entry))
+
+
+def balances(server, **filters):
+    entries = asyncio.run(server.get_daybook_entries(server.Response(), **filters))
+    return [(entry['date'].strftime('%Y-%m-%d'), entry['balance']) for entry in entries]
+
+
+def test_back_dated_entry_only_shifts_its_own_month(server):
+    add(server, "2024-01-10", credit=100)
+    add(server, "2024-02-05", debit=30)
+    add(server, "2024-02-20", credit=10)
+    add(server, "2024-03-01", credit=5)
+    entry = add(server, "2024-02-01", credit=50)
+    assert entry.balance == 150
+    assert balances(server) == [("2024-01-10", 100), ("2024-02-01", 150), ("2024-02-05", 120),
+                                ("2024-02-20", 130), ("2024-03-01", 135)]
+    # March's row kept its month balance; the February checkpoint carried the change
+    march = asyncio.run(server.db.daybook.find_one({"date": {"$regex": "^2024-03"}}))
+    assert march['month_balance'] == 5
+
+
+def test_moving_and_deleting_entries_keep_balances(server):
+    add(server, "2024-01-10", credit=100)
+    moved = add(server, "2024-01-20", debit=40)
+    add(server, "2024-03-01", credit=5)
+    update = server.DayBookEntryCreate(date="2024-02-15", description="moved", credit=0, debit=60)
+    assert asyncio.run(server.update_daybook_entry(moved.id, update))['balance'] == 40
+    assert balances(server) == [("2024-01-10", 100), ("2024-02-15", 40), ("2024-03-01", 45)]
+    asyncio.run(server.delete_daybook_entry(moved.id))
+    assert balances(server) == [("2024-01-10", 100), ("2024-03-01", 105)]
+    assert asyncio.run(server.recalculate_daybook())['rows_updated'] == 0
+
+
+def test_pages_and_exports_start_from_the_month_opening(server):
+    for day, credit in (("2024-01-05", 10), ("2024-02-05", 20), ("2024-02-06", 30)):
+        add(server, day, credit=credit)
+    page = asyncio.run(server.get_daybook_entries(server.Response(), skip=0, limit=1))
+    assert [entry['balance'] for entry in page] == [60]
+    assert asyncio.run(server.get_daybook_opening_balance(server.daybook_date_key("2024-02-06"))) == 30
+    assert asyncio.run(server.get_daybook_opening_balance(server.daybook_date_key("2024-04-01"))) == 60
+
+
+def test_rows_from_before_month_balances_are_rebuilt_at_startup(server):
+    asyncio.run(server.db.daybook.insert_many([
+        {"id": "a", "date": "2024-01-10T00:00:00+00:00", "created_at": "2024-01-10T00:00:00+00:00",
+         "credit": 100.0, "debit": 0.0, "balance": 100.0},
+        {"id": "b", "date": "2024-02-10T00:00:00+00:00", "created_at": "2024-02-10T00:00:00+00:00",
+         "credit": 0.0, "debit": 25.0, "balance": 75.0},
+    ]))
+    asyncio.run(server.ensure_daybook_indexes())
+    assert balances(server) == [("2024-01-10", 100), ("2024-02-10", 75)]
+    assert asyncio.run(server.db.daybook.count_documents({"balance": {"$exists": True}})) == 0
+
+
+def test_lease_is_held_until_released_or_expired(server, monkeypatch):
+    async def scenario():
+        assert await server.claim_daybook_lease("first")
+        assert not await server.claim_daybook_lease("second")
+        # The holder can extend its own lease
+        assert await server.claim_daybook_lease("first")
+        await server.release_daybook_lease("first")
+        assert await server.claim_daybook_lease("second")
+        monkeypatch.setattr(server, "DAYBOOK_LOCK_LEASE_SECONDS", -1)
+        assert await server.claim_daybook_lease("second")
+        # "second" died holding an expired lease
+        assert await server.claim_daybook_lease("third")
+    asyncio.run(scenario())
+
+
+def test_writers_wait_for_the_lease(server, monkeypatch):
+    monkeypatch.setattr(server, "DAYBOOK_LOCK_POLL_SECONDS", 0.01)
+
+    async def scenario():
+        # Another worker holds the lease
+        assert await server.claim_daybook_lease("other-worker")
+        writer = asyncio.ensure_future(server.create_daybook_entry(
+            server.DayBookEntryCreate(date="2024-01-10", description="waits", credit=10)))
+        await asyncio.sleep(0.05)
+        assert not writer.done()
+        await server.release_daybook_lease("other-worker")
+        return (await asyncio.wait_for(writer, 1)).balance
+    assert asyncio.run(scenario()) == pytest.approx(10)
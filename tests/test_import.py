@@ -0,0 +1,63 @@
+import asyncio
+import io
+
+from fastapi import UploadFile
+
+
+def upload(text):
+    return UploadFile(io.BytesIO(text.encode()), filename="import.csv")
+
+
+def run_import(server, entity, text, dry_run=False):
+    return asyncio.run(server.import_entities(entity, upload(text), dry_run=dry_run))
+
+
+def test_names_may_repeat_outside_imports(server):
+    async def scenario():
+        await server.db.customers.create_index("name", unique=True)
+        await server.ensure_import_indexes()
+        assert not (await server.db.customers.index_information())["name_1"].get("unique")
+        await server.create_customer(server.CustomerCreate(name="Ravi Traders"))
+        await server.create_customer(server.CustomerCreate(name="Ravi Traders"))
+        return await server.db.customers.count_documents({"name": "Ravi Traders"})
+    assert asyncio.run(scenario()) == 2
+
+
+def test_rows_match_on_id_then_unambiguous_name(server):
+    asyncio.run(server.db.customers.insert_many([
+        {"id": "c1", "name": "Ravi Traders", "phone": "1"},
+        {"id": "c2", "name": "Ravi Traders", "phone": "2"},
+        {"id": "c3", "name": "Asha Stores", "phone": "3"},
+    ]))
+    report = run_import(server, "customers", "id,name,phone\n"
+                                              ",Ravi Traders,10\n"
+                                              "c2,Ravi Traders,20\n"
+                                              ",Asha Stores,30\n"
+                                              ",New Mart,40\n"
+                                              "c9,Ghost,50\n")
+    assert (report['inserted'], report['updated'], report['valid_rows']) == (1, 2, 3)
+    assert [(error['row'], error['errors'][0]) for error in report['errors']] == [
+        (2, "2 records share this name, add an id column to choose one"),
+        (6, "No record with id c9"),
+    ]
+    phones = {doc['id']: doc['phone'] for doc in asyncio.run(server.db.customers.find({}).to_list(None))
+              if doc['name'] != "New Mart"}
+    assert phones == {"c1": "1", "c2": "20", "c3": "30"}
+    assert asyncio.run(server.db.customers.count_documents({"name": "New Mart"})) == 1
+
+
+def test_dry_run_reports_without_writing(server):
+    asyncio.run(server.db.customers.insert_one({"id": "c1", "name": "Asha Stores"}))
+    report = run_import(server, "customers", "name,phone\nAsha Stores,1\nNew Mart,2\nNew Mart,3\n", dry_run=True)
+    assert (report['inserted'], report['updated']) == (1, 1)
+    assert report['errors'][0]['errors'] == ["Duplicate name, already imported from row 3"]
+    assert asyncio.run(server.db.customers.count_documents({})) == 1
+
+
+def test_product_stock_changes_are_journaled(server):
+    asyncio.run(server.db.products.insert_one({"id": "p1", "name": "Jam", "stock_quantity": 5}))
+    report = run_import(server, "products", "name,stock_quantity,price\nJam,8,10\nPickle,3,20\n")
+    assert (report['inserted'], report['updated']) == (1, 1)
+    movements = asyncio.run(server.db.stock_movements.find({}, {"_id": 0}).to_list(None))
+    assert sorted((m['item_name'], m['source_type'], m['quantity']) for m in movements) == [
+        ("Jam", "adjustment", 3), ("Pickle", "opening_balance", 3)]
@@ -0,0 +1,131 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from mrp import ArrayIndex, low_level_codes, net_requirements, sum_by_index
+
+
+def test_array_index_adds_keys_in_first_seen_order():
+    index = ArrayIndex(["a", "b"])
+    assert index.add("b") == 1
+    assert index.add(("raw_material", "c")) == 2
+    assert index.lookup(["c", "a", "c"]).tolist() == [3, 0, 3]
+    assert index.keys == ["a", "b", ("raw_material", "c"), "c"]
+    assert len(index) == 4
+
+
+def test_array_index_lookup_of_nothing():
+    index = ArrayIndex()
+    assert index.lookup([]).tolist() == []
+    assert len(index) == 0
+
+
+def test_sum_by_index_adds_repeated_positions():
+    totals = sum_by_index(np.array([0, 2, 0]), [1.5, 4, 2], 4)
+    assert totals.tolist() == [3.5, 0.0, 4.0, 0.0]
+
+
+NO_LINES = (np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([]))
+
+
+def test_net_requirements_nets_stock_then_explodes_then_nets_materials():
+    # Products: 0 needs 10 with 4 in stock, 1 needs 5 with 8 in stock (nothing to make)
+    demand = np.array([10.0, 5.0])
+    product_stock = np.array([4.0, 8.0])
+    # Product 0 uses 2 of material 0 and 1 of material 1; product 1 uses 3 of material 1
+    bom_products = np.array([0, 0, 1])
+    bom_materials = np.array([0, 1, 1])
+    bom_quantities = np.array([2.0, 1.0, 3.0])
+    material_stock = np.array([5.0, 10.0])
+    material_on_order = np.array([3.0, 0.0])
+
+    requirement, to_produce, gross, shortage = net_requirements(
+        demand, product_stock, *NO_LINES, bom_products, bom_materials, bom_quantities,
+        material_stock, material_on_order)
+    assert requirement.tolist() == [10.0, 5.0]
+    assert to_produce.tolist() == [6.0, 0.0]
+    assert gross.tolist() == [12.0, 6.0]
+    assert shortage.tolist() == [4.0, 0.0]
+
+
+def test_sub_assembly_stock_is_netted_before_exploding_below_it():
+    # 0 (jar of jam, 10 ordered) uses 2 of sub-assembly 1 (jam batch, 15 in stock),
+    # which uses 3 of sub-assembly 2 (fruit mix, 4 in stock), which uses 1 of material 0
+    demand = np.array([10.0, 0.0, 0.0])
+    product_stock = np.array([0.0, 15.0, 4.0])
+    sub_parents, sub_children, sub_quantities = np.array([0, 1]), np.array([1, 2]), np.array([2.0, 3.0])
+
+    requirement, to_produce, gross, shortage = net_requirements(
+        demand, product_stock, sub_parents, sub_children, sub_quantities,
+        np.array([2]), np.array([0]), np.array([1.0]), np.array([0.0]), np.array([0.0]))
+    # 20 batches needed, 15 in stock -> make 5 -> 15 fruit mix needed, 4 in stock -> make 11
+    assert requirement.tolist() == [10.0, 20.0, 15.0]
+    assert to_produce.tolist() == [10.0, 5.0, 11.0]
+    assert gross.tolist() == [11.0]
+    assert shortage.tolist() == [11.0]
+
+
+def test_shared_sub_assembly_is_netted_once_against_all_its_parents():
+    # 0 uses 1 of 2 and 1 of 1; 1 uses 1 of 2. 2 is at level 2, after both its parents
+    sub_parents, sub_children, sub_quantities = np.array([0, 0, 1]), np.array([2, 1, 2]), np.ones(3)
+    assert low_level_codes(3, sub_parents, sub_children).tolist() == [0, 1, 2]
+    requirement, to_produce, _, _ = net_requirements(
+        np.array([4.0, 1.0, 0.0]), np.array([0.0, 2.0, 6.0]), sub_parents, sub_children, sub_quantities,
+        *NO_LINES, np.array([]), np.array([]))
+    # 2 is needed 4 directly by 0 plus 3 by 1 (5 needed, 2 in stock), with 6 in stock
+    assert requirement.tolist() == [4.0, 5.0, 7.0]
+    assert to_produce.tolist() == [4.0, 3.0, 1.0]
+
+
+def test_negative_stock_counts_as_none():
+    _, to_produce, gross, shortage = net_requirements(
+        np.array([3.0]), np.array([-2.0]), *NO_LINES,
+        np.array([0]), np.array([0]), np.array([1.5]),
+        np.array([-10.0]), np.array([1.0])
+    )
+    assert to_produce.tolist() == [3.0]
+    assert gross.tolist() == [pytest.approx(4.5)]
+    assert shortage.tolist() == [pytest.approx(3.5)]
+
+
+def test_materials_outside_any_bom_have_no_requirement():
+    _, _, gross, shortage = net_requirements(
+        np.array([1.0]), np.array([0.0]), *NO_LINES, *NO_LINES,
+        np.array([0.0, 0.0]), np.array([0.0, 0.0])
+    )
+    assert gross.tolist() == [0.0, 0.0]
+    assert shortage.tolist() == [0.0, 0.0]
+
+
+def test_run_mrp_uses_sub_assembly_stock_and_buys_only_materials(server):
+    def line(material_type, material_id, quantity):
+        return {"material_type": material_type, "material_id": material_id, "material_name": material_id,
+                "quantity": quantity, "unit": "pcs"}
+
+    async def scenario():
+        db = server.db
+        await db.sales_orders.insert_one({"id": "so-1", "approval_status": "approved", "production_status": "pending",
+                                          "so_status": "approved",
+                                          "items": [{"product_id": "jam", "product_name": "Jam", "quantity": 10}]})
+        await db.boms.insert_many([
+            {"id": "b1", "product_id": "jam", "created_at": "1",
+             "materials": [line("product", "batch", 2), line("raw", "sugar", 1), line("product", "lid", 1)]},
+            {"id": "b2", "product_id": "batch", "created_at": "1",
+             "materials": [line("raw", "fruit", 3), line("packing", "tub", 1)]},
+        ])
+        await db.products.insert_many([{"id": "jam", "stock_quantity": 0}, {"id": "batch", "stock_quantity": 15},
+                                       {"id": "lid", "stock_quantity": 0}])
+        await db.raw_materials.insert_many([{"id": "sugar", "name": "Sugar", "unit": "kg", "stock_quantity": 0},
+                                            {"id": "fruit", "name": "Fruit", "unit": "kg", "stock_quantity": 0}])
+        await db.packing_materials.insert_one({"id": "tub", "name": "Tub", "unit": "pcs", "stock_quantity": 1})
+        return await server.run_mrp()
+
+    result = asyncio.run(scenario())
+    plan = {row['product_id']: (row['dependent_demand'], row['to_produce']) for row in result['production_plan']}
+    # 20 batches needed, 15 in stock: only 5 are made, so fruit and tubs are bought for 5
+    assert plan == {"jam": (0.0, 10.0), "batch": (20.0, 5.0), "lid": (10.0, 10.0)}
+    assert result['products_without_bom'] == ["lid"]
+    bought = {(item['material_type'], item['material_id']): item['quantity']
+              for item in result['suggested_purchase_request']['items']}
+    assert bought == {("raw_material", "sugar"): 10, ("raw_material", "fruit"): 15, ("packing_material", "tub"): 4}
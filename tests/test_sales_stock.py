@@ -0,0 +1,47 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+
+@pytest.fixture
+def products(server):
+    asyncio.run(server.db.products.insert_many([
+        {"id": "p1", "name": "Jam", "stock_quantity": 10},
+        {"id": "p2", "name": "Pickle", "stock_quantity": 2},
+    ]))
+
+
+def item(server, product_id, quantity):
+    return server.InvoiceItem(product_id=product_id, product_name=product_id, quantity=quantity,
+                              unit="pcs", price=100, gst_rate=18)
+
+
+def stock(server):
+    return {product['id']: product['stock_quantity']
+            for product in asyncio.run(server.db.products.find({}, {"_id": 0}).to_list(None))}
+
+
+@pytest.mark.parametrize("session", [None, object()])
+def test_only_the_short_line_is_reported(server, products, session):
+    with pytest.raises(HTTPException) as raised:
+        asyncio.run(server.update_stock_on_sale([item(server, "p1", 8), item(server, "p2", 5)], session=session))
+    assert raised.value.status_code == 400
+    assert [(line['line'], line['product_id'], line['available']) for line in raised.value.detail['items']] == [
+        (2, "p2", 2)]
+    assert raised.value.detail['message'] == "Insufficient stock for p2. Available: 2, Required: 5.0"
+    assert stock(server) == {"p1": 10, "p2": 2}
+
+
+def test_repeated_lines_are_checked_against_their_total(server, products):
+    with pytest.raises(HTTPException) as raised:
+        asyncio.run(server.update_stock_on_sale([item(server, "p2", 1), item(server, "p2", 2)]))
+    assert [line['line'] for line in raised.value.detail['items']] == [1, 2]
+    assert stock(server) == {"p1": 10, "p2": 2}
+
+
+def test_sufficient_stock_is_deducted_and_journaled(server, products):
+    asyncio.run(server.update_stock_on_sale([item(server, "p1", 8), item(server, "p2", 2)], source_id="inv-1"))
+    assert stock(server) == {"p1": 2, "p2": 0}
+    movements = asyncio.run(server.db.stock_movements.find({"source_id": "inv-1"}, {"_id": 0}).to_list(None))
+    assert sorted((m['item_id'], m['quantity']) for m in movements) == [("p1", -8), ("p2", -2)]
@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+
+from benchmark_tax import float_totals, make_documents
+from tax import compute_document_tax, compute_tax_batch, document_totals, group_line_tax, to_rupee_lists
+
+TOTAL_KEYS = ("subtotal", "total_discount", "overall_discount_amount", "taxable_amount",
+              "cgst_amount", "sgst_amount", "igst_amount", "total_gst", "grand_total")
+
+
+def batch(documents):
+    """compute_tax_batch over (lines, is_interstate, discount_type, discount_value) documents, in rupees"""
+    all_lines = [line for lines, _, _, _ in documents for line in lines]
+    quantities, prices, discounts, rates = zip(*all_lines)
+    positions = np.repeat(np.arange(len(documents)), [len(lines) for lines, _, _, _ in documents])
+    result = compute_tax_batch(quantities, prices, discounts, rates, positions, len(documents),
+                               [doc[2] for doc in documents], [doc[3] for doc in documents],
+                               [doc[1] for doc in documents])
+    totals = to_rupee_lists(result['documents'])
+    lines = to_rupee_lists(result['lines'])
+    return totals, lines, positions
+
+
+def test_batch_matches_single_document_path():
+    documents = make_documents(300, 4, seed=3) + [
+        ([], False, "percentage", 10),
+        ([(0.333, 999.99, 12.5, 28), (17, 0.01, 0, 5)], True, "amount", 5000),
+        ([(2.5, 7.77, 5, 12)], False, "amount", 3.33),
+    ]
+    totals, lines, positions = batch(documents)
+    line_rows = [dict(zip(lines, values)) for values in zip(*lines.values())]
+    for index, (doc_lines, is_interstate, discount_type, discount_value) in enumerate(documents):
+        single = compute_document_tax(doc_lines, is_interstate, discount_type, discount_value, include_lines=True)
+        for key in TOTAL_KEYS:
+            assert single[key] == totals[key][index], (index, key)
+        assert single['lines'] == [row for row, position in zip(line_rows, positions) if position == index]
+
+
+def test_float_loop_matches_the_two_pass_loop_it_replaces():
+    for document in make_documents(300, 4, seed=5) + [([(3, 100, 10, 18)], False, "amount", 270)]:
+        single = document_totals(*document)
+        old = float_totals(*document)
+        for key in TOTAL_KEYS:
+            assert single[key] == pytest.approx(old[key], abs=1e-6), (document, key)
+        # Unrounded, but within a paisa per line of the exact totals
+        exact = compute_document_tax(*document)
+        assert single['grand_total'] == pytest.approx(exact['grand_total'], abs=0.01 * (len(document[0]) + 1))
+
+
+def test_lines_are_left_out_unless_asked_for():
+    assert "lines" not in compute_document_tax([(1, 100, 0, 18)])
+    assert len(compute_document_tax([(1, 100, 0, 18)] * 3, include_lines=True)['lines']) == 3
+
+
+def test_overall_discount_paise_go_to_largest_remainders():
+    # 1.00 split over three equal lines: 0.34 to the first (earlier rows win ties), 0.33 to the others
+    totals = compute_document_tax([(1, 10, 0, 0)] * 3, overall_discount_type="amount", overall_discount_value=1,
+                                  include_lines=True)
+    assert [line['overall_discount'] for line in totals['lines']] == [0.34, 0.33, 0.33]
+    assert totals['overall_discount_amount'] == 1.0
+    assert totals['taxable_amount'] == 29.0
+
+
+def test_overall_discount_follows_line_weights():
+    # 10% of 3.33 is 0.333 -> 0.33, split 1:2 -> 0.11 and 0.22
+    totals = compute_document_tax([(1, 1.11, 0, 0), (1, 2.22, 0, 0)], overall_discount_value=10, include_lines=True)
+    assert [line['overall_discount'] for line in totals['lines']] == [0.11, 0.22]
+
+
+def test_overall_discount_is_capped_at_the_taxable_amount():
+    totals = compute_document_tax([(2, 5, 0, 18)], overall_discount_type="amount", overall_discount_value=50)
+    assert totals['overall_discount_amount'] == 10.0
+    assert totals['taxable_amount'] == 0.0
+    assert totals['grand_total'] == 0.0
+
+
+def test_odd_gst_paisa_goes_to_cgst():
+    # 5% of 0.10 rounds half-up to 0.01, which can't be halved
+    totals = compute_document_tax([(1, 0.10, 0, 5)])
+    assert (totals['total_gst'], totals['cgst_amount'], totals['sgst_amount']) == (0.01, 0.01, 0.0)
+
+
+def test_interstate_puts_all_gst_in_igst():
+    totals = compute_document_tax([(3, 33.33, 10, 18)], is_interstate=True)
+    assert totals['igst_amount'] == totals['total_gst'] > 0
+    assert totals['cgst_amount'] == totals['sgst_amount'] == 0
+
+
+@pytest.mark.parametrize("is_interstate", [False, True])
+def test_document_totals_are_sums_of_lines(is_interstate):
+    doc_lines = [(3, 19.99, 12.5, 18), (7, 0.35, 0, 5), (1, 1234.56, 5, 28)]
+    totals = compute_document_tax(doc_lines, is_interstate, "percentage", 7.5, include_lines=True)
+    for total_key, line_key in (("taxable_amount", "final_taxable"), ("total_gst", "gst"),
+                                ("cgst_amount", "cgst"), ("sgst_amount", "sgst"), ("igst_amount", "igst")):
+        assert round(sum(line[line_key] for line in totals['lines']) * 100) == round(totals[total_key] * 100)
+    assert totals['grand_total'] == pytest.approx(totals['taxable_amount'] + totals['total_gst'])
+
+
+def test_half_paisa_rounds_up():
+    # 0.5 x 0.01 = 0.005 -> 0.01; 18% of 0.25 = 0.045 -> 0.05
+    assert compute_document_tax([(0.5, 0.01, 0, 0)])['subtotal'] == 0.01
+    assert compute_document_tax([(1, 0.25, 0, 18)])['total_gst'] == 0.05
+
+
+def test_group_line_tax_sums_in_paise():
+    lines = compute_document_tax([(1, 0.1, 0, 18)] * 3 + [(2, 5, 0, 5)], include_lines=True)['lines']
+    groups = group_line_tax(["a", "a", "a", "b"], [1, 1, 1, 2], lines)
+    assert [(key, quantity) for key, quantity, _ in groups] == [("a", 3), ("b", 2)]
+    assert groups[0][2]['taxable_amount'] == 0.3
+    assert groups[0][2]['total_gst'] == 0.06
@@ -0,0 +1,73 @@
+import pytest
+
+import ttl_cache
+from ttl_cache import TTLCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Controllable time.monotonic for the cache module"""
+    class Clock:
+        now = 1000.0
+    fake = Clock()
+    monkeypatch.setattr(ttl_cache.time, "monotonic", lambda: fake.now)
+    return fake
+
+
+def test_get_returns_stored_value_until_it_expires(clock):
+    cache = TTLCache(maxsize=10, ttl=5)
+    cache.set("a", 1)
+    clock.now += 4.9
+    assert cache.get("a") == 1
+    clock.now += 0.1
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_missing_key_returns_default(clock):
+    cache = TTLCache(maxsize=10, ttl=5)
+    assert cache.get("nope") is None
+    assert cache.get("nope", "fallback") == "fallback"
+
+
+def test_cached_none_is_not_a_miss(clock):
+    cache = TTLCache(maxsize=10, ttl=5)
+    cache.set("a", None)
+    assert cache.get("a", "fallback") is None
+
+
+def test_set_again_restarts_the_ttl(clock):
+    cache = TTLCache(maxsize=10, ttl=5)
+    cache.set("a", 1)
+    clock.now += 4
+    cache.set("a", 2)
+    clock.now += 4
+    assert cache.get("a") == 2
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert len(cache) == 2
+
+
+def test_pop_and_pop_where(clock):
+    cache = TTLCache(maxsize=10, ttl=60)
+    for key, role in (("u1", "admin"), ("u2", "staff"), ("u3", "staff")):
+        cache.set(key, {"role": role})
+    cache.pop("u1")
+    cache.pop("missing")
+    assert cache.pop_where(lambda user: user["role"] == "staff") == 2
+    assert len(cache) == 0
+
+
+def test_clear(clock):
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set("a", 1)
+    cache.clear()
+    assert cache.get("a") is None
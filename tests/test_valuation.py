@@ -0,0 +1,86 @@
+import pytest
+
+from valuation import FIFO, WEIGHTED_AVERAGE, issue, new_item_state, receive, value_movements
+
+
+def state():
+    return new_item_state("raw_material", "rm-1", "Sugar")
+
+
+@pytest.mark.parametrize("method", [WEIGHTED_AVERAGE, FIFO])
+def test_receipts_build_quantity_and_value(method):
+    item = state()
+    receive(item, 10, 4.0, method)
+    receive(item, 10, 6.0, method)
+    assert item['quantity'] == 20
+    assert item['value'] == pytest.approx(100.0)
+    assert item['average_cost'] == pytest.approx(5.0)
+
+
+def test_weighted_average_issues_at_average_cost():
+    item = state()
+    receive(item, 10, 4.0, WEIGHTED_AVERAGE)
+    receive(item, 10, 6.0, WEIGHTED_AVERAGE)
+    assert issue(item, 15, WEIGHTED_AVERAGE) == pytest.approx(75.0)
+    assert item['value'] == pytest.approx(25.0)
+
+
+def test_fifo_issues_oldest_layers_first():
+    item = state()
+    receive(item, 10, 4.0, FIFO)
+    receive(item, 10, 6.0, FIFO)
+    assert issue(item, 15, FIFO) == pytest.approx(10 * 4.0 + 5 * 6.0)
+    assert item['value'] == pytest.approx(30.0)
+    assert item['layers'] == [{"quantity": 5, "unit_cost": 6.0}]
+
+
+@pytest.mark.parametrize("method", [WEIGHTED_AVERAGE, FIFO])
+def test_receipt_into_negative_stock_is_valued_at_receipt_cost(method):
+    item = state()
+    receive(item, 5, 4.0, method)
+    issue(item, 10, method)
+    assert item['quantity'] == -5
+    receive(item, 10, 4.0, method)
+    assert item['quantity'] == 5
+    assert item['value'] == pytest.approx(20.0)
+    assert item['average_cost'] == pytest.approx(4.0)
+
+
+@pytest.mark.parametrize("method", [WEIGHTED_AVERAGE, FIFO])
+def test_receipt_that_leaves_stock_negative(method):
+    item = state()
+    receive(item, 2, 3.0, method)
+    issue(item, 10, method)
+    receive(item, 4, 5.0, method)
+    assert item['quantity'] == -4
+    assert item['value'] == pytest.approx(-20.0)
+
+
+@pytest.mark.parametrize("method", [WEIGHTED_AVERAGE, FIFO])
+def test_issuing_everything_zeroes_value(method):
+    item = state()
+    receive(item, 3, 1.1, method)
+    receive(item, 7, 1.3, method)
+    issue(item, 10, method)
+    assert item['quantity'] == 0.0
+    assert item['value'] == 0.0
+
+
+def test_value_movements_costs_production_output_from_consumption():
+    material, product = state(), new_item_state("product", "p-1", "Jam")
+    receive(material, 10, 2.0, WEIGHTED_AVERAGE)
+    consumed = {}
+    consume = [{"quantity": -4, "source_type": "production_consume", "source_id": "po-1"}]
+    assert value_movements(material, consume, WEIGHTED_AVERAGE, consumed) == pytest.approx(-8.0)
+    output = [{"quantity": 2, "source_type": "production_output", "source_id": "po-1"}]
+    assert value_movements(product, output, WEIGHTED_AVERAGE, consumed) == pytest.approx(8.0)
+    assert output[0]['unit_cost'] == pytest.approx(4.0)
+
+
+def test_receipt_without_cost_comes_in_at_average():
+    item = state()
+    receive(item, 10, 3.0, WEIGHTED_AVERAGE)
+    movements = [{"quantity": 5, "source_type": "adjustment"}]
+    value_movements(item, movements, WEIGHTED_AVERAGE)
+    assert movements[0]['unit_cost'] == pytest.approx(3.0)
+    assert item['value'] == pytest.approx(45.0)
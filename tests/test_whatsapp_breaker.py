@@ -0,0 +1,113 @@
+import asyncio
+
+import httpx
+import pytest
+
+import whatsapp_client
+from whatsapp_client import CircuitBreaker, WhatsAppUnavailable
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    fresh = CircuitBreaker(failure_threshold=3, reset_seconds=15)
+    monkeypatch.setattr(whatsapp_client, "breaker", fresh)
+    return fresh
+
+
+@pytest.fixture
+def service(monkeypatch):
+    """Route whatsapp_request to a handler instead of the network; set service.handler per test"""
+    class Service:
+        handler = None
+    stub = Service()
+    client = httpx.AsyncClient(base_url="http://whatsapp", transport=httpx.MockTransport(lambda r: stub.handler(r)))
+    monkeypatch.setattr(whatsapp_client, "_client", client)
+    monkeypatch.setattr(whatsapp_client, "WHATSAPP_RETRIES", 0)
+    return stub
+
+
+def test_opens_after_consecutive_failures(breaker):
+    breaker.record_failure("boom")
+    breaker.record_failure("boom")
+    assert breaker.state == "closed"
+    breaker.record_failure("boom")
+    assert (breaker.state, breaker.reason) == ("open", "failing")
+    assert not breaker.allows("/send-message")
+    assert not breaker.allows("/status")
+    with pytest.raises(WhatsAppUnavailable):
+        breaker.check("/send-message")
+
+
+def test_success_resets_the_failure_count(breaker):
+    breaker.record_failure("boom")
+    breaker.record_failure("boom")
+    breaker.record_success()
+    breaker.record_failure("boom")
+    assert breaker.state == "closed"
+    assert breaker.failures == 1
+
+
+def test_disconnected_service_still_allows_control_paths(breaker):
+    breaker.record_connected(False)
+    assert (breaker.state, breaker.reason) == ("open", "disconnected")
+    assert not breaker.allows("/send-message")
+    assert all(breaker.allows(path) for path in whatsapp_client.CONTROL_PATHS)
+    # A plain success (e.g. the /qr call itself) doesn't log the service back in
+    breaker.record_success()
+    assert breaker.state == "open"
+    breaker.record_connected(True)
+    assert breaker.state == "closed"
+
+
+def test_half_open_failure_reopens_at_once(breaker):
+    breaker.record_failure("boom")
+    breaker.state = "half_open"
+    breaker.record_failure("still down")
+    assert (breaker.state, breaker.last_error) == ("open", "still down")
+
+
+def test_probe_is_due_after_the_reset_interval(breaker):
+    breaker.reset_seconds = 0
+    assert not breaker.probe_due()
+    breaker.trip("failing", "boom")
+    assert breaker.probe_due()
+    assert breaker.snapshot()['state'] == "open"
+
+
+def test_server_errors_open_the_breaker(breaker, service):
+    service.handler = lambda request: httpx.Response(503, json={"error": "down"})
+    for _ in range(3):
+        assert asyncio.run(whatsapp_client.whatsapp_request("POST", "/send-message", json={})) == {"error": "down"}
+    assert breaker.state == "open"
+    with pytest.raises(WhatsAppUnavailable):
+        asyncio.run(whatsapp_client.whatsapp_request("POST", "/send-message", json={}))
+
+
+def test_pool_timeouts_do_not_count_as_failures(breaker, service):
+    def handler(request):
+        raise httpx.PoolTimeout("no free connection")
+    service.handler = handler
+    for _ in range(5):
+        with pytest.raises(httpx.PoolTimeout):
+            asyncio.run(whatsapp_client.whatsapp_request("POST", "/send-message", json={}))
+    assert breaker.state == "closed"
+    assert breaker.failures == 0
+
+
+def test_connect_errors_count_as_failures(breaker, service):
+    def handler(request):
+        raise httpx.ConnectError("refused")
+    service.handler = handler
+    for _ in range(3):
+        with pytest.raises(httpx.ConnectError):
+            asyncio.run(whatsapp_client.whatsapp_request("POST", "/send-message", json={}))
+    assert (breaker.state, breaker.reason) == ("open", "failing")
+
+
+def test_status_reporting_logged_out_opens_for_sends(breaker, service):
+    service.handler = lambda request: httpx.Response(200, json={"connected": False})
+    asyncio.run(whatsapp_client.whatsapp_request("GET", "/status"))
+    assert breaker.reason == "disconnected"
+    assert asyncio.run(whatsapp_client.whatsapp_request("GET", "/qr")) == {"connected": False}
+    with pytest.raises(WhatsAppUnavailable):
+        asyncio.run(whatsapp_client.whatsapp_request("POST", "/send-message", json={}))